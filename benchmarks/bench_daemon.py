@@ -0,0 +1,110 @@
+"""
+Gateway load from several clients querying overlapping days, each going to the gateway on its own ("direct") against
+all of them sharing a CacheDaemon ("daemon"). Everything runs on this machine: the clients are separate processes and
+the gateway is a FakeGateway with the given latency per call.
+
+At the end the first client sends a TRANSACTIONUPDATE, which the daemon pushes to the others.
+
+    python -m benchmarks.bench_daemon [clients] [queries per client] [records per query] [latency s]
+"""
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from model.daemon import CacheDaemon
+from model.fakegateway import FakeGateway
+from model.webservices import Webservices
+
+DAYS = 3
+
+
+def makeGateway(records: int, latency: float) -> FakeGateway:
+    gateway = FakeGateway(latency=latency)
+    # Answers any query, whatever its filter
+    gateway.record({"requesttypedescriptions": ["TRANSACTIONQUERY"]}, {"responses": [{
+        "errorcode": "0", "errormessage": "Ok", "errordata": [], "found": str(records),
+        "requesttypedescription": "TRANSACTIONQUERY",
+        "records": [{
+            "transactionreference": f"56-9-{i}", "baseamount": str(100 + i), "currencyiso3a": "GBP",
+            "settlestatus": "0", "requesttypedescription": "AUTH", "sitereference": "test_site12345",
+            "transactionstartedtimestamp": "2021-12-01 10:00:00", "errorcode": "0",
+        } for i in range(records)]}]})
+    return gateway
+
+
+def query(day: int) -> dict:
+    return {"requesttypedescriptions": ["TRANSACTIONQUERY"], "filter": {
+        "starttimestamp": [{"value": f"2021-12-{day + 1:02d} 00:00:00"}],
+        "endtimestamp": [{"value": f"2021-12-{day + 1:02d} 23:59:59"}]}}
+
+
+def client(mode, address, index, queries, records, latency, barrier, results):
+    logging.disable(logging.INFO)
+    pushes = []
+    if mode == "daemon":
+        os.environ["WS_TRANSPORT"] = "daemon"
+        os.environ["WS_DAEMON_ADDRESS"] = address
+        gateway = None
+        api = Webservices()
+        api.pushListeners.append(pushes.append)
+    else:
+        gateway = makeGateway(records, latency)
+        api = Webservices(gateway=gateway)
+    api.login("user", "pass")
+    barrier.wait()
+    started = time.perf_counter()
+    for q in range(queries):
+        api.makeRequest(query((index + q) % DAYS))
+    elapsed = time.perf_counter() - started
+    barrier.wait()
+    if index == 0:
+        api.makeRequest({"requesttypedescriptions": ["TRANSACTIONUPDATE"], "updates": {"settlestatus": "2"},
+                         "filter": {"transactionreference": [{"value": "56-9-0"}]}})
+    barrier.wait()
+    time.sleep(0.2)  # For the push to arrive
+    api.logout()
+    results.put((elapsed, gateway.calls if gateway else 0, len(pushes)))
+
+
+def run(mode, clients, queries, records, latency) -> tuple:
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(clients)
+    results = context.Queue()
+    daemon = None
+    address = None
+    if mode == "daemon":
+        address = os.path.join(tempfile.mkdtemp(), "daemon.sock")
+        daemon = CacheDaemon(address=address, gateway=makeGateway(records, latency))
+        daemon.start()
+    processes = [context.Process(target=client, args=(mode, address, i, queries, records, latency, barrier, results))
+                 for i in range(clients)]
+    for p in processes:
+        p.start()
+    outcomes = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    calls = sum(o[1] for o in outcomes)
+    if daemon is not None:
+        calls = daemon.gateway.calls
+        daemon.stop()
+    return max(o[0] for o in outcomes), calls, sum(o[2] for o in outcomes)
+
+
+def main():
+    logging.disable(logging.INFO)
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    records = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    latency = float(sys.argv[4]) if len(sys.argv) > 4 else 0.2
+    print(f"{clients} clients x {queries} queries over {DAYS} days, {records} records each, {latency}s latency")
+    print(f"{'mode':>8}{'queries':>10}{'gateway calls':>16}{'slowest client':>16}{'pushes':>8}")
+    for mode in ["direct", "daemon"]:
+        elapsed, calls, pushes = run(mode, clients, queries, records, latency)
+        # Gateway calls include each client's (or the daemon's) login
+        print(f"{mode:>8}{clients * queries:>10}{calls:>16}{elapsed * 1000:>14.0f}ms{pushes:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Ingestion throughput of TransactionStore.add against the number of Ingestor worker processes.
+
+For each worker count, measures the time add() holds the caller (the GUI thread in the app), the time a search right
+after it holds the caller (it doesn't wait for the workers' segments) and the time until the whole batch is searchable.
+1 worker is the plain in-process path.
+
+    python -m benchmarks.bench_ingest [records] [max workers]
+"""
+import logging
+import os
+import random
+import sys
+import time
+from model.ingest import Ingestor
+from model.transactionstore import TransactionStore
+
+
+def makeRecords(count: int) -> list:
+    random.seed(1)
+    return [{
+        "transactionreference": f"56-9-{i}", "requesttypedescription": random.choice(["AUTH", "REFUND"]),
+        "settlestatus": random.choice(["0", "100", "3"]), "baseamount": str(random.randint(1, 99999)),
+        "currencyiso3a": random.choice(["GBP", "USD", "EUR"]), "sitereference": "test_site12345",
+        "billingfirstname": random.choice(["John", "Jane", "Ann", "Mohammed", "Wei"]),
+        "billinglastname": f"Smith{i % 500}", "billingemail": f"user{i}@example.com",
+        "billingpostcode": f"AB{i % 90} {i % 9}CD", "orderreference": f"ORD-{i}", "maskedpan": "411111######1111",
+        "transactionstartedtimestamp": f"2021-12-{random.randint(1, 28):02d} {random.randint(0, 23):02d}:00:00",
+        "accounttypedescription": "ECOM", "paymenttypedescription": "VISA", "errorcode": "0",
+    } for i in range(count)]
+
+
+def waitForWorkers(store):
+    while store.search.pending:
+        time.sleep(0.001)
+
+
+def measure(records: list, workers: int) -> tuple:
+    ingestor = Ingestor(workers=workers, minRecords=1)
+    store = TransactionStore(budget=0, ingestor=ingestor)
+    if ingestor.wants(len(records)):
+        store.add(makeRecords(1000))  # start the workers outside the timing
+        waitForWorkers(store)
+        store.clear()
+    started = time.perf_counter()
+    store.add(records)
+    added = time.perf_counter() - started
+    searchStarted = time.perf_counter()
+    store.search.search("smith")
+    firstSearch = time.perf_counter() - searchStarted
+    waitForWorkers(store)
+    store.search.search("smith")
+    searchable = time.perf_counter() - started
+    ingestor.close()
+    return added, firstSearch, searchable
+
+
+def main():
+    logging.disable(logging.INFO)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    maxWorkers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    print(f"{count} records, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8}{'add()':>12}{'1st search':>12}{'searchable':>12}{'records/s':>14}")
+    workers = 1
+    while workers <= max(maxWorkers, 2):
+        added, firstSearch, searchable = measure(makeRecords(count), workers)
+        print(f"{workers:>8}{added * 1000:>10.0f}ms{firstSearch * 1000:>10.0f}ms{searchable * 1000:>10.0f}ms"
+              f"{count / searchable:>14.0f}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Compare the JSON transport with the securetrading SDK path against a local HTTP server posing as the gateway.
+
+Measures per-request overhead with a tiny response, and time and peak traced memory for one large TRANSACTIONQUERY
+response. The SDK path needs the securetrading package (pointed at the local server through config.datacenterurl
+and datacenterpath), a plain buffered requests.post().json() is also measured as the baseline the SDK's parsing amounts to. "streamed" hands
+the records to a callback without keeping them in the response, as a consumer filling the store would.
+
+    python -m benchmarks.bench_transport [records] [requests]
+"""
+import http.server
+import json
+import sys
+import threading
+import time
+import tracemalloc
+import requests
+from model.transport import JsonTransport, SdkTransport
+
+
+def makeBody(records: int) -> tuple:
+    """The response body either side of its requestreference, which the SDK checks against the one it sent."""
+    body = json.dumps({"requestreference": "REQUESTREFERENCE", "version": "1.00", "response": [{
+        "errorcode": "0", "errormessage": "Ok", "found": str(records), "requesttypedescription": "TRANSACTIONQUERY",
+        "records": [{
+            "transactionreference": f"1-9-{i}", "baseamount": str(100 + i % 5000), "currencyiso3a": "GBP",
+            "settlestatus": "100", "requesttypedescription": "AUTH", "sitereference": "test_site12345",
+            "billingfirstname": "Jane", "billinglastname": "Smith", "billingemail": "jane@example.com",
+            "maskedpan": "411111######1111", "transactionstartedtimestamp": "2021-12-01 10:00:00",
+            "orderreference": f"ORDER{i}", "settlebaseamount": str(100 + i % 5000), "errorcode": "0",
+        } for i in range(records)]}]}).encode()
+    head, tail = body.split(b"REQUESTREFERENCE")
+    return head, tail
+
+
+def serve(bodies: dict) -> http.server.ThreadingHTTPServer:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            reference = request["request"][0].get("requestreference", "A0001").encode()
+            head, tail = bodies[self.path]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(head) + len(reference) + len(tail)))
+            self.end_headers()
+            self.wfile.write(head)
+            self.wfile.write(reference)
+            self.wfile.write(tail)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(name, func, repeat=1):
+    func()  # warm up connections
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - started
+    # Memory is measured in a separate run, tracing allocations slows everything down
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<28}{elapsed / repeat * 1000:>10.2f}ms{peak / 1024 / 1024:>10.1f}MiB peak")
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    server = serve({"/small/json/": makeBody(0), "/large/json/": makeBody(records)})
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    request = {"requesttypedescriptions": ["TRANSACTIONQUERY"], "filter": {}}
+    transports = {"json transport": lambda path: JsonTransport("user", "pass", url=f"{base}/{path}/json/")}
+    try:
+        import securetrading
+
+        def sdk(path):
+            config = securetrading.Config()
+            config.username, config.password = "user", "pass"
+            # The SDK joins its absolute datacenterpath onto the url, replacing any path there
+            config.datacenterurl = base
+            config.datacenterpath = f"/{path}/json/"
+            return SdkTransport(securetrading.Api(config))
+        transports["securetrading sdk"] = sdk
+    except ImportError:
+        print("securetrading is not installed, skipping the SDK path")
+    session = requests.Session()
+    buffered = lambda path: session.post(f"{base}/{path}/json/", data=json.dumps({"request": [request]})).json()
+
+    print(f"Per request overhead, {count} requests with an empty response")
+    measure("buffered requests", lambda: buffered("small"), count)
+    for name, create in transports.items():
+        transport = create("small")
+        measure(name, lambda: transport.send(request, {}), count)
+    print(f"\nOne TRANSACTIONQUERY with {records} records")
+    measure("buffered requests", lambda: buffered("large"))
+    for name, create in transports.items():
+        transport = create("large")
+        measure(name, lambda: transport.send(request, {}))
+    transport = transports["json transport"]("large")
+    streamed = {"onRecords": lambda records: None, "keepRecords": False}
+    measure("json transport, streamed", lambda: transport.send(request, streamed))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
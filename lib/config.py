@@ -403,17 +403,27 @@ class Config:
                 To add multiple values for the same field, separate the values with commas.""",
             RequestType.AUTH: """All the initial fields are required and cannot be empty, unless using a saved card.
                 New field adds extra fields to the request.""",
+            RequestType.TRANSACTIONUPDATE: """Enter the new settlement values for the selected transactions, or for the
+                transaction given below if none are selected. Fields left empty are not changed.
+                settlestatus can be 0 (pending), 1 (manual), 2 (suspended) or 3 (cancelled).""",
             RequestType.ACCOUNTCHECK: """The card entered below will not be charged, but will be saved on the gateway
                 for future use, requiring only the securitycode and transactionreference of this as parent.
                 All the initial fields are required and cannot be empty.""",
         }
+        # Taken before anything toggles a header, so the defaults can always be gone back to
+        fields = [(f, d["position"]) for f, d in self.FIELDS.items() if d.get("activeInTransactionTableHeader")]
+        self._defaultHeaders = [f for f, position in sorted(fields, key=lambda f: f[1])]
 
     def toggleHeader(self, header: str):
         try:
-            self.HEADERS[header]["active"] = not self.HEADERS[header]["active"]
+            self.FIELDS[header]["activeInTransactionTableHeader"] = not self.FIELDS[header]["activeInTransactionTableHeader"]
         except KeyError as e:
             log.error(f"Header label {e} does not exist")
 
+    def defaultHeaders(self) -> list:
+        """The fields shown in the main table by default, in order, whatever has been toggled since."""
+        return list(self._defaultHeaders)
+
     def runValidation(self, field, value):
         result = False
         try:
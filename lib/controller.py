@@ -1,19 +1,40 @@
 from PySide6.QtCore import Qt
-from PySide6.QtWidgets import QLineEdit, QComboBox
+from PySide6.QtWidgets import QLineEdit, QComboBox, QMessageBox
 from lib.logger import createLogger
+from lib.profiling import profiled, profiler
 from view.errordialog import Error
 from view.infowindow import Info
+from view.reconcilewindow import ReconcileWindow
+from view.schedulewindow import ScheduleWindow
 from view.responsewindow import ResponseWindow
 from view.requestwindow import RequestWindow
 from lib.requesttype import RequestType
+from model.aggregator import DIMENSIONS
+from model.bulkupdate import BulkUpdater, UPDATABLE_FIELDS, readUpdateFile, validateUpdates
+from model.details import DetailCache
+from model.jobqueue import UNKNOWN, JobQueue
+from model.middleware import CircuitBreakerMiddleware
+from model.prefetcher import Prefetcher
+from model.reconciliation import COMPARED_FIELDS, Reconciler, formatReport
+from model.scheduler import Scheduler
+from model.searchindex import SEARCH_FIELDS
+from model.selection import Selection
+import os
+import threading
+import uuid
 
 log = createLogger(__name__)
 
+# Fields kept of listed transactions besides the table's columns: everything searched, summarised, reconciled or
+# updated locally, and what the batch refund and recurring charge windows show
+LIST_FIELDS = SEARCH_FIELDS + DIMENSIONS + COMPARED_FIELDS + UPDATABLE_FIELDS + [
+    "parenttransactionreference", "accounttypedescription", "errorcode"]
+
 
 def analyseResponses(responses: list) -> dict:
     """Expects a list of the inner responses from the outer gateway response."""
     log.debug(f"Analysing {responses}")
-    analysis = {res.get("referenceForResult", "NOREF!"): {"response": res, "error": not not int(res.get("errorcode", "ERROR!"))} for res in responses}
+    analysis = {res.get("referenceForResult", "NOREF!"): {"response": res, "error": res.get("errorcode", "ERROR!") != "0"} for res in responses}
     log.debug(f"\t->> {len(analysis.keys())}: {analysis}")
     return analysis
 
@@ -23,17 +44,43 @@ class Controller:
         self.view = view
         self.model = model
         self.api = api
-        self.selectedTransactions = []
+        self.selectedTransactions = Selection([], [])
         self.requestWindow = None
+        self.jobs = JobQueue(api)
+        self.prefetcher = None
+        self.prefetchTable = None
+        self.updater = BulkUpdater(self.jobs)
+        self.updateThread = None
+        self.scheduler = Scheduler(self.jobs)
+        self.scheduleWindow = None
+        self.billingThread = None
+        self.resumeThread = None
+        self.reconcileWindow = None
+        self.reconcileThread = None
+        self.details = DetailCache(api)
+        model.addListener(self.details)
+        # WS_PROJECT_QUERIES=0 keeps every field of every record
+        self._projecting = os.environ.get("WS_PROJECT_QUERIES", "1") == "1"
+        if self._projecting:
+            self._setProjection(self.view.table.columns())
         self._connectMainWindowComponents()
 
     def _connectMainWindowComponents(self):
         log.debug("_connectMainWindowComponents called")
         # Login Section
-        self.view.loginButton.clicked.connect(self._login)
+        self.view.loginButton.clicked.connect(lambda: self._login())
         # Table Section
-        self.view.table.itemSelectionChanged.connect(self._selectTransactions)
-        self.view.table.itemDoubleClicked.connect(self._showTransactionInfo)
+        for table in self.view.tables():
+            self._connectTable(table)
+        self.view.tableAdded.connect(self._connectTable)
+        self.view.tabs.currentChanged.connect(lambda index: self._switchTab())
+        self.view.tabs.tabCloseRequested.connect(lambda index: self._closeTab(index))
+        self.view.searchInput.textChanged.connect(self._search)
+        # Large batches become searchable a segment at a time, a search showing is run again as each one arrives
+        self.model.search.listeners.append(self.view.searchIndexed.emit)
+        self.view.searchIndexed.connect(lambda: self._search(self.view.searchInput.text()))
+        self.view.summary.groupInput.currentIndexChanged.connect(self._refreshSummary)
+        self.view.summary.bucketInput.currentIndexChanged.connect(self._refreshSummary)
 
         # Buttons Section
         def connectRequestButton(button):  # Function required due to lazy lambda?
@@ -42,32 +89,70 @@ class Controller:
 
         for btn in self.view.requestButtons.values():
             connectRequestButton(btn)
+        # Menus
+        self.view.reconcileAction.triggered.connect(self._openReconcileWindow)
+        self.view.scheduleAction.triggered.connect(self._openScheduleWindow)
+        # Status bar
+        breaker = self.api.findMiddleware(CircuitBreakerMiddleware)
+        if breaker is not None:
+            breaker.listeners.append(self.view.gatewayStateChanged.emit)
+        self.view.profileAction.toggled.connect(profiler.setEnabled)
+        self.view.residencyAction.triggered.connect(self._showResidency)
+        # Prefetching
+        self.view.recordsPrefetched.connect(self._addPrefetched)
+        self.view.prefetchDone.connect(self._prefetchDone)
+        # Bulk updates
+        self.view.updateProgress.connect(self._applyUpdates)
+        self.view.updatesDone.connect(self._updatesDone)
+        # Billing runs
+        self.view.billingProgress.connect(lambda done, total: self.view.statusBar().showMessage(
+            f"Charged {done} of {total} due subscriptions"))
+        self.view.billingDone.connect(self._billingDone)
+        self.view.reconcileDone.connect(self._reconcileDone)
+        # Jobs left unfinished by a previous session
+        self.view.resumeDone.connect(self._resumeDone)
+        # Changes other clients of the cache daemon made or saw
+        self.api.pushListeners.append(self.view.updatesPushed.emit)
+        self.view.updatesPushed.connect(self._applyPushed)
         log.debug("_connectMainWindowComponents returning")
 
+    def _connectTable(self, table):
+        table.selectionModel().selectionChanged.connect(lambda: self._selectTransactions())
+        # Resetting the model drops the selection without a selectionChanged
+        table.tableModel.modelReset.connect(lambda: self._selectTransactions())
+        table.doubleClicked.connect(lambda index: self._showTransactionInfo(index))
+        if self._projecting:
+            table.columnsChanged.connect(self._setProjection)
+
+    @profiled
     def _login(self):
         log.debug("_login called")
         # If logged in, log out
         if self.api.loggedIn:
-            self.api.st = None
-            self.api.loggedIn = False
+            self._stopPrefetch()
+            self.api.logout()
+            self.details.cleared()
+            self.model.clear()
             self.view.toggleLogin(self.api.loggedIn)
+            self._refreshSummary()
         else:
             # get username and password from main window
             username = self.view.userInput.text()
             password = self.view.passInput.text()
             # try to log in
             try:
-                response = self.api.login(username, password)
+                self.api.login(username, password)
             except Exception as e:
                 Error(e).exec()
                 log.debug("_login returning")
                 return
-            # populate table if transactions are found
-            if int(response["found"]) > 0:
-                log.debug(f"Populating table with {len(response['found'])} transactions")
-                self.model.add(response["records"])
-                self.view.table.populate(self.model.getAll())
+            # The UI is usable straight away, the table fills in as the prefetch brings in records
             self.view.toggleLogin(self.api.loggedIn)
+            self.prefetchTable = self.view.table
+            self.prefetcher = Prefetcher(self.api, self.view.recordsPrefetched.emit, self.view.prefetchDone.emit)
+            self.prefetcher.start()
+            self.view.statusBar().showMessage("Loading recent transactions...")
+            self._resumeJobs()
         log.debug("_login returning")
         return
 
@@ -84,11 +169,12 @@ class Controller:
             log.error(e)
             Error(e).exec()
             return
-        self.requestWindow.submitButton.clicked.connect(self._submitRequest)
+        self.requestWindow.submitButton.clicked.connect(lambda: self._submitRequest())
         self.requestWindow.exec()
         self.requestWindow = None
         log.debug("_openRequestWindow returning")
 
+    @profiled
     def _submitRequest(self):
         log.debug("_submitRequest called")
         window = self.requestWindow
@@ -102,6 +188,8 @@ class Controller:
             self._submitAUTH(window)
         elif window.requestType == RequestType.ACCOUNTCHECK:
             self._submitACCOUNTCHECK(window)
+        elif window.requestType == RequestType.TRANSACTIONUPDATE:
+            self._submitTRANSACTIONUPDATE(window)
         log.debug("_submitRequest returning")
 
     def _submitTRANSACTIONQUERY(self, window):
@@ -128,10 +216,11 @@ class Controller:
             Error(errString).exec()
             log.error(errString)
         elif int(response["found"]) > 0:
-            self.model.clear()
-            self.model.add(response["records"])
-            self.view.table.clear()
-            self.view.table.populate(self.model.getAll())
+            # Each query gets its own tab over the shared store, records already loaded are updated rather than copied
+            transactions = self.model.add(response["records"])
+            title = start[:10] if start[:10] == end[:10] else f"{start[:10]} to {end[:10]}"
+            self.view.newTab(title).populate(transactions)
+            self._refreshTables()
             window.close()
         else:
             msg = "Didn't find any transactions for supplied filter"
@@ -140,28 +229,21 @@ class Controller:
         log.debug("_submitTRANSACTIONQUERY returning")
 
     def _submitREFUND(self, window):
-        responses = []
         if len(window.transactions) > 0:
-            for t in window.transactions:
-                if t["requesttypedescription"] == "AUTH" and t["settlestatus"] == "100":
-                    gatewayResponse = self.api.makeRequest({
-                        "parenttransactionreference": t["transactionreference"],
-                        "requesttypedescriptions": ["REFUND"],
-                        "sitereference": t["sitereference"]
-                    })
-                    response = gatewayResponse["responses"][0]
-                    response["referenceForResult"] = t["transactionreference"]
-                    responses += (gatewayResponse["responses"])
+            items = [(f"REFUND:{t.transactionreference}", {
+                "parenttransactionreference": t.transactionreference,
+                "requesttypedescriptions": ["REFUND"],
+                "sitereference": t.sitereference
+            }) for t in window.transactions.refundable()]
         else:
             # gather data from the window to submit
-            response = self.api.makeRequest({
-                "parenttransactionreference": window.requiredInputs["parenttransactionreference"].text(),
+            parent = window.requiredInputs["parenttransactionreference"].text()
+            items = [(f"REFUND:{parent}", {
+                "parenttransactionreference": parent,
                 "requesttypedescriptions": ["REFUND"],
                 "sitereference": window.requiredInputs["sitereference"].text()
-            })
-            response["referenceForResult"] = window.requiredInputs["parenttransactionreference"].text()
-            responses.append(response)
-        ResponseWindow(analyseResponses(responses)).exec()
+            })]
+        self._runJobs(items)
 
     def _submitCUSTOM(self, window):
         # Build a request object from the inputted data
@@ -180,6 +262,7 @@ class Controller:
         gatewayResponse = self.api.makeRequest(request)
         responses = []
         for response in gatewayResponse["responses"]:
+            response = dict(response)  # Responses are read-only
             response["referenceForResult"] = response.get("transactionreference", "ERROR!")
             responses.append(response)
         ResponseWindow(analyseResponses(responses)).exec()
@@ -194,13 +277,8 @@ class Controller:
         # Remove empty rows from the filter
         if "" in request.keys():
             del request[""]
-        # make the request
-        gatewayResponse = self.api.makeRequest(request)
-        responses = []
-        for response in gatewayResponse["responses"]:
-            response["referenceForResult"] = response.get("transactionreference", "ERROR!")
-            responses.append(response)
-        ResponseWindow(analyseResponses(responses)).exec()
+        # make the request through the job queue, so there's a record of it even if we crash
+        self._runJobs([(f"AUTH:{uuid.uuid4()}", request)])
 
     def _submitACCOUNTCHECK(self, window):
         """Accountcheck to tokenise payment details on gateway"""
@@ -214,24 +292,352 @@ class Controller:
         # Remove empty rows from the filter
         if "" in request.keys():
             del request[""]
-        # make the request
-        gatewayResponse = self.api.makeRequest(request)
+        # make the request through the job queue, so there's a record of it even if we crash
+        self._runJobs([(f"ACCOUNTCHECK:{uuid.uuid4()}", request)])
+
+    def _submitTRANSACTIONUPDATE(self, window):
+        if self.updateThread is not None and self.updateThread.is_alive():
+            Error("Wait for the running update to finish first").exec()
+            return
+        try:
+            if window.updateFile is not None:
+                updates = readUpdateFile(window.updateFile)
+            else:
+                fields = {f: i.text().strip() for f, i in window.updateInputs.items() if i.text().strip()}
+                validateUpdates(fields)
+                if len(window.transactions) > 0:
+                    updates = [(t.transactionreference, t.sitereference, fields) for t in window.transactions]
+                else:
+                    updates = [(window.requiredInputs["transactionreference"].text().strip(),
+                                window.requiredInputs["sitereference"].text().strip(), fields)]
+        except Exception as e:
+            log.error(e)
+            Error(e).exec()
+            return
+        # Updates go out at the rate limit, which takes minutes for a big file, so they're sent off the GUI thread
+        self.updateThread = threading.Thread(target=self._runUpdates, args=(updates,), name="BulkUpdater", daemon=True)
+        self.updateThread.start()
+        self.view.statusBar().showMessage(f"Updating {len(updates)} transactions...")
+        window.close()
+
+    def _runUpdates(self, updates):
+        """Runs on the update thread, everything else is left to the GUI thread through signals."""
+        keys, error = [], None
+        try:
+            keys = self.updater.run(updates, self.view.updateProgress.emit)
+        except Exception as e:
+            log.error(f"Bulk update failed [{e}]")
+            error = str(e)
+        self.view.updatesDone.emit(keys, error)
+
+    @profiled
+    def _applyUpdates(self, done, total, changes):
+        if self.model.update(changes):
+            self._refreshTables()
+        self.view.statusBar().showMessage(f"Updated {done} of {total} transactions")
+
+    def _updatesDone(self, keys, error):
+        self.updateThread = None
+        if error is not None:
+            self.view.statusBar().showMessage(f"Bulk update stopped: {error}")
+            Error(error).exec()
+        if keys:
+            self._showJobResults(keys)
+
+    @profiled
+    def _runJobs(self, items):
+        """Queue (idempotencyKey, request) pairs, send whatever hasn't already gone through and show the results."""
+        keys = self.jobs.enqueue(items)
+        self.jobs.run(keys)
+        self._showJobResults(keys)
+
+    def _showJobResults(self, keys):
         responses = []
-        for response in gatewayResponse["responses"]:
-            response["referenceForResult"] = response.get("transactionreference", "ERROR!")
+        for key, (state, response) in self.jobs.results(keys).items():
+            response = response or {"errorcode": "ERROR!", "errormessage": state}
+            requestType, ref = key.split(":", 1)
+            # Refunds and updates are shown against the transaction they change, anything else against its new reference
+            if requestType == "REFUND":
+                response["referenceForResult"] = ref
+            elif requestType == "TRANSACTIONUPDATE":
+                response["referenceForResult"] = ref.split("@")[0].split(":")[-1]  # After the run id
+            else:
+                response["referenceForResult"] = response.get("transactionreference", "ERROR!")
             responses.append(response)
         ResponseWindow(analyseResponses(responses)).exec()
 
+    def _resumeJobs(self):
+        if self.resumeThread is not None:
+            return
+        unfinished = self.jobs.unfinished()
+        if unfinished == 0:
+            return
+        answer = QMessageBox.question(self.view, "Unfinished requests",
+                                      f"{unfinished} requests from a previous session didn't finish. Resume them now?")
+        if answer == QMessageBox.Yes:
+            # They may be a whole billing run or bulk update sent at the rate limits, so they're resumed off the GUI
+            # thread
+            self.resumeThread = threading.Thread(target=self._resumeRun, name="ResumeJobs", daemon=True)
+            self.resumeThread.start()
+            self.view.statusBar().showMessage(f"Resuming {unfinished} unfinished requests...")
+
+    def _resumeRun(self):
+        """Runs on the resume thread, everything else is left to the GUI thread through signals."""
+        keys, error = [], None
+        try:
+            self.jobs.run(onResult=lambda key, state, response: keys.append(key))
+            # Updates that went through are applied to the store like those of a bulk update
+            changes = self.updater.changesOf(keys)
+            if changes:
+                self.view.updateProgress.emit(len(changes), len(changes), changes)
+        except Exception as e:
+            log.error(f"Resuming unfinished requests failed [{e}]")
+            error = str(e)
+        self.view.resumeDone.emit(keys, error)
+
+    def _resumeDone(self, keys, error):
+        self.resumeThread = None
+        if error is not None:
+            self.view.statusBar().showMessage(f"Resuming unfinished requests stopped: {error}")
+            Error(error).exec()
+            return
+        states = [state for state, response in self.jobs.results(keys).values()]
+        summary = ", ".join(f"{states.count(state)} {state}" for state in sorted(set(states))) or "nothing to resume"
+        self.view.statusBar().showMessage(f"Resumed unfinished requests: {summary}", 5000)
+        message = f"Resumed unfinished requests: {summary}"
+        if UNKNOWN in states:
+            message += ("\n\nUnknown requests were interrupted while being sent and couldn't be found on the gateway. "
+                        "Check them there before sending them again.")
+        QMessageBox.information(self.view, "Unfinished requests", message)
+
+    @profiled
     def _selectTransactions(self):
         log.debug("selecting transactions")
-        table = self.view.table
-        self.selectedTransactions = []
-        for selectedRange in table.selectedRanges():
-            for transaction in table.transactions[selectedRange.topRow():selectedRange.bottomRow()+1]:
-                self.selectedTransactions.append(transaction)
-
-    def _showTransactionInfo(self, transaction):
-        Info(self.model.get(transaction.reference)).exec()
+        self.selectedTransactions = self.view.table.selection()
+
+    def _openReconcileWindow(self):
+        log.debug("_openReconcileWindow called")
+        if not self.api.loggedIn:
+            Error("Not logged in!").exec()
+            return
+        window = ReconcileWindow()
+        window.reconcileButton.clicked.connect(lambda: self._reconcile(window))
+        window.reconcileButton.setDisabled(self.reconcileThread is not None)
+        self.reconcileWindow = window
+        window.exec()
+        self.reconcileWindow = None
+        log.debug("_openReconcileWindow returning")
+
+    def _reconcile(self, window):
+        start = window.startInput.selectedDate().toPython()
+        end = window.endInput.selectedDate().toPython()
+        # A first check of a month queries every day in full, so it's done off the GUI thread
+        window.reconcileButton.setDisabled(True)
+        window.reportOutput.setPlainText(f"Reconciling {start} to {end}...")
+        apply = window.applyInput.isChecked()
+        self.reconcileThread = threading.Thread(target=self._reconcileRun, args=(start, end, apply), name="Reconciler",
+                                                daemon=True)
+        self.reconcileThread.start()
+
+    def _reconcileRun(self, start, end, apply):
+        """Runs on the reconciliation thread, everything else is left to the GUI thread through signals."""
+        report, error = None, None
+        try:
+            # The store is only changed on the GUI thread, in _reconcileDone
+            report = Reconciler(self.api, self.model).reconcile(start, end)
+            report["apply"] = apply
+        except Exception as e:
+            log.error(f"Reconciliation failed [{e}]")
+            error = str(e)
+        self.view.reconcileDone.emit(report, error)
+
+    def _reconcileDone(self, report, error):
+        self.reconcileThread = None
+        window = self.reconcileWindow
+        if window is not None:
+            window.reconcileButton.setDisabled(False)
+        if error is not None:
+            if window is not None:
+                window.reportOutput.setPlainText(f"Reconciliation stopped: {error}")
+            Error(error).exec()
+            return
+        if window is not None:
+            window.reportOutput.setPlainText(formatReport(report))
+        self.view.statusBar().showMessage(f"Reconciliation finished after {report['queries']} gateway queries", 5000)
+        if report["apply"] and report["records"]:
+            # Changed transactions are updated in place wherever they're shown, missing ones join the current tab
+            self.model.add(report["records"])
+            self.view.table.populate([self.model.get(ref) for ref in report["missing"]])
+            self._refreshTables()
+
+    def _openScheduleWindow(self):
+        log.debug("_openScheduleWindow called")
+        window = ScheduleWindow(len(self.selectedTransactions))
+        window.addButton.clicked.connect(lambda: self._addSubscriptions(window))
+        window.cancelButton.clicked.connect(lambda: self._cancelSubscriptions(window))
+        window.runButton.clicked.connect(lambda: self._runBillingRun(window))
+        window.runButton.setDisabled(self.billingThread is not None)
+        window.display(self.scheduler.subscriptions(), self.scheduler.history())
+        self.scheduleWindow = window
+        window.exec()
+        self.scheduleWindow = None
+        log.debug("_openScheduleWindow returning")
+
+    def _addSubscriptions(self, window):
+        try:
+            for t in self.selectedTransactions:
+                self.scheduler.add(t.transactionreference, t.sitereference, window.amountInput.text().strip(),
+                                   window.currencyInput.text().strip().upper() or t.currencyiso3a,
+                                   window.unitInput.currentText(), window.countInput.value(),
+                                   window.firstDueInput.date().toPython())
+        except Exception as e:
+            log.error(e)
+            Error(e).exec()
+        window.display(self.scheduler.subscriptions(), self.scheduler.history())
+
+    def _cancelSubscriptions(self, window):
+        for id in window.selectedIds():
+            self.scheduler.cancel(id)
+        window.display(self.scheduler.subscriptions(), self.scheduler.history())
+
+    def _runBillingRun(self, window):
+        if not self.api.loggedIn:
+            Error("Not logged in!").exec()
+            return
+        # Charges go out at the AUTH rate limit, thousands of them take minutes, so they're sent off the GUI thread
+        window.runButton.setDisabled(True)
+        self.billingThread = threading.Thread(target=self._billingRun, name="BillingRun", daemon=True)
+        self.billingThread.start()
+        self.view.statusBar().showMessage("Charging due subscriptions...")
+
+    def _billingRun(self):
+        """Runs on the billing thread, everything else is left to the GUI thread through signals."""
+        keys, error = [], None
+        try:
+            keys = self.scheduler.run(onBatch=self.view.billingProgress.emit)
+        except Exception as e:
+            log.error(f"Billing run failed [{e}]")
+            error = str(e)
+        self.view.billingDone.emit(keys, error)
+
+    def _billingDone(self, keys, error):
+        self.billingThread = None
+        window = self.scheduleWindow
+        if window is not None:
+            window.runButton.setDisabled(False)
+            window.display(self.scheduler.subscriptions(), self.scheduler.history())
+        if error is not None:
+            self.view.statusBar().showMessage(f"Billing run stopped: {error}")
+            Error(error).exec()
+            return
+        # Thousands of charges are summarised, the history lists each one
+        states = [state for state, response in self.jobs.results(keys).values()]
+        summary = ", ".join(f"{states.count(state)} {state}" for state in sorted(set(states))) or "nothing was due"
+        self.view.statusBar().showMessage(f"Billing run finished: {summary}", 5000)
+        QMessageBox.information(window or self.view, "Billing run", f"Billing run finished: {summary}")
+
+    def _refreshSummary(self):
+        """Summarise the transactions of the current tab."""
+        groupBy, bucket = self.view.summary.grouping()
+        aggregates = self.model.aggregates
+        rows = aggregates.rowsOf(self.view.table.references())
+        self.view.summary.display(aggregates.summarise(groupBy, bucket, rows))
+
+    @profiled
+    def _search(self, text):
+        self.view.table.setFilter(self.model.search.search(text), self.model.search)
+        pending = self.model.search.pending
+        if text.strip() and pending:
+            # Shown again as each segment arrives, until none are left
+            self.view.statusBar().showMessage(f"Still indexing {pending} transactions, more results may follow", 3000)
+
+    def _refreshTables(self):
+        """Show transactions changed in the store in every tab."""
+        for table in self.view.tables():
+            table.refresh()
+        self._refreshSummary()
+        self._search(self.view.searchInput.text())
+
+    def _switchTab(self):
+        if self.view.table is None:
+            return  # The last tab is going
+        self._refreshSummary()
+        self._search(self.view.searchInput.text())
+        self._selectTransactions()
+
+    def _closeTab(self, index):
+        # The transactions stay in the store, which keeps their records within its memory budget
+        table = self.view.tabs.widget(index)
+        if self.view.tabs.count() == 1:
+            table.clear()
+            self._refreshSummary()
+        else:
+            self.view.closeTab(index)
+        if table is self.prefetchTable:
+            self._stopPrefetch()
+
+    @profiled
+    def _addPrefetched(self, prefetcher, records):
+        if prefetcher is not self.prefetcher:
+            return  # From a prefetch that has since been stopped
+        self.prefetchTable.populate(self.model.add(records))
+        if self.prefetchTable is self.view.table:
+            self._refreshSummary()
+            self._search(self.view.searchInput.text())
+        self.view.statusBar().showMessage(f"Loading recent transactions... {prefetcher.loaded} so far")
+
+    def _prefetchDone(self, prefetcher, error):
+        if prefetcher is not self.prefetcher:
+            return
+        self.prefetcher = None
+        self.prefetchTable = None
+        if error is not None:
+            self.view.statusBar().showMessage(f"Couldn't load all recent transactions: {error}")
+        else:
+            self.view.statusBar().showMessage(f"Loaded {prefetcher.loaded} recent transactions", 5000)
+
+    def _applyPushed(self, message):
+        # Only transactions already loaded are brought up to date, the daemon pushes changes rather than new results
+        if message["push"] == "records":
+            records = [r for r in message["records"] if r.get("transactionreference") in self.model]
+            if not records:
+                return
+            self.model.add(records)
+        elif message["push"] == "updates":
+            if not self.model.update(message["updates"]):
+                return
+        self._refreshTables()
+
+    def _stopPrefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+            self.prefetchTable = None
+            self.view.statusBar().clearMessage()
+
+    def _showResidency(self):
+        stats = self.model.residency()
+        budget = f"{stats['budgetBytes'] / 2 ** 20:.0f}MiB" if stats["budgetBytes"] > 0 else "unlimited"
+        QMessageBox.information(self.view, "Store memory", "\n".join([
+            f"{stats['transactions']} transactions, {stats['resident']} in memory, {stats['spilled']} on disk",
+            f"{stats['residentBytes'] / 2 ** 20:.1f}MiB of records in memory, budget {budget}",
+            f"{stats['spillFileBytes'] / 2 ** 20:.1f}MiB spill file",
+            f"{stats['evictions']} evictions, {stats['reloads']} reloads",
+        ]))
+
+    def _setProjection(self, columns):
+        # Records already loaded keep what they have, a column added later fills in on the next query
+        self.model.projection = LIST_FIELDS + columns
+
+    @profiled
+    def _showTransactionInfo(self, index):
+        transaction = self.model.get(self.view.table.transactionAt(index).transactionreference)
+        try:
+            record = self.details.get(transaction)
+        except Exception as e:
+            log.error(e)
+            record = transaction.raw
+        Info(record).exec()
 
 
 
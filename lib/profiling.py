@@ -0,0 +1,127 @@
+"""
+Diagnostics for slow paths on the Qt thread.
+
+StallDetector measures event loop latency with a heartbeat timer, and a watchdog thread logs a stack sample of the
+GUI thread whenever the loop has been blocked for longer than WS_STALL_THRESHOLD_MS.
+
+ActionProfiler wraps functions decorated with @profiled in cProfile and tracemalloc when enabled, either with
+WS_PROFILE=1 or from the Debug menu, and writes a report per call to WS_PROFILE_DIR.
+"""
+import cProfile
+import datetime
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from PySide6.QtCore import QObject, QTimer
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+
+class StallDetector(QObject):
+    def __init__(self, thresholdMs=None, intervalMs=50):
+        super().__init__()
+        self.threshold = (thresholdMs or int(os.environ.get("WS_STALL_THRESHOLD_MS", 200))) / 1000
+        self.interval = intervalMs / 1000
+        self.maxLatency = 0.0
+        self.stalls = 0
+        self._lastBeat = time.monotonic()
+        self._reported = False
+        self._running = False
+        self._guiThreadId = threading.get_ident()
+        self._timer = QTimer(self)
+        self._timer.setInterval(intervalMs)
+        self._timer.timeout.connect(self._beat)
+
+    def start(self):
+        log.debug(f"Watching for event loop stalls over {self.threshold * 1000:.0f}ms")
+        self._lastBeat = time.monotonic()
+        self._running = True
+        self._timer.start()
+        threading.Thread(target=self._watch, name="StallDetector", daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        self._timer.stop()
+
+    def _beat(self):
+        now = time.monotonic()
+        latency = now - self._lastBeat - self.interval
+        self.maxLatency = max(self.maxLatency, latency)
+        if self._reported:
+            log.warning(f"Event loop resumed after a {(now - self._lastBeat) * 1000:.0f}ms stall")
+            self._reported = False
+        self._lastBeat = now
+
+    def _watch(self):
+        while self._running:
+            time.sleep(self.threshold / 2)
+            blocked = time.monotonic() - self._lastBeat
+            if blocked > self.threshold and not self._reported:
+                self._reported = True
+                self.stalls += 1
+                frame = sys._current_frames().get(self._guiThreadId)
+                stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>"
+                log.warning(f"Event loop blocked for {blocked * 1000:.0f}ms, GUI thread is at:\n{stack}")
+
+
+class ActionProfiler:
+    def __init__(self):
+        self.enabled = os.environ.get("WS_PROFILE", "0") == "1"
+        self.directory = os.environ.get("WS_PROFILE_DIR", "profiles")
+        self._active = False
+
+    def setEnabled(self, enabled):
+        log.info(f"Action profiling {'enabled' if enabled else 'disabled'}, reports go to {self.directory}")
+        self.enabled = enabled
+
+    def run(self, name, func, *args, **kwargs):
+        # Nested profiled calls are covered by the outermost one
+        if not self.enabled or self._active:
+            return func(*args, **kwargs)
+        self._active = True
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self._active = False
+            self._writeReport(name, profile, snapshot, elapsed, peak)
+
+    def _writeReport(self, name, profile, snapshot, elapsed, peak):
+        os.makedirs(self.directory, exist_ok=True)
+        stem = os.path.join(self.directory, f"{name}-{datetime.datetime.now():%Y%m%d-%H%M%S-%f}")
+        profile.dump_stats(stem + ".prof")
+        report = io.StringIO()
+        report.write(f"{name} took {elapsed * 1000:.1f}ms, peak traced memory {peak / 1024:.1f}KiB\n\n")
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(30)
+        report.write("Top allocations:\n")
+        for stat in snapshot.statistics("lineno")[:20]:
+            report.write(f"{stat}\n")
+        with open(stem + ".txt", "w") as f:
+            f.write(report.getvalue())
+        log.info(f"{name} took {elapsed * 1000:.1f}ms, profile written to {stem}.txt")
+
+
+profiler = ActionProfiler()
+
+
+def profiled(func):
+    """Profile calls to func whenever the profiler is enabled."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return profiler.run(func.__qualname__, func, *args, **kwargs)
+    return wrapper
@@ -1,13 +1,27 @@
 from PySide6.QtWidgets import QApplication
+import os
 import sys
 from lib.controller import Controller
+from lib.profiling import StallDetector
 from view.mainwindow import WSMain
 from model.webservices import Webservices
+from model.fakegateway import FakeGateway
+from model.journal import Journal
+from model.ingest import Ingestor
 from model.transactionstore import TransactionStore
 
-app = QApplication(sys.argv)
-mainWindow = WSMain()
-api = Webservices()
-model = TransactionStore()
-controller = Controller(view=mainWindow, model=model, api=api)
-sys.exit(app.exec())
+# Ingestion workers are spawned processes, which import this module again and must not start another app
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    stallDetector = StallDetector()
+    stallDetector.start()
+    mainWindow = WSMain()
+    # WS_FAKE_GATEWAY=<journal dir> answers every request from a recorded journal instead of the real gateway
+    fakeGateway = FakeGateway.fromJournal(Journal(os.environ["WS_FAKE_GATEWAY"])) if os.environ.get("WS_FAKE_GATEWAY") else None
+    api = Webservices(gateway=fakeGateway)
+    ingestor = Ingestor()
+    model = TransactionStore(ingestor=ingestor)
+    controller = Controller(view=mainWindow, model=model, api=api)
+    exitCode = app.exec()
+    ingestor.close()
+    sys.exit(exitCode)
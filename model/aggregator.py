@@ -0,0 +1,123 @@
+"""
+Columnar aggregates over the transaction store.
+
+Transactions are copied into NumPy columns as each batch arrives (one row per transactionreference, so a record that
+is added again replaces its old values). Summaries are grouped with bincount over integer codes, so they cost a few
+vectorised passes over the columns however many records are loaded.
+"""
+import numpy as np
+from lib.logger import createLogger
+
+log = createLogger(__name__)
+
+DIMENSIONS = ["currencyiso3a", "settlestatus", "requesttypedescription", "sitereference"]
+BUCKETS = {"hour": "datetime64[h]", "day": "datetime64[D]", "month": "datetime64[M]"}
+
+
+class TransactionAggregator:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._rows = {}
+        self._size = 0
+        self._amounts = np.zeros(1024, dtype=np.int64)
+        self._timestamps = np.zeros(1024, dtype="datetime64[s]")
+        self._codes = {d: np.zeros(1024, dtype=np.int32) for d in DIMENSIONS}
+        self._vocab = {d: {} for d in DIMENSIONS}
+        self._cache = {}
+
+    # Store listener interface
+    def added(self, transactions: list):
+        rows = self._rowsFor([t.transactionreference for t in transactions])
+        self._amounts[rows] = [t.baseamount or 0 for t in transactions]
+        self._timestamps[rows] = np.array([t.timestamp or "NaT" for t in transactions], dtype="datetime64[s]")
+        for dimension in DIMENSIONS:
+            self._codes[dimension][rows] = [self._code(dimension, t.get(dimension, "")) for t in transactions]
+        self._cache = {}
+        log.debug(f"Aggregated {len(transactions)} transactions, {self._size} in total")
+
+    def cleared(self):
+        self.clear()
+
+    def summarise(self, groupBy=("currencyiso3a",), bucket=None, rows=None) -> list:
+        """
+        Total, count and average baseamount for every group, as a list of (key, count, total, average) tuples sorted
+        by key. groupBy is a sequence of DIMENSIONS, bucket optionally adds a time bucket from BUCKETS. rows (see
+        rowsOf) limits the summary to some of the transactions, otherwise it covers all of them.
+        """
+        if rows is not None:
+            return self._summarise(groupBy, bucket, rows)
+        cacheKey = (tuple(groupBy), bucket)
+        if cacheKey not in self._cache:
+            self._cache[cacheKey] = self._summarise(groupBy, bucket)
+        return self._cache[cacheKey]
+
+    def rowsOf(self, refs) -> np.ndarray:
+        """The rows of the given transactionreferences, for summarise. Unknown references are left out."""
+        rows = self._rows
+        found = np.fromiter((rows.get(ref, -1) for ref in refs), dtype=np.int64)
+        return found[found >= 0]
+
+    def __len__(self):
+        return self._size
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _rowsFor(self, refs: list) -> np.ndarray:
+        rows = []
+        for ref in refs:
+            row = self._rows.get(ref)
+            if row is None:
+                row = self._rows[ref] = self._size
+                self._size += 1
+            rows.append(row)
+        if self._size > len(self._amounts):
+            self._grow(self._size)
+        return np.array(rows, dtype=np.int64)
+
+    def _grow(self, needed: int):
+        capacity = len(self._amounts)
+        while capacity < needed:
+            capacity *= 2
+        extra = capacity - len(self._amounts)
+        self._amounts = np.concatenate([self._amounts, np.zeros(extra, dtype=np.int64)])
+        self._timestamps = np.concatenate([self._timestamps, np.zeros(extra, dtype="datetime64[s]")])
+        for dimension in DIMENSIONS:
+            self._codes[dimension] = np.concatenate([self._codes[dimension], np.zeros(extra, dtype=np.int32)])
+
+    def _code(self, dimension: str, value: str) -> int:
+        vocab = self._vocab[dimension]
+        code = vocab.get(value)
+        if code is None:
+            code = vocab[value] = len(vocab)
+        return code
+
+    def _summarise(self, groupBy, bucket, rows=None) -> list:
+        n = self._size if rows is None else len(rows)
+        if rows is None:
+            rows = slice(0, n)
+        if n == 0:
+            return []
+        # Build one integer key per row from the mixed-radix combination of each dimension's codes
+        keys = np.zeros(n, dtype=np.int64)
+        labels = []
+        for dimension in groupBy:
+            radix = max(len(self._vocab[dimension]), 1)
+            keys = keys * radix + self._codes[dimension][rows]
+            labels.append(list(self._vocab[dimension]))
+        if bucket is not None:
+            buckets = self._timestamps[rows].astype(BUCKETS[bucket])
+            uniqueBuckets, bucketCodes = np.unique(buckets, return_inverse=True)
+            keys = keys * len(uniqueBuckets) + bucketCodes
+            labels.append([str(b) for b in uniqueBuckets])
+        uniqueKeys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse)
+        totals = np.bincount(inverse, weights=self._amounts[rows])
+        summary = []
+        for key, count, total in zip(uniqueKeys.tolist(), counts.tolist(), totals.tolist()):
+            parts = []
+            for values in reversed(labels):
+                key, code = divmod(key, len(values))
+                parts.append(values[code])
+            summary.append((tuple(reversed(parts)), count, int(total), total / count))
+        return sorted(summary)
@@ -0,0 +1,119 @@
+"""
+Bulk TRANSACTIONUPDATE of settlement fields.
+
+Updates are sent through the JobQueue, so a run is concurrent, checkpointed and safe to resume, in batches of
+WS_UPDATE_BATCH. The gateway doesn't return the updated record, so after each batch the changes that succeeded are
+handed back to be applied to the TransactionStore.
+
+Each run has its own id in its job keys, so a change made again later (e.g. settlestatus 2, then 0, then 2 again) is
+sent again rather than taken as already done. Passing the id of an earlier run resumes it instead. How fast updates go out is up to the RateLimitMiddleware, so a big
+run takes minutes and is meant to be run off the GUI thread.
+"""
+import csv
+import datetime
+import hashlib
+import os
+import re
+import uuid
+from dotenv import load_dotenv
+from lib.logger import createLogger
+from model.jobqueue import DONE
+from model.middleware import canonicalKey
+
+load_dotenv()
+log = createLogger(__name__)
+
+UPDATABLE_FIELDS = ["settlestatus", "settlebaseamount", "settleduedate"]
+SETTLE_STATUSES = {"0", "1", "2", "3"}
+
+
+def validateUpdates(updates: dict):
+    """Raise an Exception describing the first invalid change in updates, if any."""
+    if not updates:
+        raise Exception("Nothing to update, give at least one of " + ", ".join(UPDATABLE_FIELDS))
+    for field, value in updates.items():
+        if field not in UPDATABLE_FIELDS:
+            raise Exception(f"{field} can't be updated, only {', '.join(UPDATABLE_FIELDS)}")
+        if field == "settlestatus" and value not in SETTLE_STATUSES:
+            raise Exception(f"settlestatus must be one of {', '.join(sorted(SETTLE_STATUSES))}, not {value!r}")
+        if field == "settlebaseamount" and not re.fullmatch("[0-9]+", value):
+            raise Exception(f"settlebaseamount must be a whole number of minor units, not {value!r}")
+        if field == "settleduedate":
+            try:
+                datetime.date.fromisoformat(value)
+            except ValueError:
+                raise Exception(f"settleduedate must be a YYYY-MM-DD date, not {value!r}")
+
+
+def readUpdateFile(path: str) -> list:
+    """
+    (transactionreference, sitereference, updates) for each row of a CSV file with a transactionreference column, an
+    optional sitereference column and any of the UPDATABLE_FIELDS. Empty cells are left unchanged.
+    """
+    updates = []
+    with open(path, newline="") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            ref = (row.get("transactionreference") or "").strip()
+            if not ref:
+                raise Exception(f"{path} line {line}: no transactionreference")
+            changes = {field: row[field].strip() for field in UPDATABLE_FIELDS if (row.get(field) or "").strip()}
+            try:
+                validateUpdates(changes)
+            except Exception as e:
+                raise Exception(f"{path} line {line}: {e}")
+            updates.append((ref, (row.get("sitereference") or "").strip(), changes))
+    log.debug(f"Read {len(updates)} updates from {path}")
+    return updates
+
+
+def updateKey(runId: str, ref: str, updates: dict) -> str:
+    """Idempotency key: the same change to the same transaction is only ever sent once per run."""
+    return f"TRANSACTIONUPDATE:{runId}:{ref}@{hashlib.sha1(canonicalKey(updates).encode()).hexdigest()[:12]}"
+
+
+def updateRequest(ref: str, site: str, updates: dict) -> dict:
+    reqFilter = {"transactionreference": [{"value": ref}]}
+    if site:
+        reqFilter["sitereference"] = [{"value": site}]
+    return {"requesttypedescriptions": ["TRANSACTIONUPDATE"], "filter": reqFilter, "updates": dict(updates)}
+
+
+class BulkUpdater:
+    def __init__(self, jobs, batchSize=None):
+        self.jobs = jobs
+        self.batchSize = batchSize or int(os.environ.get("WS_UPDATE_BATCH", 200))
+
+    def run(self, updates: list, onBatch=None, runId=None) -> list:
+        """
+        Send (transactionreference, sitereference, updates) changes. onBatch(done, total, changes) is called after
+        each batch with the changes that went through, {transactionreference: updates}, for TransactionStore.update.
+        Both are called on the thread run is called on. runId resumes an earlier run of the same updates, by default
+        this is a new run. Returns the job keys, for JobQueue.results.
+        """
+        runId = runId or uuid.uuid4().hex
+        items = []
+        changes = {}
+        for ref, site, fields in updates:
+            key = updateKey(runId, ref, fields)
+            items.append((key, updateRequest(ref, site, fields)))
+            changes[key] = (ref, fields)
+        keys = self.jobs.enqueue(items)
+        log.debug(f"Updating {len(keys)} transactions in batches of {self.batchSize}")
+        for start in range(0, len(keys), self.batchSize):
+            batch = keys[start:start + self.batchSize]
+            self.jobs.run(batch)
+            # Including updates an interrupted copy of this run already made
+            done = [key for key, (state, response) in self.jobs.results(batch).items() if state == DONE]
+            if onBatch is not None:
+                onBatch(start + len(batch), len(keys), {changes[key][0]: changes[key][1] for key in done})
+        return keys
+
+    def changesOf(self, keys) -> dict:
+        """
+        The changes made by the done updates among any job keys, {transactionreference: updates}, e.g. for the jobs of
+        an interrupted run once JobQueue.run has finished them.
+        """
+        done = [key for key, (state, response) in self.jobs.results(keys).items()
+                if state == DONE and key.startswith("TRANSACTIONUPDATE:")]
+        return {request["filter"]["transactionreference"][0]["value"]: request["updates"]
+                for request in self.jobs.requests(done).values()}
@@ -0,0 +1,301 @@
+"""
+A local daemon shared by every client on the machine, so that operators running the client side by side share one
+gateway session per account instead of each querying the gateway for the same transactions.
+
+Clients connect with WS_TRANSPORT=daemon (see DaemonTransport) over a Unix socket or a localhost port, WS_DAEMON_ADDRESS.
+Every client logged in with the same credentials shares one Webservices, so its middlewares cache responses, merge
+identical requests in flight and keep to the rate limits for all of them together.
+
+The daemon also remembers a digest of every record it has passed on. When a query brings back a different version of a
+transaction, or a TRANSACTIONUPDATE goes through, the change is pushed to the account's other clients so the
+transactions they have loaded stay current without querying again.
+
+    python -m model.daemon
+
+The daemon itself reaches the gateway with the transport named by WS_DAEMON_TRANSPORT, sdk (the default) or json.
+
+WS_FAKE_GATEWAY=<journal dir> answers from a recorded journal instead of the real gateway, as for the client.
+"""
+import hashlib
+import json
+import os
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from dotenv import load_dotenv
+from lib.logger import createLogger
+from model.middleware import canonicalKey, requestTypesOf
+from model.transport import daemonAddress, daemonAuthkey
+from model.webservices import Webservices
+
+load_dotenv()
+log = createLogger(__name__)
+
+
+class _Session:
+    """One gateway session, shared by the clients logged in to the same account."""
+
+    def __init__(self, api):
+        self.api = api
+        self.clients = set()
+        self.digests = OrderedDict()  # transactionreference -> digest of the record last seen, least recent first
+        self.lock = threading.Lock()
+
+
+class _Client:
+    def __init__(self, connection):
+        self.connection = connection
+        self.session = None
+        self.sessionKey = None
+        self._lock = threading.Lock()
+
+    def send(self, message: dict):
+        data = json.dumps(message).encode()
+        with self._lock:
+            self.connection.send_bytes(data)
+
+    def disconnect(self):
+        """Hang up from any thread, _serve's recv then ends as if the client had."""
+        # Closing the Connection itself under a thread reading from it would break that read rather than end it
+        with socket.socket(fileno=os.dup(self.connection.fileno())) as s:
+            s.shutdown(socket.SHUT_RDWR)
+
+
+class CacheDaemon:
+    def __init__(self, address=None, gateway=None, workers=None, maxDigests=None, transport=None):
+        """
+        gateway replaces the securetrading Api of every session, e.g. with a FakeGateway. transport is how sessions reach
+        the gateway, sdk or json, by default WS_DAEMON_TRANSPORT. WS_TRANSPORT is for the clients and isn't used here.
+        """
+        self.address = address or daemonAddress()
+        self.gateway = gateway
+        self.transport = transport or os.environ.get("WS_DAEMON_TRANSPORT", "sdk")
+        if self.transport not in ["sdk", "json"]:
+            # A daemon going through a daemon would end up connecting to itself
+            raise Exception(f"The cache daemon reaches the gateway with the sdk or json transport, not {self.transport!r}")
+        self.maxDigests = maxDigests or int(os.environ.get("WS_DAEMON_MAX_RECORDS", 1000000))
+        self.requests = 0
+        self.pushes = 0
+        self._sessions = {}
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(workers or int(os.environ.get("WS_DAEMON_WORKERS", 32)),
+                                        thread_name_prefix="CacheDaemon")
+        self._listener = None
+        self._stopped = threading.Event()
+
+    def listen(self):
+        """Start listening, without accepting anyone yet. A Unix socket left by a daemon that has gone is replaced."""
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            try:
+                Client(self.address).close()
+            except OSError:
+                os.unlink(self.address)
+            else:
+                raise Exception(f"A cache daemon is already listening on {self.address}")
+        self._listener = Listener(self.address, authkey=daemonAuthkey())
+        if isinstance(self.address, str):
+            os.chmod(self.address, 0o600)
+        self.address = self._listener.address
+        log.info(f"Cache daemon listening on {self.address}")
+
+    def serveForever(self):
+        if self._listener is None:
+            self.listen()
+        while not self._stopped.is_set():
+            try:
+                connection = self._listener.accept()
+            except AuthenticationError:
+                log.warning("Refused a client with the wrong WS_DAEMON_KEY")
+                continue
+            except OSError:
+                break
+            if self._stopped.is_set():
+                connection.close()  # Only stop() waking us up
+                break
+            client = _Client(connection)
+            with self._lock:
+                self._clients.add(client)
+            threading.Thread(target=self._serve, args=(client,), name="CacheDaemonClient", daemon=True).start()
+
+    def start(self) -> threading.Thread:
+        """Serve on a background thread, for running the daemon inside another program or a test."""
+        self.listen()
+        thread = threading.Thread(target=self.serveForever, name="CacheDaemon", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+        if self._listener is not None:
+            # Closing the listener doesn't interrupt an accept() already waiting on it, a connection does
+            try:
+                Client(self.address, authkey=daemonAuthkey()).close()
+            except OSError:
+                pass
+            self._listener.close()
+        with self._lock:
+            clients = list(self._clients)
+        # Their clients see the connection go, and each one's _serve leaves its session
+        for client in clients:
+            try:
+                client.disconnect()
+            except OSError:
+                pass  # Already gone
+        self._pool.shutdown(wait=False)
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.api.logout()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._sessions), "clients": sum(len(s.clients) for s in self._sessions.values()),
+                    "requests": self.requests, "pushes": self.pushes}
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _serve(self, client):
+        try:
+            while True:
+                message = json.loads(client.connection.recv_bytes())
+                op = message.get("op")
+                if op == "login":
+                    self._login(client, message)
+                elif op == "request":
+                    if client.session is None:
+                        client.send({"id": message.get("id"), "error": "Not logged in to the cache daemon"})
+                    elif not self._stopped.is_set():
+                        self._pool.submit(self._request, client, client.session, message)
+                elif op == "logout":
+                    break
+                else:
+                    client.send({"id": message.get("id"), "error": f"Unknown operation {op!r}"})
+        except (EOFError, OSError):
+            pass
+        finally:
+            self._leave(client)
+            client.connection.close()
+            with self._lock:
+                self._clients.discard(client)
+
+    def _login(self, client, message):
+        """Join the session of the account, logging in to the gateway if nobody else is."""
+        # A wrong password is a different key, so it never gets into someone else's session
+        key = (message["username"], hashlib.sha256(message["password"].encode()).hexdigest())
+        self._leave(client)
+        with self._lock:
+            session = self._join(client, key)
+        if session is None:
+            api = Webservices(gateway=self.gateway, transport=self.transport)
+            try:
+                api.login(message["username"], message["password"])
+            except Exception as e:
+                client.send({"id": message["id"], "error": str(e)})
+                return
+            with self._lock:
+                session = self._join(client, key) or self._join(client, key, _Session(api))
+            if session.api is not api:  # Someone else logged in to the account meanwhile
+                api.logout()
+        log.debug(f"{message['username']} joined, {len(session.clients)} clients on the account")
+        client.send({"id": message["id"], "ok": True})
+
+    def _join(self, client, key, newSession=None):
+        """Add the client to the session under key, or to newSession as that key's. Called holding _lock."""
+        if newSession is not None:
+            self._sessions[key] = newSession
+        session = self._sessions.get(key)
+        if session is not None:
+            session.clients.add(client)
+            client.session = session
+            client.sessionKey = key
+        return session
+
+    def _leave(self, client):
+        """Leave the client's session, the last client out logs it out of the gateway."""
+        with self._lock:
+            session = client.session
+            if session is None:
+                return
+            session.clients.discard(client)
+            client.session = None
+            if not session.clients:
+                if self._sessions.get(client.sessionKey) is session:
+                    del self._sessions[client.sessionKey]
+                session.api.logout()
+
+    def _request(self, client, session, message):
+        request = message["request"]
+        def relay(records):
+            client.send({"id": message["id"], "records": records})
+        try:
+            with self._lock:
+                self.requests += 1
+            # Keep the records here too, the push needs them even if the client doesn't
+            response = session.api.makeRequest(request, onRecords=relay if message.get("stream") else None)
+        except Exception as e:
+            self._reply(client, {"id": message["id"], "error": str(e) or type(e).__name__})
+            return
+        responses = response.get("responses", [])
+        self._publish(session, client, request, responses)
+        if not message.get("keepRecords", True):
+            response = {**response, "responses": [{k: v for k, v in res.items() if k != "records"} for res in responses]}
+        self._reply(client, {"id": message["id"], "response": response})
+
+    def _reply(self, client, message):
+        try:
+            client.send(message)
+        except OSError:
+            pass  # The client has gone, _serve cleans up
+
+    def _publish(self, session, origin, request, responses):
+        """Push what changed to the account's other clients."""
+        push = None
+        requestTypes = requestTypesOf(request)
+        if requestTypes == ("TRANSACTIONQUERY",):
+            changed = []
+            with session.lock:
+                for res in responses:
+                    for record in res.get("records") or []:
+                        ref = record.get("transactionreference")
+                        digest = hashlib.sha1(canonicalKey(record).encode()).digest()
+                        previous = session.digests.pop(ref, None)
+                        session.digests[ref] = digest
+                        if previous is not None and previous != digest:
+                            changed.append(record)
+                while len(session.digests) > self.maxDigests:
+                    session.digests.popitem(last=False)
+            if changed:
+                push = {"push": "records", "records": changed}
+        elif requestTypes == ("TRANSACTIONUPDATE",) and all(r.get("errorcode") == "0" for r in responses):
+            refs = [f["value"] for f in request.get("filter", {}).get("transactionreference", [])]
+            if refs and request.get("updates"):
+                push = {"push": "updates", "updates": {ref: request["updates"] for ref in refs}}
+        if push is None:
+            return
+        with self._lock:
+            others = [c for c in session.clients if c is not origin]
+            self.pushes += len(others)
+        for other in others:
+            self._reply(other, push)
+
+
+def main():
+    gateway = None
+    if os.environ.get("WS_FAKE_GATEWAY"):
+        from model.fakegateway import FakeGateway
+        from model.journal import Journal
+        gateway = FakeGateway.fromJournal(Journal(os.environ["WS_FAKE_GATEWAY"]))
+    daemon = CacheDaemon(gateway=gateway)
+    try:
+        daemon.serveForever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Full gateway records for partial Transactions.
+
+List queries only keep the fields the table, search, summaries and reconciliation need (TransactionStore.projection).
+Everything else about a transaction is fetched by reference the first time it is asked for, and the last
+WS_DETAIL_CACHE records fetched are kept.
+"""
+import os
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+
+class DetailCache:
+    def __init__(self, api, maxEntries=None):
+        self.api = api
+        self.maxEntries = maxEntries or int(os.environ.get("WS_DETAIL_CACHE", 256))
+        self.hits = 0
+        self.fetches = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, transaction) -> dict:
+        """The full record of a Transaction, from the gateway if it is partial."""
+        if not transaction.isPartial:
+            return transaction.raw
+        ref = transaction.transactionreference
+        with self._lock:
+            record = self._entries.get(ref)
+            if record is not None:
+                self._entries.move_to_end(ref)
+                self.hits += 1
+                return record
+        reqFilter = {"transactionreference": [{"value": ref}]}
+        if transaction.sitereference:
+            reqFilter["sitereference"] = [{"value": transaction.sitereference}]
+        response = self.api.makeRequest({"requesttypedescriptions": ["TRANSACTIONQUERY"], "filter": reqFilter})
+        response = response["responses"][0]
+        self.fetches += 1
+        if response.get("errorcode") != "0" or not response.get("records"):
+            log.warning(f"Couldn't fetch the details of {ref}, showing what is loaded")
+            return transaction.raw
+        record = response["records"][0]
+        with self._lock:
+            self._entries[ref] = record
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+        return record
+
+    # Store listener interface, records that change in the store are fetched again
+    def added(self, transactions: list):
+        with self._lock:
+            for t in transactions:
+                self._entries.pop(t.transactionreference, None)
+
+    def cleared(self):
+        with self._lock:
+            self._entries = OrderedDict()
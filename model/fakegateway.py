@@ -0,0 +1,90 @@
+"""
+A stand-in for securetrading.Api that answers from recorded responses, for offline use and repeatable performance
+tests. Pass one to Webservices(gateway=...) and log in as normal.
+
+It can also misbehave like the real thing: latency grows once more than capacity requests are in flight, a fraction
+of requests (spikeChance) take spikeLatency longer, and outage() makes it fail for a while. Pass seed to make the
+spikes repeatable.
+"""
+import copy
+import itertools
+import random
+import threading
+import time
+from lib.logger import createLogger
+from model.journal import redact
+from model.middleware import TRANSPORT_ERRORCODES, canonicalKey, requestTypesOf
+
+log = createLogger(__name__)
+
+
+class FakeGateway:
+    def __init__(self, latency=0.0, capacity=None, spikeChance=0.0, spikeLatency=0.0, seed=None):
+        self.latency = latency
+        self.capacity = capacity
+        self.spikeChance = spikeChance
+        self.spikeLatency = spikeLatency
+        self.calls = 0
+        self.inflight = 0
+        self._exact = {}
+        self._byType = {}
+        self._cycles = {}
+        self._random = random.Random(seed)
+        self._outageUntil = 0.0
+        self._outageErrorcode = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromJournal(cls, journal, **kwargs):
+        gateway = cls(**kwargs)
+        for entry in journal.entries():
+            gateway.record(entry["request"], entry["response"])
+        return gateway
+
+    def record(self, request: dict, response: dict):
+        """Answer request with response. Recording the same request again queues another response for it."""
+        self._exact.setdefault(self._key(request), []).append(response)
+        self._byType.setdefault(requestTypesOf(request), []).append(response)
+
+    def outage(self, seconds, errorcode="7"):
+        """
+        Fail every request for the next seconds with a response carrying errorcode, by default "7" as the securetrading
+        SDK answers when it can't connect (it never raises). With errorcode None a ConnectionError is raised instead,
+        as JsonTransport would.
+        """
+        self._outageUntil = time.monotonic() + seconds
+        self._outageErrorcode = errorcode
+
+    def process(self, request) -> dict:
+        with self._lock:
+            self.calls += 1
+            self.inflight += 1
+            load = self.inflight / self.capacity if self.capacity else 1
+            spike = self._random.random() < self.spikeChance
+        try:
+            delay = self.latency * max(load, 1) + (self.spikeLatency if spike else 0)
+            if delay:
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+        if time.monotonic() < self._outageUntil:
+            if self._outageErrorcode is None:
+                raise ConnectionError("Fake gateway outage")
+            # The SDK's own errors aren't answers to any request type
+            requestType = "ERROR" if self._outageErrorcode in TRANSPORT_ERRORCODES else requestTypesOf(request)[0]
+            return {"responses": [{"errorcode": self._outageErrorcode, "errormessage": "Fake gateway outage",
+                                   "errordata": [], "requesttypedescription": requestType}]}
+        key = self._key(request)
+        responses = self._exact.get(key) or self._byType.get(requestTypesOf(request))
+        if not responses:
+            log.debug(f"No recorded response for {key}")
+            return {"responses": [{"errorcode": "0", "errormessage": "Ok", "errordata": [], "found": "0",
+                                   "records": [], "requesttypedescription": requestTypesOf(request)[0]}]}
+        # Cycle through the recorded responses so repeated runs see the same sequence
+        cycle = self._cycles.setdefault(key, itertools.cycle(responses))
+        return copy.deepcopy(next(cycle))
+
+    def _key(self, request) -> str:
+        request = {k: v for k, v in dict(request).items() if k != "requestreference"}
+        return canonicalKey(redact(request))
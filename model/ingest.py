@@ -0,0 +1,42 @@
+"""
+Worker processes for the CPU heavy part of ingesting large query responses.
+
+Workers are spawned (never forked, the parent is a Qt application) once, on the first batch big enough to be worth
+it, and kept for the session. Work is sent as plain tuples and comes back as compact NumPy arrays, so a chunk costs
+little to move between processes compared with what it saves.
+"""
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+
+class Ingestor:
+    def __init__(self, workers=None, minRecords=None):
+        """Batches of fewer than minRecords are left to the caller, splitting them costs more than it saves."""
+        self.workers = workers or int(os.environ.get("WS_INGEST_WORKERS", 0)) or os.cpu_count() or 1
+        self.minRecords = minRecords or int(os.environ.get("WS_INGEST_MIN_RECORDS", 20000))
+        self._pool = None
+
+    def wants(self, size: int) -> bool:
+        return self.workers > 1 and size >= self.minRecords
+
+    def map(self, func, items: list) -> list:
+        """Submit func over chunks of items, returning (start of the chunk in items, future) pairs."""
+        if self._pool is None:
+            log.debug(f"Starting {self.workers} ingestion workers")
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        # Two chunks per worker evens out the load without paying for many small transfers
+        chunkSize = max(math.ceil(len(items) / (self.workers * 2)), 1)
+        return [(start, self._pool.submit(func, items[start:start + chunkSize]))
+                for start in range(0, len(items), chunkSize)]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
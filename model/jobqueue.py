@@ -0,0 +1,197 @@
+"""
+Durable queue for bulk gateway work.
+
+Every request is stored in SQLite under an idempotency key before it is sent, and its state is checkpointed around
+each call: pending -> inflight -> done/failed. Enqueuing a key that already exists does nothing unless it failed, so
+re-running a batch after a crash only sends what hasn't gone through yet.
+
+A job still inflight when the app stopped may or may not have reached the gateway. On resume it is looked up on the
+gateway where possible (a REFUND by its parent reference, a TRANSACTIONUPDATE by whether the transaction already has
+the new values, anything else by its orderreference) and otherwise marked unknown, never sent twice. Once the gateway
+has been checked by hand, retry queues unknown jobs again.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+PENDING = "pending"
+INFLIGHT = "inflight"
+DONE = "done"
+FAILED = "failed"
+UNKNOWN = "unknown"
+
+
+class JobQueue:
+    def __init__(self, api, path=None, workers=None):
+        self.api = api
+        self.path = path or os.environ.get("WS_JOBQUEUE_PATH", "jobs.sqlite3")
+        self.workers = workers or int(os.environ.get("WS_JOBQUEUE_WORKERS", 4))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            key TEXT PRIMARY KEY,
+            requesttype TEXT NOT NULL,
+            request TEXT NOT NULL,
+            state TEXT NOT NULL,
+            response TEXT,
+            updated REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self._db.commit()
+
+    def enqueue(self, items: list) -> list:
+        """
+        Add (idempotencyKey, request) pairs. Keys that are already queued or done are left alone, failed ones are
+        queued again. Returns the keys, for run and results.
+        """
+        with self._lock:
+            for key, request in items:
+                self._db.execute(
+                    """INSERT INTO jobs VALUES (?, ?, ?, ?, NULL, ?)
+                       ON CONFLICT(key) DO UPDATE SET state = excluded.state, request = excluded.request,
+                       updated = excluded.updated WHERE jobs.state = ?""",
+                    (key, "|".join(request["requesttypedescriptions"]), json.dumps(request), PENDING, time.time(),
+                     FAILED))
+            self._db.commit()
+        return [key for key, request in items]
+
+    def retry(self, keys) -> list:
+        """
+        Queue the unknown (or failed) jobs among keys again, for once the gateway has been checked and they are known
+        not to have gone through. Returns the keys that were queued.
+        """
+        keys = list(keys)
+        queued = []
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key FROM jobs WHERE state IN (?, ?) AND key IN ({','.join('?' * len(chunk))})",
+                    [UNKNOWN, FAILED] + chunk)
+                queued += [key for key, in rows]
+            self._db.executemany("UPDATE jobs SET state = ?, response = NULL, updated = ? WHERE key = ?",
+                                 [(PENDING, time.time(), key) for key in queued])
+            self._db.commit()
+        log.debug(f"Queued {len(queued)} of {len(keys)} jobs again")
+        return queued
+
+    def requests(self, keys) -> dict:
+        """key -> the request queued under it, for the given keys."""
+        keys = list(keys)
+        requests = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, request FROM jobs WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, request in rows:
+                    requests[key] = json.loads(request)
+        return requests
+
+    def run(self, keys=None, onResult=None):
+        """
+        Send the unfinished jobs among keys (or every unfinished job) with concurrent workers, checkpointing each
+        result. onResult(key, state, response) is called from the worker threads as each one completes.
+        """
+        jobs = self._unfinished(keys)
+        log.debug(f"Running {len(jobs)} jobs with {self.workers} workers")
+        with ThreadPoolExecutor(self.workers) as pool:
+            for key, request, state in jobs:
+                pool.submit(self._runJob, key, json.loads(request), state, onResult)
+
+    def results(self, keys) -> dict:
+        """key -> (state, response) for the given keys."""
+        keys = list(keys)
+        results = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, state, response FROM jobs WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, state, response in rows:
+                    results[key] = (state, json.loads(response) if response else None)
+        return results
+
+    def unfinished(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)", (PENDING, INFLIGHT)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _unfinished(self, keys) -> list:
+        with self._lock:
+            rows = self._db.execute("SELECT key, request, state FROM jobs WHERE state IN (?, ?)",
+                                    (PENDING, INFLIGHT)).fetchall()
+        if keys is not None:
+            keys = set(keys)
+            rows = [row for row in rows if row[0] in keys]
+        return rows
+
+    def _runJob(self, key, request, state, onResult):
+        try:
+            if state == INFLIGHT:
+                response = self._recover(request)
+                if response is None:
+                    self._checkpoint(key, UNKNOWN, {"errorcode": "UNKNOWN", "errormessage":
+                                     "Interrupted while being sent, check the gateway before retrying"}, onResult)
+                    return
+            else:
+                self._checkpoint(key, INFLIGHT, None, None)
+                response = self.api.makeRequest(request)["responses"][0]
+            self._checkpoint(key, DONE if response.get("errorcode") == "0" else FAILED, response, onResult)
+        except Exception as e:
+            log.error(f"Job {key} failed [{e}]")
+            self._checkpoint(key, FAILED, {"errorcode": "ERROR!", "errormessage": str(e)}, onResult)
+
+    def _recover(self, request):
+        """Find out whether an interrupted request reached the gateway, returning its record if it did."""
+        requestType = request["requesttypedescriptions"][0]
+        if requestType == "TRANSACTIONUPDATE":
+            return self._recoverUpdate(request)
+        if requestType == "REFUND":
+            reqFilter = {"parenttransactionreference": [{"value": request["parenttransactionreference"]}]}
+        elif request.get("orderreference"):
+            reqFilter = {"orderreference": [{"value": request["orderreference"]}]}
+        else:
+            return None
+        reqFilter["requesttypedescription"] = [{"value": requestType}]
+        if request.get("sitereference"):
+            reqFilter["sitereference"] = [{"value": request["sitereference"]}]
+        response = self.api.makeRequest({"requesttypedescriptions": ["TRANSACTIONQUERY"], "filter": reqFilter})
+        response = response["responses"][0]
+        if response.get("errorcode") != "0" or int(response.get("found", 0)) == 0:
+            return None
+        # A copy, the record may be shared with a cached gateway response
+        record = {"errorcode": "0", **response["records"][0]}
+        log.debug(f"Recovered interrupted {requestType} {record['transactionreference']}")
+        return record
+
+    def _recoverUpdate(self, request):
+        response = self.api.makeRequest({"requesttypedescriptions": ["TRANSACTIONQUERY"], "filter": request["filter"]})
+        response = response["responses"][0]
+        if response.get("errorcode") != "0" or int(response.get("found", 0)) == 0:
+            return None
+        record = response["records"][0]
+        if any(record.get(field) != value for field, value in request["updates"].items()):
+            return None
+        log.debug(f"Recovered interrupted TRANSACTIONUPDATE of {record['transactionreference']}")
+        return {"errorcode": "0", "errormessage": "Ok", "requesttypedescription": "TRANSACTIONUPDATE"}
+
+    def _checkpoint(self, key, state, response, onResult):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET state = ?, response = ?, updated = ? WHERE key = ?",
+                             (state, json.dumps(response, default=str) if response is not None else None,
+                              time.time(), key))
+            self._db.commit()
+        if onResult is not None:
+            onResult(key, state, response)
@@ -0,0 +1,188 @@
+"""
+Append-only journal of every request sent to the gateway and the response it got.
+
+Entries are single JSON lines in size-rotated segment files, with card details and passwords redacted. Each append
+also writes a line to journal.idx giving the segment, byte offset, time and every transactionreference the entry
+mentions, so lookups by reference or time read just the entries they need through a memory map. Only the newest
+maxSegments segments are kept, older ones (and their index lines) are deleted as the journal rotates.
+"""
+import bisect
+import glob
+import json
+import mmap
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+SENSITIVE_FIELDS = {"pan", "securitycode", "expirydate", "password"}
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: "REDACTED" if k in SENSITIVE_FIELDS else redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+
+def referencesIn(request: dict, response: dict) -> set:
+    refs = {request.get("transactionreference"), request.get("parenttransactionreference")}
+    for res in response.get("responses", []):
+        refs.add(res.get("transactionreference"))
+        refs.update(record.get("transactionreference") for record in res.get("records", []))
+    refs.discard(None)
+    refs.discard("")
+    return refs
+
+
+class Journal:
+    def __init__(self, directory=None, maxBytes=None, maxSegments=None):
+        self.directory = directory or os.environ.get("WS_JOURNAL_DIR", "journal")
+        self.maxBytes = maxBytes or int(os.environ.get("WS_JOURNAL_MAX_BYTES", 64 * 1024 * 1024))
+        self.maxSegments = maxSegments or int(os.environ.get("WS_JOURNAL_MAX_SEGMENTS", 16))
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._byRef = {}
+        self._times = []
+        self._positions = []
+        self._maps = {}
+        self._loadIndex()
+        segments = self._segments()
+        self._segment = segments[-1] if segments else 1
+        self._file = open(self._segmentPath(self._segment), "ab")
+        self._indexFile = open(os.path.join(self.directory, "journal.idx"), "a")
+        # In case maxSegments was lowered since the journal was written
+        self._dropSegmentsBefore(self._segment - self.maxSegments + 1)
+
+    def append(self, request: dict, response: dict):
+        timestamp = time.time()
+        line = json.dumps({"t": timestamp, "request": redact(request), "response": redact(response)},
+                          default=str).encode() + b"\n"
+        refs = sorted(referencesIn(request, response))
+        with self._lock:
+            if self._file.tell() + len(line) > self.maxBytes and self._file.tell() > 0:
+                self._rotate()
+            offset = self._file.tell()
+            self._file.write(line)
+            self._file.flush()
+            self._indexFile.write(json.dumps({"s": self._segment, "o": offset, "t": timestamp, "r": refs}) + "\n")
+            self._indexFile.flush()
+            self._addToIndex(self._segment, offset, timestamp, refs)
+
+    def lookup(self, ref: str) -> list:
+        """Every entry mentioning the transactionreference, oldest first."""
+        return [self._read(segment, offset) for segment, offset in self._byRef.get(ref, [])]
+
+    def between(self, start: float, end: float) -> list:
+        """Every entry appended between the two epoch times, oldest first."""
+        first = bisect.bisect_left(self._times, start)
+        last = bisect.bisect_right(self._times, end)
+        return [self._read(segment, offset) for segment, offset in self._positions[first:last]]
+
+    def entries(self):
+        for segment, offset in list(self._positions):
+            yield self._read(segment, offset)
+
+    def replayInto(self, store):
+        """Add the records of every journalled TRANSACTIONQUERY response to a TransactionStore."""
+        for entry in self.entries():
+            if "TRANSACTIONQUERY" in entry["request"].get("requesttypedescriptions", []):
+                for res in entry["response"].get("responses", []):
+                    if res.get("records"):
+                        store.add(res["records"])
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._indexFile.close()
+            for m in self._maps.values():
+                m.close()
+            self._maps = {}
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _segments(self) -> list:
+        paths = glob.glob(os.path.join(self.directory, "journal-*.jsonl"))
+        return sorted(int(os.path.basename(p)[8:-6]) for p in paths)
+
+    def _segmentPath(self, segment: int) -> str:
+        return os.path.join(self.directory, f"journal-{segment:06d}.jsonl")
+
+    def _rotate(self):
+        self._file.close()
+        self._segment += 1
+        self._file = open(self._segmentPath(self._segment), "ab")
+        log.debug(f"Journal rotated to segment {self._segment}")
+        self._dropSegmentsBefore(self._segment - self.maxSegments + 1)
+
+    def _dropSegmentsBefore(self, first: int):
+        """Delete the segments numbered below first and forget their entries. Called holding _lock."""
+        old = [segment for segment in self._segments() if segment < first]
+        if not old:
+            return
+        # Rewrite the index without them first, a crash part way through then only leaves orphaned segment files
+        indexPath = os.path.join(self.directory, "journal.idx")
+        self._indexFile.close()
+        with open(indexPath) as f, open(indexPath + ".tmp", "w") as out:
+            for line in f:
+                try:
+                    if json.loads(line)["s"] >= first:
+                        out.write(line)
+                except ValueError:
+                    continue
+        os.replace(indexPath + ".tmp", indexPath)
+        self._indexFile = open(indexPath, "a")
+        for segment in old:
+            m = self._maps.pop(segment, None)
+            if m is not None:
+                m.close()
+            os.remove(self._segmentPath(segment))
+        kept = [i for i, (segment, offset) in enumerate(self._positions) if segment >= first]
+        self._times = [self._times[i] for i in kept]
+        self._positions = [self._positions[i] for i in kept]
+        for ref in list(self._byRef):
+            positions = [p for p in self._byRef[ref] if p[0] >= first]
+            if positions:
+                self._byRef[ref] = positions
+            else:
+                del self._byRef[ref]
+        log.info(f"Journal deleted {len(old)} old segment(s), {len(self._positions)} entries left")
+
+    def _loadIndex(self):
+        try:
+            with open(os.path.join(self.directory, "journal.idx")) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A torn write from a crash, the entry it described is unreadable anyway
+                    self._addToIndex(entry["s"], entry["o"], entry["t"], entry["r"])
+        except FileNotFoundError:
+            pass
+        log.debug(f"Journal index loaded with {len(self._positions)} entries")
+
+    def _addToIndex(self, segment, offset, timestamp, refs):
+        # Appends are nearly always in time order, insort keeps the lists sorted if the clock went backwards
+        position = bisect.bisect_right(self._times, timestamp)
+        self._times.insert(position, timestamp)
+        self._positions.insert(position, (segment, offset))
+        for ref in refs:
+            self._byRef.setdefault(ref, []).append((segment, offset))
+
+    def _read(self, segment: int, offset: int) -> dict:
+        with self._lock:
+            if segment == self._segment:
+                self._file.flush()
+            m = self._maps.get(segment)
+            if m is None or len(m) <= offset:
+                # (Re)map the segment, the current one grows as we append to it
+                if m is not None:
+                    m.close()
+                with open(self._segmentPath(segment), "rb") as f:
+                    m = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            end = m.find(b"\n", offset)
+            return json.loads(m[offset:end if end != -1 else len(m)])
@@ -0,0 +1,552 @@
+"""
+Middlewares wrapped around Webservices._send.
+
+Each middleware sees every request on its way to the gateway and every response (or exception) on the way back.
+The pipeline is ordered outermost first, so the first middleware in the list wraps all of the others.
+
+Options can be given once for every request type, or overridden per requesttypedescription, e.g.
+
+    RetryMiddleware(attempts=2, perType={"TRANSACTIONQUERY": {"attempts": 5}})
+
+Responses can be shared between callers (cached, or merged in flight) rather than copied, records and all, so whatever
+makes a request must treat its response as read-only.
+"""
+import json
+import os
+import random
+import threading
+import time
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+READ_ONLY_TYPES = {"TRANSACTIONQUERY"}
+# The securetrading SDK doesn't raise when it can't reach the gateway, it answers with one of these errorcodes: send or
+# receive failed, couldn't connect, invalid HTTP response, unexpected error
+TRANSPORT_ERRORCODES = ("4", "7", "8", "9")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def requestTypesOf(request: dict) -> tuple:
+    return tuple(request.get("requesttypedescriptions", ["CUSTOM"]))
+
+
+def canonicalKey(request: dict) -> str:
+    """A stable string for a request, independent of dict ordering."""
+    return json.dumps(request, sort_keys=True, default=str)
+
+
+class Middleware:
+    """
+    Base middleware. Subclasses override before/after/error for simple hooks, or process for full control over
+    the call (retrying, short-circuiting etc.). requestTypes limits the middleware to the given request types.
+    """
+    defaults = {}
+
+    def __init__(self, requestTypes=None, perType=None, **options):
+        self.requestTypes = set(requestTypes) if requestTypes else None
+        self.perType = perType or {}
+        self.options = options
+
+    def appliesTo(self, request: dict) -> bool:
+        return self.requestTypes is None or bool(self.requestTypes.intersection(requestTypesOf(request)))
+
+    def option(self, request: dict, name: str):
+        for requestType in requestTypesOf(request):
+            if name in self.perType.get(requestType, {}):
+                return self.perType[requestType][name]
+        return self.options.get(name, self.defaults.get(name))
+
+    def process(self, request: dict, context: dict, callNext):
+        if not self.appliesTo(request):
+            return callNext(request, context)
+        self.before(request, context)
+        try:
+            response = callNext(request, context)
+        except Exception as e:
+            return self.error(request, e, context)
+        return self.after(request, response, context)
+
+    def before(self, request: dict, context: dict):
+        pass
+
+    def after(self, request: dict, response: dict, context: dict) -> dict:
+        return response
+
+    def error(self, request: dict, exception: Exception, context: dict) -> dict:
+        raise exception
+
+    def reset(self):
+        """Called on logout, drop any state tied to the current session."""
+        pass
+
+
+class TimingMiddleware(Middleware):
+    """Records how long each request type takes to get a response."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def before(self, request, context):
+        context["timingStarted"] = time.perf_counter()
+
+    def after(self, request, response, context):
+        self._record(request, context, failed=False)
+        return response
+
+    def error(self, request, exception, context):
+        self._record(request, context, failed=True)
+        raise exception
+
+    def _record(self, request, context, failed):
+        elapsed = time.perf_counter() - context["timingStarted"]
+        key = "|".join(requestTypesOf(request))
+        with self._lock:
+            stats = self.stats.setdefault(key, {"count": 0, "failed": 0, "total": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["failed"] += int(failed)
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+        log.debug(f"{key} took {elapsed * 1000:.1f}ms{' (failed)' if failed else ''}")
+
+
+class PayloadSizeMiddleware(Middleware):
+    """
+    Keeps a running total of request and response sizes per request type, as counted by the transport on the wire
+    (context bytesSent and bytesReceived). Calls the transport couldn't measure, e.g. through the securetrading SDK, are
+    counted as unmeasured, and answers that never reached the transport (cached or merged) aren't counted at all.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def after(self, request, response, context):
+        if "bytesSent" not in context and not context.get("unmeasured"):
+            return response
+        key = "|".join(requestTypesOf(request))
+        sent = context.get("bytesSent", 0)
+        received = context.get("bytesReceived", 0)
+        with self._lock:
+            stats = self.stats.setdefault(key, {"count": 0, "unmeasured": 0, "sent": 0, "received": 0})
+            if "bytesSent" not in context:
+                stats["unmeasured"] += 1
+                return response
+            stats["count"] += 1
+            stats["sent"] += sent
+            stats["received"] += received
+        log.debug("%s sent %d bytes, received %d bytes", key, sent, received)
+        return response
+
+
+class DeadlineMiddleware(Middleware):
+    """
+    Gives each call an overall deadline. Nothing is sent once the deadline has passed, and inner middlewares
+    (retries) stop trying when they see it.
+    """
+    defaults = {"seconds": 60}
+
+    def process(self, request, context, callNext):
+        if not self.appliesTo(request):
+            return callNext(request, context)
+        seconds = self.option(request, "seconds")
+        context.setdefault("deadline", time.monotonic() + seconds)
+        if time.monotonic() > context["deadline"]:
+            raise DeadlineExceeded(f"Deadline of {seconds}s passed before the request was sent")
+        response = callNext(request, context)
+        if time.monotonic() > context["deadline"]:
+            log.warning(f"{'|'.join(requestTypesOf(request))} response arrived after its {seconds}s deadline")
+        return response
+
+
+class RetryMiddleware(Middleware):
+    """
+    Retries failed calls, exceptions or responses carrying one of retryErrorcodes (by default the SDK's for not
+    reaching the gateway), with full-jitter exponential backoff. Only read-only request types are retried by default,
+    as retrying a REFUND or AUTH could duplicate it.
+    """
+    defaults = {"attempts": 3, "baseDelay": 0.25, "maxDelay": 4.0, "retryErrorcodes": TRANSPORT_ERRORCODES}
+
+    def __init__(self, requestTypes=READ_ONLY_TYPES, *args, **kwargs):
+        super().__init__(requestTypes, *args, **kwargs)
+
+    def process(self, request, context, callNext):
+        if not self.appliesTo(request):
+            return callNext(request, context)
+        attempts = self.option(request, "attempts")
+        retryErrorcodes = set(self.option(request, "retryErrorcodes"))
+        for attempt in range(1, attempts + 1):
+            try:
+                response = callNext(request, context)
+                errorcodes = {r.get("errorcode") for r in response.get("responses", [])}
+                if attempt == attempts or not errorcodes.intersection(retryErrorcodes):
+                    return response
+                log.warning(f"Gateway returned {errorcodes} on attempt {attempt}/{attempts}, retrying")
+            except (DeadlineExceeded, CircuitOpen):
+                raise
+            except Exception as e:
+                if attempt == attempts:
+                    raise
+                log.warning(f"Request failed on attempt {attempt}/{attempts} [{e}], retrying")
+            delay = random.uniform(0, min(self.option(request, "maxDelay"),
+                                          self.option(request, "baseDelay") * 2 ** (attempt - 1)))
+            if "deadline" in context and time.monotonic() + delay > context["deadline"]:
+                raise DeadlineExceeded(f"Gave up retrying after {attempt} attempts, deadline would pass")
+            time.sleep(delay)
+
+
+class CacheMiddleware(Middleware):
+    """
+    Caches responses to read-only requests for a short time. Any other request may change what a query would
+    return, so it empties the cache. A hit returns the cached response itself, not a copy.
+    """
+    defaults = {"ttl": 30, "maxEntries": 32}
+
+    def __init__(self, cacheable=READ_ONLY_TYPES, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cacheable = set(cacheable)
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def process(self, request, context, callNext):
+        if not self.appliesTo(request):
+            return callNext(request, context)
+        if not self.cacheable.issuperset(requestTypesOf(request)):
+            self.reset()
+            return callNext(request, context)
+        key = canonicalKey(request)
+        with self._lock:
+            entry = self._entries.get(key)
+            hit = entry is not None and entry[0] > time.monotonic()
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit:
+            log.debug(f"Cache hit ({self.hits} hits, {self.misses} misses)")
+            # The records are handed over as the transport would have
+            onRecords = context.get("onRecords")
+            if onRecords is not None:
+                for res in entry[1].get("responses", []):
+                    if res.get("records"):
+                        onRecords(res["records"])
+            return entry[1]
+        response = callNext(request, context)
+        # Responses streamed without their records aren't worth keeping
+        if context.get("keepRecords", True) and all(r.get("errorcode") == "0" for r in response.get("responses", [])):
+            with self._lock:
+                if len(self._entries) >= self.option(request, "maxEntries"):
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k][0])]
+                self._entries[key] = (time.monotonic() + self.option(request, "ttl"), response)
+        return response
+
+    def reset(self):
+        with self._lock:
+            self._entries = {}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.exception = None
+
+
+class SingleFlightMiddleware(Middleware):
+    """
+    Merges identical read-only requests that are in flight at the same time: the first caller makes the gateway call
+    and every caller that asks for the same thing before it returns waits for, and gets, the same response (or
+    exception). Anything that isn't read-only is never merged.
+
+    Requests whose records are streamed without being kept in the response aren't merged either, as there would be
+    nothing to give the other callers.
+    """
+
+    def __init__(self, mergeable=READ_ONLY_TYPES, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mergeable = set(mergeable)
+        self.calls = 0
+        self.saved = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def process(self, request, context, callNext):
+        if (not self.appliesTo(request) or not self.mergeable.issuperset(requestTypesOf(request))
+                or not context.get("keepRecords", True)):
+            return callNext(request, context)
+        key = canonicalKey(request)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+                self.calls += 1
+            else:
+                leader = False
+                self.saved += 1
+        if leader:
+            response = None
+            try:
+                response = callNext(request, context)
+                return response
+            except Exception as e:
+                flight.exception = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.response = response
+                flight.done.set()
+        log.debug(f"Joined an identical request in flight ({self.saved} calls saved, {self.calls} made)")
+        self._wait(flight, context)
+        if flight.exception is not None:
+            raise flight.exception
+        response = flight.response
+        onRecords = context.get("onRecords")
+        if onRecords is not None:
+            for res in response.get("responses", []):
+                if res.get("records"):
+                    onRecords(res["records"])
+        return response
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    @staticmethod
+    def _wait(flight, context):
+        if "deadline" not in context:
+            flight.done.wait()
+        elif not flight.done.wait(max(context["deadline"] - time.monotonic(), 0)):
+            raise DeadlineExceeded("Deadline passed waiting for an identical request in flight")
+
+
+class JournalMiddleware(Middleware):
+    """Appends every request and its response to a Journal."""
+
+    def __init__(self, journal, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.journal = journal
+
+    def after(self, request, response, context):
+        self.journal.append(request, response)
+        return response
+
+
+class RateLimitMiddleware(Middleware):
+    """
+    Token bucket limiting how many requests per second are sent, per request type. rate is requests per second
+    (None for no limit) and burst how many can go at once after a quiet spell. A request waits for its turn, until
+    its deadline at the latest.
+    """
+    defaults = {"rate": None, "burst": 1}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buckets = {}  # request type -> [tokens, last refill]
+        self._lock = threading.Lock()
+
+    def before(self, request, context):
+        rate = self.option(request, "rate")
+        if not rate:
+            return
+        burst = self.option(request, "burst")
+        requestType = requestTypesOf(request)[0]
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._buckets.setdefault(requestType, [burst, now])
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                    return
+                wait = (1 - bucket[0]) / rate
+            if "deadline" in context and now + wait > context["deadline"]:
+                raise DeadlineExceeded(f"Deadline would pass waiting for the {requestType} rate limit")
+            time.sleep(wait)
+
+    def reset(self):
+        with self._lock:
+            self._buckets = {}
+
+
+def gatewayErrorcodes(response: dict) -> set:
+    return {r.get("errorcode") for r in response.get("responses", [])}
+
+
+class AdaptiveConcurrencyMiddleware(Middleware):
+    """
+    Limits the number of requests in flight, adjusting the limit with AIMD: it creeps up by one per limit's worth of
+    healthy responses, and is cut by backoffRatio when a response takes more than latencyTolerance times the best
+    recent latency of its request type, fails, or carries one of overloadErrorcodes. Callers over the limit wait for a
+    free slot (until their deadline, if they have one).
+    """
+    defaults = {"initialLimit": 4, "minLimit": 1, "maxLimit": 32, "latencyTolerance": 1.5, "backoffRatio": 0.7,
+                # Bank/acquirer unavailable and unknown errors, which mean the gateway side is struggling, and the
+                # SDK's own for not reaching it at all
+                "overloadErrorcodes": ("60010", "60022", "99999") + TRANSPORT_ERRORCODES}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limit = float(self.options.get("initialLimit", self.defaults["initialLimit"]))
+        self.inflight = 0
+        self.baselines = {}  # Best recent latency per request type, a 5ms query says nothing about a REFUND
+        self._condition = threading.Condition()
+
+    def process(self, request, context, callNext):
+        if not self.appliesTo(request):
+            return callNext(request, context)
+        self._acquire(context)
+        started = time.monotonic()
+        try:
+            response = callNext(request, context)
+        except Exception:
+            self._release(request, None, healthy=False)
+            raise
+        latency = time.monotonic() - started
+        overloaded = bool(gatewayErrorcodes(response).intersection(self.option(request, "overloadErrorcodes")))
+        self._release(request, latency, healthy=not overloaded)
+        return response
+
+    def _acquire(self, context):
+        with self._condition:
+            while self.inflight >= int(self.limit):
+                timeout = context["deadline"] - time.monotonic() if "deadline" in context else None
+                if timeout is not None and timeout <= 0:
+                    raise DeadlineExceeded(f"Deadline passed waiting for one of {int(self.limit)} request slots")
+                self._condition.wait(timeout)
+            self.inflight += 1
+
+    def _release(self, request, latency, healthy):
+        with self._condition:
+            self.inflight -= 1
+            if latency is not None:
+                # The baseline follows the best latency seen, drifting up slowly so it can recover from a fast outlier
+                key = "|".join(requestTypesOf(request))
+                baseline = self.baselines.get(key)
+                baseline = self.baselines[key] = latency if baseline is None else min(latency, baseline * 1.01)
+                if latency > baseline * self.option(request, "latencyTolerance"):
+                    healthy = False
+            old = int(self.limit)
+            if healthy:
+                self.limit = min(self.option(request, "maxLimit"), self.limit + 1 / self.limit)
+            else:
+                self.limit = max(self.option(request, "minLimit"), self.limit * self.option(request, "backoffRatio"))
+            if int(self.limit) != old:
+                log.debug(f"Gateway concurrency limit {old} -> {int(self.limit)}")
+            self._condition.notify_all()
+
+    def reset(self):
+        with self._condition:
+            self.baselines = {}
+
+
+class CircuitBreakerMiddleware(Middleware):
+    """
+    Fails fast while the gateway looks down. After failureThreshold consecutive failures (exceptions or
+    overloadErrorcodes) the circuit opens and every request raises CircuitOpen for openSeconds. Then one trial request
+    is let through (half-open): success closes the circuit, failure opens it again for twice as long, up to
+    maxOpenSeconds. Functions in listeners are called with the new state on every change, from whichever thread
+    caused it.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+    defaults = {"failureThreshold": 5, "openSeconds": 5.0, "maxOpenSeconds": 120.0,
+                "overloadErrorcodes": AdaptiveConcurrencyMiddleware.defaults["overloadErrorcodes"]}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.listeners = []
+        self.state = self.CLOSED
+        self._failures = 0
+        self._openFor = self.options.get("openSeconds", self.defaults["openSeconds"])
+        self._openUntil = 0.0
+        self._trialRunning = False
+        self._lock = threading.Lock()
+
+    def process(self, request, context, callNext):
+        if not self.appliesTo(request):
+            return callNext(request, context)
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() >= self._openUntil:
+                self._setState(self.HALF_OPEN)
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._trialRunning):
+                wait = max(self._openUntil - time.monotonic(), 0)
+                raise CircuitOpen(f"Gateway circuit is open, retrying in {wait:.0f}s")
+            trial = self.state == self.HALF_OPEN
+            self._trialRunning = trial
+        try:
+            response = callNext(request, context)
+        except Exception:
+            self._record(request, failed=True, trial=trial)
+            raise
+        failed = bool(gatewayErrorcodes(response).intersection(self.option(request, "overloadErrorcodes")))
+        self._record(request, failed=failed, trial=trial)
+        return response
+
+    def _record(self, request, failed, trial):
+        with self._lock:
+            if trial:
+                self._trialRunning = False
+            if not failed:
+                self._failures = 0
+                if self.state != self.CLOSED:
+                    self._openFor = self.option(request, "openSeconds")
+                    self._setState(self.CLOSED)
+                return
+            self._failures += 1
+            if trial:
+                self._openFor = min(self._openFor * 2, self.option(request, "maxOpenSeconds"))
+            if trial or (self.state == self.CLOSED and self._failures >= self.option(request, "failureThreshold")):
+                self._openUntil = time.monotonic() + self._openFor
+                self._setState(self.OPEN)
+
+    def _setState(self, state):
+        log.warning(f"Gateway circuit {self.state} -> {state}")
+        self.state = state
+        for listener in self.listeners:
+            listener(state)
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._trialRunning = False
+            self._openFor = self.options.get("openSeconds", self.defaults["openSeconds"])
+            if self.state != self.CLOSED:
+                self._setState(self.CLOSED)
+
+
+def defaultMiddlewares() -> list:
+    middlewares = [
+        TimingMiddleware(),
+        PayloadSizeMiddleware(),
+        CacheMiddleware(),
+        SingleFlightMiddleware(),
+    ]
+    if os.environ.get("WS_JOURNAL", "0") == "1":
+        from model.journal import Journal
+        middlewares.append(JournalMiddleware(Journal()))
+    middlewares += [
+        DeadlineMiddleware(),
+        RetryMiddleware(),
+        CircuitBreakerMiddleware(),
+        RateLimitMiddleware(perType={
+            "TRANSACTIONUPDATE": {"rate": float(os.environ.get("WS_UPDATE_RATE", 10)), "burst": 5},
+            "AUTH": {"rate": float(os.environ.get("WS_AUTH_RATE", 20)), "burst": 10},
+        }),
+        AdaptiveConcurrencyMiddleware(),
+    ]
+    return middlewares
@@ -0,0 +1,96 @@
+"""
+Background loading of recent transactions after login.
+
+Login only checks the credentials, the records are fetched afterwards on a worker thread, newest first, in
+WS_PREFETCH_CHUNK_HOURS chunks covering today and the WS_PREFETCH_DAYS days before it. Each chunk is handed over as
+soon as it arrives, so the table fills progressively from the most recent transactions while the app is usable.
+"""
+import datetime
+import os
+import threading
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+PREFETCH_TYPES = ["AUTH", "REFUND", "THREEDQUERY"]
+
+
+def chunksBackFrom(now: datetime.datetime, days: int, hours: int) -> list:
+    """(start, end) datetimes from the chunk holding now back to the start of the day days before, newest first."""
+    floor = datetime.datetime.combine(now.date() - datetime.timedelta(days=days), datetime.time())
+    # Chunks are aligned to the start of the day so the same hours are asked for every time
+    midnight = datetime.datetime.combine(now.date(), datetime.time())
+    start = midnight + datetime.timedelta(hours=(now - midnight) // datetime.timedelta(hours=hours) * hours)
+    chunks = []
+    end = now
+    while end > floor:
+        chunks.append((start, end))
+        end = start - datetime.timedelta(seconds=1)
+        start = max(start - datetime.timedelta(hours=hours), floor)
+    return chunks
+
+
+class Prefetcher:
+    def __init__(self, api, onRecords, onDone, days=None, chunkHours=None):
+        """
+        onRecords(prefetcher, records) is called with each chunk's records and onDone(prefetcher, error) once at the
+        end, error being None unless a chunk failed. Both are called from the worker thread.
+        """
+        self.api = api
+        self.onRecords = onRecords
+        self.onDone = onDone
+        self.days = int(os.environ.get("WS_PREFETCH_DAYS", 0)) if days is None else days
+        self.chunkHours = chunkHours or int(os.environ.get("WS_PREFETCH_CHUNK_HOURS", 6))
+        self.loaded = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="Prefetcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the chunk in flight, whose records are then dropped."""
+        self._stopped.set()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stopped.is_set()
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _run(self):
+        chunks = chunksBackFrom(datetime.datetime.now().replace(microsecond=0), self.days, self.chunkHours)
+        log.debug(f"Prefetching {len(chunks)} chunks of up to {self.chunkHours}h")
+        error = None
+        for start, end in chunks:
+            if self._stopped.is_set():
+                break
+            try:
+                records = self._fetch(start, end)
+            except Exception as e:
+                error = str(e)
+                log.error(f"Prefetch of {start} to {end} failed [{error}]")
+                break
+            if self._stopped.is_set():
+                break
+            self.loaded += len(records)
+            if records:
+                self.onRecords(self, records)
+        log.debug(f"Prefetch finished after {self.loaded} records")
+        if not self._stopped.is_set():
+            self.onDone(self, error)
+
+    def _fetch(self, start, end) -> list:
+        response = self.api.makeRequest({
+            "requesttypedescriptions": ["TRANSACTIONQUERY"],
+            "filter": {
+                "starttimestamp": [{"value": start.strftime("%Y-%m-%d %H:%M:%S")}],
+                "endtimestamp": [{"value": end.strftime("%Y-%m-%d %H:%M:%S")}],
+                "requesttypedescription": [{"value": t} for t in PREFETCH_TYPES]
+            }
+        })["responses"][0]
+        if response.get("errorcode") != "0":
+            raise Exception(f"[{response.get('errorcode')}] {response.get('errormessage')}")
+        return response.get("records", [])
@@ -0,0 +1,162 @@
+"""
+Reconciliation of the local TransactionStore against the gateway.
+
+Records are fingerprinted per day (count plus a hash of reference, settlestatus and settlebaseamount). A day whose
+local fingerprint matches the one it had when last verified, and whose transactions are all in a final settle state
+and older than WS_RECONCILE_CLOSED_DAYS, can't have changed on the gateway and isn't queried again. Every other day is
+queried on its own and compared record by record, and matching days are remembered in WS_RECONCILE_STATE.
+
+Local records are fingerprinted from their parsed fields, so records the TransactionStore has spilled to disk are only
+read back for the changes found on days that differ.
+"""
+import datetime
+import hashlib
+import json
+import os
+from dotenv import load_dotenv
+from lib.logger import createLogger
+from model.transaction import SettleStatus, Transaction, parseAmount, parseStatus
+
+load_dotenv()
+log = createLogger(__name__)
+
+FINAL_SETTLE_STATUSES = {SettleStatus.SETTLED, SettleStatus.CANCELLED}
+COMPARED_FIELDS = ["settlestatus", "settlebaseamount"]
+# Fields a reqFilter can be matched on without the raw record
+PARSED_FILTER_FIELDS = ["transactionreference", "requesttypedescription", "sitereference", "currencyiso3a"]
+
+
+def compared(record) -> tuple:
+    """transactionreference and the COMPARED_FIELDS of a Transaction or a gateway record, as strings."""
+    if isinstance(record, Transaction):
+        status, amount = record.settlestatus, record.settlebaseamount
+        ref = record.transactionreference
+    else:
+        status, amount = parseStatus(record.get("settlestatus")), parseAmount(record.get("settlebaseamount"))
+        ref = record["transactionreference"]
+    return ref, "" if status is None else str(int(status)), "" if amount is None else str(amount)
+
+
+def fingerprint(transactions: list) -> str:
+    digest = hashlib.sha1()
+    for fields in sorted(compared(t) for t in transactions):
+        digest.update("|".join(fields).encode())
+        digest.update(b"\n")
+    return f"{len(transactions)}:{digest.hexdigest()}"
+
+
+class Reconciler:
+    def __init__(self, api, model):
+        self.api = api
+        self.model = model
+        self.stateFile = os.environ.get("WS_RECONCILE_STATE", "reconciled.json")
+        self.closedAfter = datetime.timedelta(days=int(os.environ.get("WS_RECONCILE_CLOSED_DAYS", 7)))
+        self._verified = self._loadState()
+
+    def reconcile(self, start: datetime.date, end: datetime.date, reqFilter=None, apply=False) -> dict:
+        """
+        Compare every day from start to end (inclusive). reqFilter is an optional extra TRANSACTIONQUERY filter, the
+        same filter is applied to the local records. The report's records are the gateway's version of every missing or
+        changed record, with apply they are added to the store. Returns a report dict, see formatReport.
+        """
+        log.debug(f"reconcile({start}, {end}) called")
+        reqFilter = reqFilter or {}
+        report = {"days": {}, "missing": [], "extra": [], "changed": [], "records": [], "queries": 0}
+        local = self._localByDay(reqFilter)
+        day = start
+        while day <= end:
+            key = self._stateKey(day, reqFilter)
+            localRecords = local.get(str(day), [])
+            localPrint = fingerprint(localRecords)
+            if self._verified.get(key) == localPrint and self._isClosed(day, localRecords):
+                report["days"][str(day)] = "skipped"
+            else:
+                gatewayRecords = self._query(day, reqFilter)
+                report["queries"] += 1
+                if fingerprint(gatewayRecords) == localPrint:
+                    report["days"][str(day)] = "verified"
+                    self._verified[key] = localPrint
+                else:
+                    report["days"][str(day)] = "differs"
+                    self._verified.pop(key, None)
+                    self._diff(localRecords, gatewayRecords, report)
+            day += datetime.timedelta(days=1)
+        if apply and report["records"]:
+            self.model.add(report["records"])
+        self._saveState()
+        log.debug(f"reconcile returning after {report['queries']} queries")
+        return report
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _localByDay(self, reqFilter) -> dict:
+        wanted = {f: {v["value"] for v in values} for f, values in reqFilter.items()}
+        byDay = {}
+        for t in self.model.getAll():
+            if all(self._field(t, f) in values for f, values in wanted.items()):
+                byDay.setdefault(str(t.timestamp.date()) if t.timestamp else "", []).append(t)
+        return byDay
+
+    @staticmethod
+    def _field(t, field) -> str:
+        if field in PARSED_FILTER_FIELDS:
+            return getattr(t, field)
+        if field == "settlestatus":
+            return "" if t.settlestatus is None else str(int(t.settlestatus))
+        return t.get(field, "")
+
+    def _query(self, day, reqFilter) -> list:
+        response = self.api.makeRequest({
+            "requesttypedescriptions": ["TRANSACTIONQUERY"],
+            "filter": {
+                **reqFilter,
+                "starttimestamp": [{"value": f"{day} 00:00:00"}],
+                "endtimestamp": [{"value": f"{day} 23:59:59"}],
+            }
+        })["responses"][0]
+        if response["errorcode"] != "0":
+            raise Exception(f"[{response['errorcode']}] {response['errormessage']} {response['errordata']}")
+        return response.get("records", []) if int(response["found"]) > 0 else []
+
+    def _diff(self, localRecords, gatewayRecords, report):
+        local = {t.transactionreference: t for t in localRecords}
+        gateway = {t["transactionreference"]: t for t in gatewayRecords}
+        report["missing"] += [ref for ref in gateway if ref not in local]
+        report["extra"] += [ref for ref in local if ref not in gateway]
+        changed = []
+        for ref in gateway.keys() & local.keys():
+            if compared(local[ref]) == compared(gateway[ref]):
+                continue  # Without reading a spilled record back
+            for field in COMPARED_FIELDS:
+                if local[ref].get(field, "") != gateway[ref].get(field, ""):
+                    report["changed"].append((ref, field, local[ref].get(field, ""), gateway[ref].get(field, "")))
+            changed.append(gateway[ref])
+        report["records"] += changed + [t for ref, t in gateway.items() if ref not in local]
+
+    def _isClosed(self, day, records) -> bool:
+        if datetime.date.today() - day < self.closedAfter:
+            return False
+        return all(t.settlestatus in FINAL_SETTLE_STATUSES for t in records)
+
+    def _stateKey(self, day, reqFilter) -> str:
+        return f"{day}|{json.dumps(reqFilter, sort_keys=True)}"
+
+    def _loadState(self) -> dict:
+        try:
+            with open(self.stateFile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _saveState(self):
+        with open(self.stateFile, "w") as f:
+            json.dump(self._verified, f)
+
+
+def formatReport(report: dict) -> str:
+    lines = [f"{report['queries']} gateway queries"]
+    for day, state in report["days"].items():
+        lines.append(f"{day}: {state}")
+    lines += [f"Missing locally: {ref}" for ref in report["missing"]]
+    lines += [f"Not on gateway: {ref}" for ref in report["extra"]]
+    lines += [f"Changed {field} on {ref}: {local!r} -> {gateway!r}" for ref, field, local, gateway in report["changed"]]
+    return "\n".join(lines)
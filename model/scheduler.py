@@ -0,0 +1,196 @@
+"""
+Recurring charges against card details stored on the gateway by an ACCOUNTCHECK (or an earlier AUTH) made with
+credentialsonfile=1.
+
+Subscriptions and the history of every charge are kept in SQLite. Due subscriptions are taken off a heap ordered by
+next due date, and each due charge is a RECUR AUTH sent through the JobQueue under the key RECUR:<id>:<due date>, so a
+billing run that is interrupted or run twice never charges the same period twice. A failed charge leaves the
+subscription due, to be tried again by the next run.
+
+Due dates are always worked out from the first one (the anchor), so a subscription starting on the 31st is charged on
+the last day of shorter months and on the 31st again after them.
+"""
+import calendar
+import datetime
+import heapq
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+from lib.logger import createLogger
+from model.jobqueue import DONE
+
+load_dotenv()
+log = createLogger(__name__)
+
+UNITS = ["DAY", "MONTH"]
+
+
+def advance(due: datetime.date, unit: str, count: int) -> datetime.date:
+    """
+    The due date count units after (or before, if negative) due, month ends clamped (31 Jan + 1 month is 28/29 Feb).
+    Clamped dates don't step on to the right day, so always advance from the anchor rather than the last due date.
+    """
+    if unit == "DAY":
+        return due + datetime.timedelta(days=count)
+    month = due.month - 1 + count
+    year = due.year + month // 12
+    month = month % 12 + 1
+    return datetime.date(year, month, min(due.day, calendar.monthrange(year, month)[1]))
+
+
+class Scheduler:
+    def __init__(self, jobs, path=None, batchSize=None):
+        self.jobs = jobs
+        self.path = path or os.environ.get("WS_SCHEDULE_PATH", "schedule.sqlite3")
+        self.batchSize = batchSize or int(os.environ.get("WS_RECUR_BATCH", 500))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("""CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY,
+            parenttransactionreference TEXT NOT NULL,
+            sitereference TEXT NOT NULL,
+            baseamount TEXT NOT NULL,
+            currencyiso3a TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            nextdue TEXT NOT NULL,
+            payments INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1,
+            anchor TEXT)""")
+        columns = [row["name"] for row in self._db.execute("PRAGMA table_info(subscriptions)")]
+        if "anchor" not in columns:
+            self._db.execute("ALTER TABLE subscriptions ADD COLUMN anchor TEXT")
+        # Subscriptions from before anchors were kept, anchored as near as can be told from their next due date
+        for row in self._db.execute("SELECT * FROM subscriptions WHERE anchor IS NULL").fetchall():
+            anchor = advance(datetime.date.fromisoformat(row["nextdue"]), row["unit"], -row["count"] * row["payments"])
+            self._db.execute("UPDATE subscriptions SET anchor = ? WHERE id = ?", (anchor.isoformat(), row["id"]))
+        self._db.execute("""CREATE TABLE IF NOT EXISTS runs (
+            key TEXT PRIMARY KEY,
+            subscription INTEGER NOT NULL,
+            due TEXT NOT NULL,
+            state TEXT NOT NULL,
+            transactionreference TEXT,
+            errorcode TEXT,
+            errormessage TEXT,
+            updated REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_subscription ON runs (subscription)")
+        self._db.commit()
+        self._heap = [(row["nextdue"], row["id"]) for row in self._db.execute(
+            "SELECT id, nextdue FROM subscriptions WHERE active = 1")]
+        heapq.heapify(self._heap)
+
+    def add(self, parent: str, site: str, amount: str, currency: str, unit: str, count: int,
+            firstDue: datetime.date) -> int:
+        """Schedule a recurring charge on the stored credentials of transaction parent. Returns its id."""
+        if unit not in UNITS or count < 1:
+            raise Exception(f"A subscription is charged every whole number of {' or '.join(UNITS)}s")
+        if not amount.isdigit():
+            raise Exception(f"baseamount must be a whole number of minor units, not {amount!r}")
+        with self._lock:
+            id = self._db.execute(
+                """INSERT INTO subscriptions (parenttransactionreference, sitereference, baseamount, currencyiso3a,
+                   unit, count, nextdue, anchor) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (parent, site, amount, currency, unit, count, firstDue.isoformat(), firstDue.isoformat())).lastrowid
+            self._db.commit()
+            heapq.heappush(self._heap, (firstDue.isoformat(), id))
+        log.debug(f"Scheduled {amount} {currency} every {count} {unit} on {parent} from {firstDue}")
+        return id
+
+    def cancel(self, id: int):
+        """Stop charging a subscription. Its entry in the due heap is dropped when it comes up."""
+        with self._lock:
+            self._db.execute("UPDATE subscriptions SET active = 0 WHERE id = ?", (id,))
+            self._db.commit()
+
+    def subscriptions(self) -> list:
+        with self._lock:
+            return [dict(row) for row in self._db.execute(
+                "SELECT * FROM subscriptions WHERE active = 1 ORDER BY nextdue, id")]
+
+    def history(self, id=None, limit=200) -> list:
+        """The latest charges, newest first, of one subscription or of all of them."""
+        query = "SELECT * FROM runs" + (" WHERE subscription = ?" if id is not None else "")
+        query += " ORDER BY updated DESC LIMIT ?"
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query, ((id,) if id is not None else ()) + (limit,))]
+
+    def run(self, today=None, onBatch=None) -> list:
+        """
+        Charge every subscription due on or before today, catching up one period at a time on those more than one
+        period behind. onBatch(done, total) is called after each batch. Returns the job keys of this run.
+        """
+        today = (today or datetime.date.today()).isoformat()
+        keys = []
+        failed = []
+        while True:
+            due = self._takeDue(today)
+            if not due:
+                break
+            total = len(keys) + len(due)
+            for start in range(0, len(due), self.batchSize):
+                batch = due[start:start + self.batchSize]
+                keys += self._charge(batch, failed)
+                if onBatch is not None:
+                    onBatch(len(keys), total)
+        # Failed charges stay due, for the next run rather than this one
+        with self._lock:
+            for s in failed:
+                heapq.heappush(self._heap, (s["nextdue"], s["id"]))
+        log.debug(f"Billing run finished, {len(keys)} charges, {len(failed)} not charged")
+        return keys
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _takeDue(self, today: str) -> list:
+        """Pop every active subscription due on or before today off the heap."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= today:
+                nextDue, id = heapq.heappop(self._heap)
+                row = self._db.execute("SELECT * FROM subscriptions WHERE id = ? AND active = 1 AND nextdue = ?",
+                                       (id, nextDue)).fetchone()
+                if row is not None:  # Otherwise cancelled, or an entry left from before it was last charged
+                    due.append(dict(row))
+        return due
+
+    def _charge(self, subscriptions: list, failed: list) -> list:
+        items = []
+        for s in subscriptions:
+            items.append((f"RECUR:{s['id']}:{s['nextdue']}", {
+                "requesttypedescriptions": ["AUTH"],
+                "accounttypedescription": "RECUR",
+                "parenttransactionreference": s["parenttransactionreference"],
+                "sitereference": s["sitereference"],
+                "baseamount": s["baseamount"],
+                "currencyiso3a": s["currencyiso3a"],
+                "credentialsonfile": "2",
+                "subscriptiontype": "RECURRING",
+                "subscriptionnumber": str(s["payments"] + 2),  # The first payment was the parent
+                "orderreference": f"RECUR-{s['id']}-{s['nextdue']}",
+            }))
+        keys = self.jobs.enqueue(items)
+        self.jobs.run(keys)
+        results = self.jobs.results(keys)
+        with self._lock:
+            for s, key in zip(subscriptions, keys):
+                state, response = results[key]
+                response = response or {}
+                self._db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+                    key, s["id"], s["nextdue"], state, response.get("transactionreference"),
+                    response.get("errorcode"), response.get("errormessage"), time.time()))
+                if state == DONE:
+                    nextDue = advance(datetime.date.fromisoformat(s["anchor"]), s["unit"],
+                                      s["count"] * (s["payments"] + 1)).isoformat()
+                    self._db.execute("UPDATE subscriptions SET nextdue = ?, payments = payments + 1 WHERE id = ?",
+                                     (nextDue, s["id"]))
+                    heapq.heappush(self._heap, (nextDue, s["id"]))
+                else:
+                    failed.append(s)
+            self._db.commit()
+        return keys
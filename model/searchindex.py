@@ -0,0 +1,159 @@
+"""
+Inverted index for searching the loaded transactions as the user types.
+
+Every searchable field value is lowercased and split into alphanumeric tokens, and the whole value is kept as a token
+too so "1-2-3" finds "1-2-345". Each query term must match the start of some token of a transaction.
+
+Each transaction gets an integer id. Every added batch is tokenised into a segment, its tokens sorted with the ids
+for each, and on the next search the segments are merged into one id array ordered by token, so every token starting
+with a term is a single contiguous slice of it. A search is then a couple of bisects and a vectorised mask per term,
+however common the term is.
+
+Tokenising is the bulk of the work of adding a batch. Large batches are split into chunks tokenised by an Ingestor's
+worker processes, while the caller carries on. A search never waits for them: it merges the segments that have
+arrived, and transactions of the rest don't match anything until theirs does (see pending). The listeners are called
+as each one arrives, so searches can be run again.
+"""
+import bisect
+import itertools
+import re
+import numpy as np
+from lib.logger import createLogger
+
+log = createLogger(__name__)
+
+SEARCH_FIELDS = ["billingfirstname", "billinglastname", "billingemail", "billingpostcode", "orderreference",
+                 "maskedpan", "transactionreference"]
+SPLIT = re.compile(r"[^0-9a-z]+")
+
+
+def tokenise(value: str) -> set:
+    value = value.lower().strip()
+    tokens = {t for t in SPLIT.split(value) if t}
+    if value:
+        tokens.add(value)
+        tokens.add(value.replace(" ", ""))
+    return tokens
+
+
+def tokeniseChunk(values: list) -> tuple:
+    """
+    Segment for a chunk of records, each given as a tuple of its SEARCH_FIELDS values: the sorted tokens, the number
+    of records with each token and the records' positions in the chunk, grouped by token.
+    """
+    postings = {}
+    for position, fields in enumerate(values):
+        tokens = set()
+        for value in fields:
+            tokens |= tokenise(value)
+        for token in tokens:
+            positions = postings.get(token)
+            if positions is None:
+                positions = postings[token] = []
+            positions.append(position)
+    tokens = sorted(postings)
+    counts = np.fromiter((len(postings[t]) for t in tokens), dtype=np.int64, count=len(tokens))
+    positions = np.fromiter(itertools.chain.from_iterable(postings[t] for t in tokens), dtype=np.int32,
+                            count=int(counts.sum()))
+    return tokens, counts, positions
+
+
+class SearchIndex:
+    def __init__(self, ingestor=None):
+        """ingestor, if given, tokenises large batches in its worker processes."""
+        self.ingestor = ingestor
+        self.listeners = []  # Called with no arguments as each worker segment arrives, from the ingestor's thread
+        self.generation = 0  # Changes whenever ids do, so ids from idsOf can be kept until then
+        self.cleared()
+
+    # Store listener interface
+    def added(self, transactions: list):
+        base = len(self._alive)
+        for t in transactions:
+            ref = t.transactionreference
+            old = self._ids.get(ref)
+            if old is not None:
+                # Replaced records get a new id rather than having their old postings removed
+                self._alive[old] = False
+            self._ids[ref] = len(self._alive)
+            self._alive.append(True)
+        values = [tuple(t.get(field) or "" for field in SEARCH_FIELDS) for t in transactions]
+        if self.ingestor is not None and self.ingestor.wants(len(values)):
+            chunks = self.ingestor.map(tokeniseChunk, values)
+            for i, (start, future) in enumerate(chunks):
+                end = chunks[i + 1][0] if i + 1 < len(chunks) else len(values)
+                self._pending.append((base + start, future, end - start))
+                future.add_done_callback(self._arrived)
+        else:
+            self._segments.append((base, tokeniseChunk(values)))
+        self._compacted = None
+        self.generation += 1
+        log.debug(f"Indexed {len(transactions)} transactions")
+
+    def cleared(self):
+        self._segments = []  # (first id, segment) for each batch added since the last compaction
+        self._pending = []  # (first id, future of a segment, transactions in it) being tokenised by the ingestor
+        self._ids = {}
+        self._alive = []
+        self._compacted = None
+        self.generation += 1
+
+    def search(self, query: str):
+        """
+        A boolean mask over transaction ids (see idsOf) of the transactions matching every term of the query, or None
+        when the query is empty and everything matches.
+        """
+        terms = query.lower().split()
+        if not terms:
+            return None
+        tokens, offsets, postings, alive = self._compact()
+        mask = alive.copy()
+        for term in terms:
+            start = bisect.bisect_left(tokens, term)
+            end = bisect.bisect_left(tokens, term + "\uffff", start)
+            matches = np.zeros(len(mask), dtype=bool)
+            matches[postings[offsets[start]:offsets[end]]] = True
+            mask &= matches
+        return mask
+
+    @property
+    def pending(self) -> int:
+        """How many transactions are still being tokenised, and can't be found yet."""
+        return sum(count for base, future, count in self._pending if not future.done())
+
+    def idsOf(self, refs) -> np.ndarray:
+        """The current ids of the given transactionreferences, for indexing search masks."""
+        ids = self._ids
+        return np.fromiter((ids.get(ref, -1) for ref in refs), dtype=np.int64)
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _arrived(self, future):
+        for listener in self.listeners:
+            listener()
+
+    def _compact(self) -> tuple:
+        # Only the worker segments that have arrived, a search doesn't wait for the rest
+        arrived, waiting = [], []
+        for p in self._pending:
+            (arrived if p[1].done() else waiting).append(p)
+        if self._compacted is None or arrived:
+            self._pending = waiting
+            segments = self._segments + [(base, future.result()) for base, future, count in arrived]
+            tokens = sorted(set().union(*(segment[0] for base, segment in segments)))
+            number = {token: i for i, token in enumerate(tokens)}
+            # Every (token, id) pair of every segment, then sorted by token with ids kept in order within each
+            tokenNumbers = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+                np.repeat(np.fromiter((number[t] for t in segment[0]), dtype=np.int64, count=len(segment[0])),
+                          segment[1]) for base, segment in segments])
+            ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+                segment[2].astype(np.int64) + base for base, segment in segments])
+            order = np.argsort(tokenNumbers, kind="stable")
+            postings = ids[order]
+            offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(tokenNumbers, minlength=len(tokens)), out=offsets[1:])
+            # Keep the result as the only segment, so the next compaction only has to merge new batches into it
+            counts = np.diff(offsets)
+            self._segments = [(0, (tokens, counts, postings))]
+            # The extra False at the end is where the -1 ids of unknown references land
+            self._compacted = (tokens, offsets, postings, np.array(self._alive + [False], dtype=bool))
+        return self._compacted
@@ -0,0 +1,76 @@
+"""
+Selections of table rows kept as row ranges rather than lists of transactions.
+
+Selecting everything in a 100k row table is a single range, so building, counting and passing a selection around costs
+nothing however many rows it covers. Transactions are only looked up as they are iterated.
+"""
+import bisect
+import numpy as np
+
+
+class Selection:
+    """
+    The transactions in rows[top:bottom + 1] for each (top, bottom) range. rows must not be changed in place, the
+    table makes a new list whenever its rows change, so a Selection keeps the transactions that were selected.
+
+    refundablePrefix, if given, is the running count of refundable transactions in rows (with a leading 0), so
+    refundable transactions can be counted and found per range without looking at each transaction. It has to be
+    worked out over the same rows, otherwise it is worked out here when first needed.
+    """
+
+    def __init__(self, rows: list, ranges, refundablePrefix: np.ndarray = None):
+        self.rows = rows
+        self.ranges = self._merge(ranges)
+        self._refundablePrefix = refundablePrefix
+        # Index of the first selected transaction of each range, and the total at the end
+        self._offsets = [0]
+        for top, bottom in self.ranges:
+            self._offsets.append(self._offsets[-1] + bottom - top + 1)
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def __iter__(self):
+        rows = self.rows
+        for top, bottom in self.ranges:
+            yield from rows[top:bottom + 1]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Selection index out of range")
+        i = bisect.bisect_right(self._offsets, index) - 1
+        return self.rows[self.ranges[i][0] + index - self._offsets[i]]
+
+    def refundableCount(self) -> int:
+        prefix = self._prefix()
+        return int(sum(prefix[bottom + 1] - prefix[top] for top, bottom in self.ranges))
+
+    def refundable(self):
+        """The refundable transactions in the selection, in order."""
+        prefix = self._prefix()
+        rows = self.rows
+        for top, bottom in self.ranges:
+            if prefix[bottom + 1] == prefix[top]:
+                continue
+            for row in (np.flatnonzero(np.diff(prefix[top:bottom + 2])) + top).tolist():
+                yield rows[row]
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _prefix(self) -> np.ndarray:
+        if self._refundablePrefix is None:
+            flags = np.fromiter((t.isRefundable for t in self.rows), dtype=bool, count=len(self.rows))
+            self._refundablePrefix = np.zeros(len(flags) + 1, dtype=np.int64)
+            np.cumsum(flags, out=self._refundablePrefix[1:])
+        return self._refundablePrefix
+
+    @staticmethod
+    def _merge(ranges) -> list:
+        merged = []
+        for top, bottom in sorted(ranges):
+            if merged and top <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], bottom))
+            else:
+                merged.append((top, bottom))
+        return merged
@@ -0,0 +1,95 @@
+"""
+Append-only scratch file for gateway records evicted from memory.
+
+Each record is written as one JSON line and found again through an in-memory offset index, so reading one back is a
+single seek and read. A record spilled again replaces its index entry and the old line becomes garbage. Once there is
+more garbage than live records (and at least COMPACT_MIN_BYTES of it) the live lines are copied to a new file.
+"""
+import json
+import os
+import tempfile
+import threading
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+COMPACT_MIN_BYTES = 4 * 1024 * 1024
+
+
+class SpillFile:
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ.get("WS_STORE_SPILL_DIR") or None
+        self._lock = threading.Lock()
+        self._file = tempfile.TemporaryFile(prefix="spill-", suffix=".jsonl", dir=self.directory)
+        self._index = {}
+        self._size = 0
+        self._live = 0
+        self.compactions = 0
+
+    def write(self, ref: str, raw: dict):
+        line = json.dumps(raw, separators=(",", ":"), default=str).encode() + b"\n"
+        with self._lock:
+            old = self._index.get(ref)
+            if old is not None:
+                self._live -= old[1]
+            self._file.seek(self._size)
+            self._file.write(line)
+            self._index[ref] = (self._size, len(line))
+            self._size += len(line)
+            self._live += len(line)
+            if self._size - self._live > max(self._live, COMPACT_MIN_BYTES):
+                self._compact()
+
+    def read(self, ref: str) -> dict:
+        with self._lock:
+            offset, length = self._index[ref]
+            self._file.seek(offset)
+            return json.loads(self._file.read(length))
+
+    def __contains__(self, ref):
+        return ref in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def size(self) -> int:
+        """Bytes on disk, including lines that have since been replaced."""
+        return self._size
+
+    @property
+    def liveBytes(self) -> int:
+        """Bytes of the lines still in the index."""
+        return self._live
+
+    def clear(self):
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self._index = {}
+            self._size = 0
+            self._live = 0
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _compact(self):
+        """Copy the live lines to a new file, in file order. Called holding _lock."""
+        compacted = tempfile.TemporaryFile(prefix="spill-", suffix=".jsonl", dir=self.directory)
+        index = {}
+        size = 0
+        for ref, (offset, length) in sorted(self._index.items(), key=lambda item: item[1][0]):
+            self._file.seek(offset)
+            compacted.write(self._file.read(length))
+            index[ref] = (size, length)
+            size += length
+        log.debug(f"Compacted the spill file from {self._size // 1024}KiB to {size // 1024}KiB")
+        self._file.close()
+        self._file = compacted
+        self._index = index
+        self._size = size
+        self.compactions += 1
@@ -0,0 +1,122 @@
+import datetime
+import sys
+from enum import IntEnum
+
+
+class SettleStatus(IntEnum):
+    PENDING = 0
+    MANUAL = 1
+    SUSPENDED = 2
+    CANCELLED = 3
+    SETTLING = 10
+    SETTLED = 100
+
+
+# Fields with few distinct values, interned so every record shares one copy of each value
+INTERNED_FIELDS = ["requesttypedescription", "sitereference", "currencyiso3a", "settlestatus",
+                   "accounttypedescription", "paymenttypedescription", "operatorname", "errorcode"]
+# Fields every Transaction needs whatever else is dropped by a projection
+PARSED_FIELDS = ["transactionreference", "requesttypedescription", "sitereference", "currencyiso3a", "baseamount",
+                 "settlebaseamount", "settlestatus", "transactionstartedtimestamp"]
+
+
+def parseAmount(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parseStatus(value):
+    try:
+        return SettleStatus(int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def parseTimestamp(value):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Transaction:
+    """
+    A gateway transaction record, parsed once when it enters the TransactionStore. Amounts are integer minor units,
+    settlestatus a SettleStatus and transactionstartedtimestamp a datetime (each None if missing or invalid). The
+    gateway's own string fields stay available through raw, get and [].
+
+    The TransactionStore may evict the raw record to disk to keep within its memory budget, the parsed fields stay.
+    Reading the raw record then loads it back through the store. isSpilled tells the store the raw record is unchanged
+    since it was last written to disk, so evicting it again needn't write it again.
+
+    A partial Transaction only has the fields of a projection (see project), the full record has to be fetched from
+    the gateway.
+    """
+    __slots__ = ["transactionreference", "requesttypedescription", "sitereference", "currencyiso3a", "baseamount",
+                 "settlebaseamount", "settlestatus", "timestamp", "isPartial", "isSpilled", "_raw", "_store"]
+
+    def __init__(self, raw: dict, isPartial=False):
+        for field in INTERNED_FIELDS:
+            value = raw.get(field)
+            if type(value) is str:
+                raw[field] = sys.intern(value)
+        self._raw = raw
+        self._store = None
+        self.isPartial = isPartial
+        self.isSpilled = False
+        self._parse(raw)
+
+    @classmethod
+    def project(cls, raw: dict, fields):
+        """A Transaction keeping only the given fields (and PARSED_FIELDS) of raw, partial if anything was dropped."""
+        projected = {k: v for k, v in raw.items() if k in fields}
+        return cls(projected, isPartial=len(projected) < len(raw))
+
+    def _parse(self, raw: dict):
+        self.transactionreference = raw["transactionreference"]
+        self.requesttypedescription = raw.get("requesttypedescription", "")
+        self.sitereference = raw.get("sitereference", "")
+        self.currencyiso3a = raw.get("currencyiso3a", "")
+        self.baseamount = parseAmount(raw.get("baseamount"))
+        self.settlebaseamount = parseAmount(raw.get("settlebaseamount"))
+        self.settlestatus = parseStatus(raw.get("settlestatus"))
+        self.timestamp = parseTimestamp(raw.get("transactionstartedtimestamp"))
+
+    @property
+    def raw(self) -> dict:
+        if self._raw is None:
+            self._store.reload(self)
+        return self._raw
+
+    @property
+    def isResident(self) -> bool:
+        return self._raw is not None
+
+    @property
+    def isRefundable(self) -> bool:
+        return self.requesttypedescription == "AUTH" and self.settlestatus == SettleStatus.SETTLED
+
+    def replaceWith(self, other):
+        """Take on a newer version of the same transaction, so everything holding this one sees it."""
+        self._raw = other.raw
+        self.isPartial = other.isPartial
+        self.isSpilled = False
+        self._parse(self._raw)
+
+    def update(self, fields: dict):
+        """Change gateway fields, e.g. after a TRANSACTIONUPDATE, and parse them again."""
+        # A new dict, the record may be shared with a cached gateway response
+        self._raw = {**self.raw, **fields}
+        self.isSpilled = False
+        self._parse(self._raw)
+
+    def get(self, field, default=""):
+        return self.raw.get(field, default)
+
+    def __getitem__(self, field):
+        return self.raw[field]
+
+    def __repr__(self):
+        return f"Transaction({self.raw!r})"
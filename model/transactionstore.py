@@ -1,30 +1,188 @@
+"""
+The loaded transactions, by transactionreference.
+
+The raw gateway records make up most of the memory of a long session, so they are kept within WS_STORE_BUDGET_MB
+(0 for no limit): once over budget the least recently used ones are written to a SpillFile and dropped from memory.
+The Transaction objects themselves stay, with their parsed fields, so the table, search and summaries carry on as
+before, and a spilled record is read back transparently when anything asks for its raw fields.
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
 from lib.logger import createLogger
+from model.aggregator import TransactionAggregator
+from model.searchindex import SearchIndex
+from model.spillfile import SpillFile
+from model.transaction import PARSED_FIELDS, Transaction
 
+load_dotenv()
 log = createLogger(__name__)
 
 
+def recordSize(raw: dict) -> int:
+    """Rough bytes held by a raw record, its values counted as if none were shared."""
+    return sys.getsizeof(raw) + sum(sys.getsizeof(v) for v in raw.values())
+
+
 class TransactionStore:
-    def __init__(self):
+    def __init__(self, budget=None, spillDirectory=None, ingestor=None):
+        """budget is in bytes, by default WS_STORE_BUDGET_MB. ingestor is passed on to the SearchIndex."""
+        self._projection = None
+        self.budget = int(os.environ.get("WS_STORE_BUDGET_MB", 256)) * 1024 * 1024 if budget is None else budget
         self._data = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+        self._resident = OrderedDict()  # ref -> size of its raw record, least recently used first
+        self._residentBytes = 0
+        self._spill = SpillFile(spillDirectory)
+        self.evictions = 0
+        self.reloads = 0
+        self.aggregates = TransactionAggregator()
+        self.addListener(self.aggregates)
+        self.search = SearchIndex(ingestor)
+        self.addListener(self.search)
+
+    def addListener(self, listener):
+        """Listeners are told about each batch of added transactions (added) and when the store is emptied (cleared)."""
+        self._listeners.append(listener)
+
+    @property
+    def projection(self):
+        """The fields kept of each added record, or None to keep them all."""
+        return self._projection
+
+    @projection.setter
+    def projection(self, fields):
+        self._projection = None if fields is None else frozenset(fields).union(PARSED_FIELDS)
+
+    def add(self, transactions: list) -> list:
+        """
+        Add gateway records (dicts) or Transactions. A transaction that is already loaded is updated in place, so every
+        view of the store sees the new version. Returns the store's Transactions for the added records.
+        """
+        if self._projection is None:
+            transactions = [t if isinstance(t, Transaction) else Transaction(t) for t in transactions]
+        else:
+            fields = self._projection
+            transactions = [t if isinstance(t, Transaction) else Transaction.project(t, fields) for t in transactions]
+        log.debug(f"Adding {len(transactions)} transactions")
+        with self._lock:
+            for i, t in enumerate(transactions):
+                existing = self._data.get(t.transactionreference)
+                if existing is not None and existing is not t:
+                    existing.replaceWith(t)
+                    t = transactions[i] = existing
+                else:
+                    t._store = self
+                    self._data[t.transactionreference] = t
+                self._admit(t)
+        # Listeners read the new records, so they are only evicted afterwards
+        for listener in self._listeners:
+            listener.added(transactions)
+        self._evict()
+        return transactions
 
-    def add(self, transactions: list):
-        log.debug(f"Added:")
-        for t in transactions:
-            log.debug("\t<-- " + str(t))
-            self._data[t["transactionreference"]] = t
+    def update(self, changes: dict) -> list:
+        """
+        Apply field changes, {transactionreference: {field: value}}, to the loaded transactions in place. References
+        that aren't loaded are skipped. Returns the changed Transactions.
+        """
+        changed = []
+        with self._lock:
+            for ref, fields in changes.items():
+                transaction = self._data.get(ref)
+                if transaction is None:
+                    continue
+                transaction.update(fields)
+                self._admit(transaction)
+                changed.append(transaction)
+        if changed:
+            for listener in self._listeners:
+                listener.added(changed)
+            self._evict()
+        log.debug(f"Updated {len(changed)} of {len(changes)} transactions")
+        return changed
 
-    def get(self, ref) -> dict:
+    def get(self, ref) -> Transaction:
         log.debug(f"Gave:")
-        transaction = self._data.get(ref, None)
+        with self._lock:
+            transaction = self._data.get(ref, None)
+            if transaction is not None:
+                if transaction.isResident:
+                    self._resident.move_to_end(ref)
+                else:
+                    self.reload(transaction)
         log.debug(f"\t--> " + str(transaction))
         return transaction
 
+    def __contains__(self, ref) -> bool:
+        return ref in self._data
+
     def getAll(self) -> list:
         transactions = list(self._data.values())
-        log.debug(f"Gave:")
-        for t in transactions:
-            log.debug(f"\t--> " + str(t))
+        log.debug(f"Gave {len(transactions)} transactions")
         return transactions
 
+    def reload(self, transaction: Transaction):
+        """Read a spilled raw record back into its Transaction, called by Transaction.raw."""
+        with self._lock:
+            if transaction.isResident:
+                return
+            transaction._raw = self._spill.read(transaction.transactionreference)
+            transaction.isSpilled = True  # Until it changes
+            self.reloads += 1
+            self._admit(transaction)
+            self._evict()
+
+    def residency(self) -> dict:
+        """How much of the store is in memory, and how much has been spilled to disk."""
+        with self._lock:
+            return {
+                "transactions": len(self._data),
+                "resident": len(self._resident),
+                "spilled": len(self._data) - len(self._resident),
+                "residentBytes": self._residentBytes,
+                "budgetBytes": self.budget,
+                "spillFileBytes": self._spill.size,
+                "spillLiveBytes": self._spill.liveBytes,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+            }
+
     def clear(self):
-        self._data = {}
\ No newline at end of file
+        with self._lock:
+            self._data = {}
+            self._resident = OrderedDict()
+            self._residentBytes = 0
+            self._spill.clear()
+        for listener in self._listeners:
+            listener.cleared()
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _admit(self, transaction):
+        ref = transaction.transactionreference
+        self._residentBytes -= self._resident.pop(ref, 0)
+        size = recordSize(transaction._raw)
+        self._resident[ref] = size
+        self._residentBytes += size
+
+    def _evict(self):
+        if self.budget <= 0:
+            return
+        with self._lock:
+            evicted = 0
+            # The most recently used record always stays, it's the one being asked for
+            while self._residentBytes > self.budget and len(self._resident) > 1:
+                ref, size = self._resident.popitem(last=False)
+                transaction = self._data[ref]
+                if not transaction.isSpilled:
+                    self._spill.write(ref, transaction._raw)
+                    transaction.isSpilled = True
+                transaction._raw = None
+                self._residentBytes -= size
+                evicted += 1
+            if evicted:
+                self.evictions += evicted
+                log.debug(f"Spilled {evicted} records, {self._residentBytes // 1024}KiB resident")
@@ -0,0 +1,331 @@
+"""
+Transports carry a request dict to the gateway and bring back its response, for Webservices._send.
+
+SdkTransport goes through the securetrading SDK (or anything with the same process() method, like FakeGateway).
+JsonTransport posts straight to the gateway's JSON API over a pooled HTTP session, and parses the body while it
+downloads: each record of a TRANSACTIONQUERY is decoded on its own as soon as it has arrived and handed to the
+onRecords callback, and the raw body is never held in memory in full.
+DaemonTransport hands requests to a CacheDaemon shared by every client on the machine, see model.daemon.
+"""
+import codecs
+import itertools
+import json
+import os
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+import requests
+import securetrading
+from multiprocessing.connection import Client
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from lib.logger import createLogger
+
+load_dotenv()
+log = createLogger(__name__)
+
+STRUCTURE = re.compile(r'["{}\[\]]')
+STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+SEPARATORS = re.compile(r'[\s,]*')
+
+
+class SdkTransport:
+    def __init__(self, api):
+        self.api = api
+
+    def send(self, request: dict, context: dict) -> dict:
+        strequest = securetrading.Request()
+        strequest.update(request)
+        response = self.api.process(strequest)
+        # The SDK serialises the request itself, there's no telling how big it was on the wire
+        context["unmeasured"] = True
+        onRecords = context.get("onRecords")
+        if onRecords is not None:
+            for res in response.get("responses", []):
+                if res.get("records"):
+                    onRecords(res["records"])
+        return response
+
+    def close(self):
+        pass
+
+
+class RecordStreamParser:
+    """
+    Incremental parser for gateway JSON responses. feed() takes the body in chunks and returns the records (elements
+    of any "records" array) completed so far, finish() returns the whole document with the records put back.
+
+    Outside records arrays the body is scanned for its structure and kept as text, it is small and parsed once at the
+    end. Inside one, each record is decoded straight out of the buffer with the C JSON decoder as soon as all of it
+    has arrived, and then dropped from the buffer.
+    """
+
+    def __init__(self, keepRecords=True):
+        self.keepRecords = keepRecords
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._data = ""
+        self._pos = 0
+        self._stack = []  # [container, lastString] per open object/array outside records
+        self._inRecords = False
+        self._skeleton = []
+        self._skeletonFrom = 0
+        self._arrays = []
+
+    def feed(self, chunk: bytes) -> list:
+        data = self._data + self._decoder.decode(chunk)
+        pos = self._pos
+        records = []
+        stack = self._stack
+        while True:
+            if self._inRecords:
+                pos = SEPARATORS.match(data, pos).end()
+                if pos == len(data):
+                    break
+                if data[pos] == "]":
+                    self._inRecords = False
+                    self._skeletonFrom = pos
+                    pos += 1
+                    continue
+                try:
+                    record, end = self._json.raw_decode(data, pos)
+                except json.JSONDecodeError:
+                    break  # The rest of the record hasn't arrived yet
+                if self.keepRecords:
+                    self._arrays[-1].append(record)
+                records.append(record)
+                pos = end
+                continue
+            match = STRUCTURE.search(data, pos)
+            if match is None:
+                pos = len(data)
+                break
+            i = match.start()
+            char = data[i]
+            if char == '"':
+                end = STRING_REST.match(data, i + 1)
+                if end is None:
+                    pos = i  # The rest of the string hasn't arrived yet
+                    break
+                if stack:
+                    stack[-1][1] = data[i + 1:end.end() - 1]
+                pos = end.end()
+            elif char == "{" or char == "[":
+                parent = stack[-1] if stack else None
+                # Only the records of each gateway response, i.e. {"response": [{"records": [...]}]}
+                if char == "[" and len(stack) == 3 and parent[0] == "{" and parent[1] == "records":
+                    # Keep the brackets in the skeleton, the records go into their own list. The array isn't pushed on
+                    # the stack as its closing bracket is found by the records loop above.
+                    self._skeleton.append(data[self._skeletonFrom:i + 1])
+                    self._inRecords = True
+                    self._arrays.append([])
+                else:
+                    stack.append([char, None])
+                pos = i + 1
+            else:
+                stack.pop()
+                pos = i + 1
+        # Keep only the text still needed: an unfinished record or string
+        if not self._inRecords:
+            self._skeleton.append(data[self._skeletonFrom:pos])
+        self._data = data[pos:]
+        self._pos = 0
+        self._skeletonFrom = 0
+        return records
+
+    def finish(self) -> dict:
+        if self._inRecords or self._data.strip():
+            raise ValueError("Gateway response ended part way through")
+        document = json.loads("".join(self._skeleton))
+        arrays = iter(self._arrays)
+        for response in document.get("response", []):
+            if "records" in response:
+                response["records"] = next(arrays)
+        return document
+
+
+class JsonTransport:
+    def __init__(self, username, password, url=None, poolSize=None):
+        self.alias = username
+        self.url = url or os.environ.get("WS_JSON_URL", "https://webservices.securetrading.net/json/")
+        poolSize = poolSize or int(os.environ.get("WS_HTTP_POOL_SIZE", 32))
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update({"Content-Type": "application/json", "Accept": "application/json"})
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=poolSize))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=poolSize))
+
+    def send(self, request: dict, context: dict) -> dict:
+        body = json.dumps({"alias": self.alias, "version": "1.00", "request": [request]})
+        timeout = max(context["deadline"] - time.monotonic(), 0.1) if "deadline" in context else 60
+        onRecords = context.get("onRecords")
+        parser = RecordStreamParser(keepRecords=context.get("keepRecords", True) or onRecords is None)
+        body = body.encode()
+        context["bytesSent"] = context.get("bytesSent", 0) + len(body)
+        with self.session.post(self.url, data=body, stream=True, timeout=timeout) as httpResponse:
+            httpResponse.raise_for_status()
+            for chunk in httpResponse.iter_content(chunk_size=64 * 1024):
+                context["bytesReceived"] = context.get("bytesReceived", 0) + len(chunk)
+                records = parser.feed(chunk)
+                if records and onRecords is not None:
+                    onRecords(records)
+        document = parser.finish()
+        return {"requestreference": document.get("requestreference"), "responses": document.get("response", [])}
+
+    def close(self):
+        self.session.close()
+
+
+def daemonAddress():
+    """
+    Where the CacheDaemon listens, WS_DAEMON_ADDRESS: host:port for a localhost TCP socket, anything else is the path of
+    a Unix socket. Defaults to a Unix socket in the temp directory, or a localhost port on Windows.
+    """
+    address = os.environ.get("WS_DAEMON_ADDRESS")
+    if not address:
+        if sys.platform == "win32":
+            return "127.0.0.1", 47600
+        return os.path.join(tempfile.gettempdir(), "webservices-daemon.sock")
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return host, int(port)
+    return address
+
+
+def daemonAuthkey():
+    """WS_DAEMON_KEY, the secret a client has to know to connect to the CacheDaemon, if one is set."""
+    key = os.environ.get("WS_DAEMON_KEY")
+    return key.encode() if key else None
+
+
+class DaemonTransport:
+    """
+    Sends requests through a CacheDaemon, which shares one gateway session, cache and in-flight requests between
+    every client logged in to the same account. Messages are JSON, one per frame.
+
+    Records of a streamed TRANSACTIONQUERY arrive in batches as the daemon receives them. Anything else the daemon
+    sends unasked, changes to transactions made or seen by other clients, is passed to onPush(message) from the
+    reader thread.
+    """
+
+    def __init__(self, username, password, address=None, onPush=None):
+        self.address = address or daemonAddress()
+        self.onPush = onPush
+        self._ids = itertools.count(1)
+        self._pending = {}  # id -> Queue of the daemon's messages about that request
+        self._sendLock = threading.Lock()
+        self._lock = threading.Lock()
+        self._closed = False
+        try:
+            self._connection = Client(self.address, authkey=daemonAuthkey())
+        except OSError as e:
+            raise Exception(f"Can't reach the cache daemon at {self.address} [{e}]")
+        self._reader = threading.Thread(target=self._read, name="DaemonTransport", daemon=True)
+        self._reader.start()
+        reply = self._call({"op": "login", "username": username, "password": password}, 60)
+        if "error" in reply:
+            self.close()
+            raise Exception(reply["error"])
+
+    def send(self, request: dict, context: dict) -> dict:
+        timeout = max(context["deadline"] - time.monotonic(), 0.1) if "deadline" in context else 60
+        onRecords = context.get("onRecords")
+        reply = self._call({"op": "request", "request": request, "stream": onRecords is not None,
+                            "keepRecords": context.get("keepRecords", True) or onRecords is None}, timeout, onRecords)
+        context["unmeasured"] = True  # What went to the gateway is counted by the daemon
+        if "error" in reply:
+            raise Exception(reply["error"])
+        return reply["response"]
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            self._write({"op": "logout"})
+        except OSError:
+            pass
+        self._connection.close()
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _call(self, message: dict, timeout: float, onRecords=None) -> dict:
+        """Send message and wait for the daemon's reply to it, handing any batches of records to onRecords."""
+        id = next(self._ids)
+        replies = queue.Queue()
+        with self._lock:
+            if self._closed:
+                raise ConnectionError("Not connected to the cache daemon")
+            self._pending[id] = replies
+        try:
+            self._write({**message, "id": id})
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    reply = replies.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    raise TimeoutError(f"No reply from the cache daemon after {timeout:.0f}s")
+                if isinstance(reply, Exception):
+                    raise reply
+                if "records" in reply:
+                    if onRecords is not None:
+                        onRecords(reply["records"])
+                    continue
+                return reply
+        finally:
+            with self._lock:
+                self._pending.pop(id, None)
+
+    def _write(self, message: dict):
+        data = json.dumps(message).encode()
+        with self._sendLock:
+            self._connection.send_bytes(data)
+
+    def _read(self):
+        try:
+            while True:
+                message = json.loads(self._connection.recv_bytes())
+                if "push" in message:
+                    if self.onPush is not None:
+                        self.onPush(message)
+                    continue
+                with self._lock:
+                    replies = self._pending.get(message.get("id"))
+                if replies is not None:  # Otherwise the caller gave up waiting
+                    replies.put(message)
+        except (EOFError, OSError) as e:
+            error = ConnectionError(f"Lost the connection to the cache daemon [{str(e) or 'closed'}]")
+        with self._lock:
+            if not self._closed:
+                log.error(str(error))
+            self._closed = True
+            for replies in self._pending.values():
+                replies.put(error)
+
+
+TRANSPORTS = ["sdk", "json", "daemon"]
+
+
+def createTransport(username, password, gateway=None, onPush=None, transport=None):
+    """
+    The transport named by transport, by default WS_TRANSPORT (sdk, json or daemon), or an SdkTransport around gateway
+    if one is given. onPush is passed on to a DaemonTransport.
+    """
+    if gateway is not None:
+        return SdkTransport(gateway)
+    transport = transport or os.environ.get("WS_TRANSPORT", "sdk")
+    if transport not in TRANSPORTS:
+        raise Exception(f"Unknown transport {transport!r}, expected one of {', '.join(TRANSPORTS)}")
+    if transport == "json":
+        log.debug("Using the JSON transport")
+        return JsonTransport(username, password)
+    if transport == "daemon":
+        log.debug("Using the cache daemon")
+        return DaemonTransport(username, password, onPush=onPush)
+    config = securetrading.Config()
+    config.username = username
+    config.password = password
+    return SdkTransport(securetrading.Api(config))
@@ -1,34 +1,41 @@
-import securetrading
 from lib.logger import createLogger
+from model.middleware import defaultMiddlewares
+from model.transport import createTransport
 import datetime
 
 log = createLogger(__name__)
 
 
 class Webservices:
-    def __init__(self):
-        self.st = None
+    def __init__(self, middlewares=None, gateway=None, transport=None):
+        """
+        gateway replaces the securetrading Api used after login, e.g. with a FakeGateway. transport names the transport
+        to log in with (see createTransport), by default WS_TRANSPORT.
+        """
+        self.gateway = gateway
+        self.transportName = transport
+        self.transport = None
         self.loggedIn = False
+        self.middlewares = defaultMiddlewares() if middlewares is None else middlewares
+        # Called with each update pushed by the transport (only a DaemonTransport pushes), from its own thread
+        self.pushListeners = []
 
     def login(self, username, password):
         """
         Attempt to log in to Webservices by verifying credentials with a TRANSACTIONQUERY.
-        Returns a GatewayResponse containing today's transactions, and sets the Webservices st property.
+        The query only covers the current second, so it costs the gateway next to nothing however busy the day has
+        been; the day's transactions are loaded afterwards, see Prefetcher.
+        Returns the GatewayResponse, and sets the Webservices transport property.
         Throws an InvalidCredentials exception if an error is returned from the gateway.
         """
-        log.debug(f"Logging in with {username}:{password}")
-        config = securetrading.Config()
-        config.username = username
-        config.password = password
-        self.st = securetrading.Api(config)
+        log.debug(f"Logging in with {username}")
+        self.transport = createTransport(username, password, self.gateway, self._push, self.transportName)
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         request = {
             "requesttypedescriptions": ["TRANSACTIONQUERY"],
             "filter": {
-                "starttimestamp": [{"value": str(datetime.datetime.now().date()) + " 00:00:00"}],
-                "endtimestamp": [{"value": str(datetime.datetime.now().date()) + " 23:59:59"}],
-                "requesttypedescription": [
-                    {"value": "AUTH"}, {"value": "REFUND"}, {"value": "THREEDQUERY"}
-                ]
+                "starttimestamp": [{"value": now}],
+                "endtimestamp": [{"value": now}]
             }
         }
         response = self.makeRequest(request)["responses"][0]
@@ -41,18 +48,47 @@ class Webservices:
             log.error(errString)
             raise Exception(errString)
 
-    def makeRequest(self, request: dict) -> dict:
+    def logout(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = None
+        self.loggedIn = False
+        for middleware in self.middlewares:
+            middleware.reset()
+
+    def makeRequest(self, request: dict, onRecords=None, keepRecords=True) -> dict:
+        """
+        Send a request to the gateway and return its response. onRecords, if given, is called with batches of
+        TRANSACTIONQUERY records as they arrive (all at once, unless the transport streams). With keepRecords False
+        a streaming transport hands records only to onRecords and leaves them out of the response.
+        """
         log.debug("Making a new request:")
-        log.debug("\t--> " + str(request))
+        log.debug("\t--> %s", request)
         # isMultiRequest = True if len(request["requesttypedescriptions"]) > 1 else False
-        # Send request to Trust Payments Webservices API
-        response = self._send(request)
-        log.debug("\t<-- " + str(response))
+        # Send request to Trust Payments Webservices API, through the middleware pipeline
+        context = {"onRecords": onRecords, "keepRecords": keepRecords} if onRecords else {}
+        response = self._dispatch(request, context)
+        log.debug("\t<-- %s", response)
         return response
 
+    def findMiddleware(self, middlewareType):
+        """The first middleware in the pipeline of the given type, or None."""
+        return next((m for m in self.middlewares if isinstance(m, middlewareType)), None)
+
     # PRIVATE METHODS --------------------------------------------------------------------
-    def _send(self, request: dict) -> dict:
-        strequest = securetrading.Request()
-        strequest.update(request)
-        stresponse = self.st.process(strequest)
-        return stresponse
+    def _dispatch(self, request: dict, context: dict) -> dict:
+        """Pass the request down the middleware chain, the innermost link calls _send."""
+        def link(index):
+            def callNext(request, context):
+                if index == len(self.middlewares):
+                    return self._send(request, context)
+                return self.middlewares[index].process(request, context, link(index + 1))
+            return callNext
+        return link(0)(request, context)
+
+    def _send(self, request: dict, context: dict) -> dict:
+        return self.transport.send(request, context)
+
+    def _push(self, message: dict):
+        for listener in self.pushListeners:
+            listener(message)
@@ -0,0 +1,11 @@
+from lib.config import Config
+
+
+def testDefaultHeadersSurviveToggling():
+    cfg = Config()
+    defaults = cfg.defaultHeaders()
+    assert defaults
+    cfg.toggleHeader(defaults[0])
+    hidden = next(f for f, d in cfg.FIELDS.items() if not d.get("activeInTransactionTableHeader"))
+    cfg.toggleHeader(hidden)
+    assert cfg.defaultHeaders() == defaults
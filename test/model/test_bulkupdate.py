@@ -0,0 +1,91 @@
+import pytest
+from model.bulkupdate import BulkUpdater, readUpdateFile, updateKey, updateRequest, validateUpdates
+from model.jobqueue import DONE, FAILED, JobQueue
+
+
+class Api:
+    def __init__(self, failing=()):
+        self.requests = []
+        self.failing = set(failing)
+
+    def makeRequest(self, request):
+        self.requests.append(request)
+        ref = request["filter"]["transactionreference"][0]["value"]
+        return {"responses": [{"errorcode": "30000" if ref in self.failing else "0"}]}
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    def create(api):
+        return JobQueue(api, path=str(tmp_path / "jobs.sqlite3"), workers=2)
+    return create
+
+
+def testValidation():
+    validateUpdates({"settlestatus": "2", "settlebaseamount": "100", "settleduedate": "2021-12-01"})
+    for updates in [{}, {"baseamount": "1"}, {"settlestatus": "100"}, {"settlebaseamount": "1.00"},
+                    {"settleduedate": "01/12/2021"}]:
+        with pytest.raises(Exception):
+            validateUpdates(updates)
+
+
+def testReadUpdateFile(tmp_path):
+    path = tmp_path / "updates.csv"
+    path.write_text("transactionreference,sitereference,settlestatus,settleduedate\n"
+                    "1-1,site,2,\n"
+                    "1-2,,,2021-12-01\n")
+    assert readUpdateFile(str(path)) == [("1-1", "site", {"settlestatus": "2"}),
+                                         ("1-2", "", {"settleduedate": "2021-12-01"})]
+    path.write_text("transactionreference,settlestatus\n1-1,9\n")
+    with pytest.raises(Exception, match="line 2"):
+        readUpdateFile(str(path))
+
+
+def testBatchesReportTheChangesThatWentThrough(jobs):
+    api = Api(failing={"1-2"})
+    updater = BulkUpdater(jobs(api), batchSize=2)
+    batches = []
+    updates = [(f"1-{i}", "site", {"settlestatus": "2"}) for i in range(1, 4)]
+    keys = updater.run(updates, lambda done, total, changes: batches.append((done, total, changes)))
+    assert batches == [(2, 3, {"1-1": {"settlestatus": "2"}}), (3, 3, {"1-3": {"settlestatus": "2"}})]
+    assert [state for state, response in updater.jobs.results(keys).values()].count(FAILED) == 1
+    assert api.requests[0]["updates"] == {"settlestatus": "2"}
+
+
+def testRerunSendsOnlyWhatDidntGoThrough(jobs):
+    api = Api(failing={"1-2"})
+    queue = jobs(api)
+    updates = [(f"1-{i}", "site", {"settlestatus": "2"}) for i in range(1, 4)]
+    BulkUpdater(queue).run(updates, runId="run1")
+    api.failing.clear()
+    batches = []
+    keys = BulkUpdater(queue).run(updates, lambda done, total, changes: batches.append(changes), runId="run1")
+    assert len(api.requests) == 4
+    # Updates done by the first run are reported again, so the store catches up with them
+    assert batches == [{ref: {"settlestatus": "2"} for ref in ["1-1", "1-2", "1-3"]}]
+    assert all(state == DONE for state, response in queue.results(keys).values())
+    assert keys[0] == updateKey("run1", "1-1", {"settlestatus": "2"})
+
+
+def testTheSameChangeLaterIsSentAgain(jobs):
+    api = Api()
+    updater = BulkUpdater(jobs(api))
+    applied = []
+    for status in ["2", "0", "2"]:
+        updater.run([("1-1", "site", {"settlestatus": status})],
+                    lambda done, total, changes: applied.append(changes["1-1"]["settlestatus"]))
+    assert [r["updates"]["settlestatus"] for r in api.requests] == ["2", "0", "2"]
+    assert applied == ["2", "0", "2"]
+
+
+def testChangesOfAnInterruptedRun(jobs):
+    api = Api(failing={"1-2"})
+    queue = jobs(api)
+    keys = queue.enqueue([(updateKey("run1", f"1-{i}", {"settlestatus": "2"}),
+                           updateRequest(f"1-{i}", "site", {"settlestatus": "2"})) for i in range(1, 4)])
+    queue.enqueue([("REFUND:1-9", {"requesttypedescriptions": ["REFUND"], "filter": {
+        "transactionreference": [{"value": "1-9"}]}})])
+    # Resumed after a crash, everything unfinished
+    queue.run()
+    assert BulkUpdater(queue).changesOf(keys + ["REFUND:1-9"]) == {"1-1": {"settlestatus": "2"},
+                                                                 "1-3": {"settlestatus": "2"}}
@@ -0,0 +1,101 @@
+import os
+import time
+import pytest
+from model.daemon import CacheDaemon, _Session
+from model.fakegateway import FakeGateway
+from model.transport import JsonTransport, createTransport
+from model.webservices import Webservices
+
+QUERY = {"requesttypedescriptions": ["TRANSACTIONQUERY"], "filter": {"starttimestamp": [{"value": "2021-12-01"}]}}
+
+
+def record(ref, settlestatus="0"):
+    return {"transactionreference": ref, "settlestatus": settlestatus, "baseamount": "100"}
+
+
+@pytest.fixture
+def gateway():
+    gateway = FakeGateway()
+    gateway.record({"requesttypedescriptions": ["TRANSACTIONQUERY"]}, {"responses": [{
+        "errorcode": "0", "errormessage": "Ok", "errordata": [], "found": "2",
+        "requesttypedescription": "TRANSACTIONQUERY", "records": [record("1-1"), record("1-2")]}]})
+    return gateway
+
+
+@pytest.fixture
+def daemon(gateway, tmp_path, monkeypatch):
+    # The clients' setting, which the daemon's own sessions must not follow
+    monkeypatch.setenv("WS_TRANSPORT", "daemon")
+    monkeypatch.setenv("WS_DAEMON_ADDRESS", str(tmp_path / "daemon.sock"))
+    daemon = CacheDaemon(gateway=gateway)
+    daemon.start()
+    yield daemon
+    daemon.stop()
+
+
+def client():
+    api = Webservices()
+    api.login("user", "pass")
+    return api
+
+
+def testDaemonNeverUsesTheDaemonTransport(monkeypatch):
+    monkeypatch.setenv("WS_TRANSPORT", "daemon")
+    with pytest.raises(Exception):
+        CacheDaemon(transport="daemon")
+    assert CacheDaemon(address=os.devnull).transport == "sdk"
+    assert isinstance(createTransport("user", "pass", transport="json"), JsonTransport)
+
+
+def testClientsShareOneSession(daemon, gateway):
+    first, second = client(), client()
+    assert daemon.stats()["sessions"] == 1
+    calls = gateway.calls
+    for api in [first, second]:
+        response = api.makeRequest(QUERY)["responses"][0]
+        assert [r["transactionreference"] for r in response["records"]] == ["1-1", "1-2"]
+    assert gateway.calls == calls + 1
+    first.logout()
+    second.logout()
+
+
+def testRecordsAreStreamed(daemon):
+    api = client()
+    for _ in range(2):  # The second time from the daemon's cache
+        streamed = []
+        response = api.makeRequest(QUERY, onRecords=streamed.extend, keepRecords=False)
+        assert len(streamed) == 2
+        assert "records" not in response["responses"][0]
+    api.logout()
+
+
+def testUpdatesArePushedToOtherClients(daemon):
+    first, second = client(), client()
+    pushes = []
+    second.pushListeners.append(pushes.append)
+    first.makeRequest({"requesttypedescriptions": ["TRANSACTIONUPDATE"], "updates": {"settlestatus": "2"},
+                       "filter": {"transactionreference": [{"value": "1-1"}]}})
+    deadline = time.monotonic() + 5
+    while not pushes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pushes == [{"push": "updates", "updates": {"1-1": {"settlestatus": "2"}}}]
+    first.logout()
+    second.logout()
+
+
+def testOnlyChangedRecordsArePushed(daemon):
+    class Listener:
+        def __init__(self):
+            self.messages = []
+
+        def send(self, message):
+            self.messages.append(message)
+    session = _Session(None)
+    origin, other = Listener(), Listener()
+    session.clients = {origin, other}
+    daemon._publish(session, origin, QUERY, [{"records": [record("1-1")]}])
+    daemon._publish(session, origin, QUERY, [{"records": [record("1-1"), record("1-2")]}])
+    assert other.messages == []
+    daemon._publish(session, origin, QUERY, [{"records": [record("1-1", "100")]}])
+    assert other.messages == [{"push": "records", "records": [record("1-1", "100")]}]
+    assert origin.messages == []
@@ -0,0 +1,148 @@
+import sqlite3
+import pytest
+from model.jobqueue import DONE, FAILED, INFLIGHT, PENDING, UNKNOWN, JobQueue
+
+
+class Api:
+    """Answers requests with errorcode 0, or with the response queued for its request type in answers."""
+
+    def __init__(self):
+        self.requests = []
+        self.answers = {}
+
+    def makeRequest(self, request):
+        self.requests.append(request)
+        requestType = request["requesttypedescriptions"][0]
+        if requestType in self.answers:
+            return {"responses": [self.answers[requestType]]}
+        return {"responses": [{"errorcode": "0", "requesttypedescription": requestType}]}
+
+
+@pytest.fixture
+def api():
+    return Api()
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "jobs.sqlite3")
+
+
+@pytest.fixture
+def jobs(api, path):
+    jobs = JobQueue(api, path=path, workers=2)
+    yield jobs
+    jobs.close()
+
+
+def refund(parent):
+    return (f"REFUND:{parent}", {"requesttypedescriptions": ["REFUND"], "parenttransactionreference": parent,
+                                 "sitereference": "test_site12345"})
+
+
+def interrupt(path, key):
+    """Leave the job as a crash part way through sending it would."""
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE jobs SET state = ? WHERE key = ?", (INFLIGHT, key))
+
+
+def states(jobs, keys):
+    return {key: state for key, (state, response) in jobs.results(keys).items()}
+
+
+def testEnqueueIsIdempotent(jobs, api):
+    keys = jobs.enqueue([refund("1-1"), refund("1-2")])
+    jobs.run(keys)
+    assert len(api.requests) == 2
+    jobs.enqueue([refund("1-1"), refund("1-2")])
+    assert jobs.unfinished() == 0
+    jobs.run(keys)
+    assert len(api.requests) == 2
+    assert states(jobs, keys) == {"REFUND:1-1": DONE, "REFUND:1-2": DONE}
+
+
+def testFailedJobsAreQueuedAgain(jobs, api):
+    api.answers["REFUND"] = {"errorcode": "70000", "errormessage": "Decline"}
+    keys = jobs.enqueue([refund("1-1")])
+    jobs.run(keys)
+    assert states(jobs, keys) == {"REFUND:1-1": FAILED}
+    del api.answers["REFUND"]
+    jobs.enqueue([refund("1-1")])
+    assert states(jobs, keys) == {"REFUND:1-1": PENDING}
+    jobs.run(keys)
+    assert states(jobs, keys) == {"REFUND:1-1": DONE}
+
+
+def testInterruptedRefundFoundOnTheGateway(jobs, api, path):
+    keys = jobs.enqueue([refund("1-1")])
+    interrupt(path, keys[0])
+    record = {"transactionreference": "1-9", "parenttransactionreference": "1-1"}
+    api.answers["TRANSACTIONQUERY"] = {"errorcode": "0", "found": "1", "records": [record]}
+    jobs.run(keys)
+    # Looked up rather than sent again
+    assert [r["requesttypedescriptions"] for r in api.requests] == [["TRANSACTIONQUERY"]]
+    assert api.requests[0]["filter"]["parenttransactionreference"] == [{"value": "1-1"}]
+    state, response = jobs.results(keys)[keys[0]]
+    assert state == DONE and response["transactionreference"] == "1-9"
+    assert "errorcode" not in record
+
+
+def testInterruptedRefundNotFoundIsUnknown(jobs, api, path):
+    keys = jobs.enqueue([refund("1-1")])
+    interrupt(path, keys[0])
+    api.answers["TRANSACTIONQUERY"] = {"errorcode": "0", "found": "0"}
+    jobs.run(keys)
+    assert states(jobs, keys) == {"REFUND:1-1": UNKNOWN}
+    assert jobs.unfinished() == 0
+
+
+def testInterruptedUpdate(jobs, api, path):
+    update = {"requesttypedescriptions": ["TRANSACTIONUPDATE"], "updates": {"settlestatus": "2"},
+              "filter": {"transactionreference": [{"value": "1-1"}]}}
+    keys = jobs.enqueue([("UPDATE:1-1", update), ("UPDATE:1-2", {**update, "filter": {
+        "transactionreference": [{"value": "1-2"}]}})])
+    interrupt(path, "UPDATE:1-1")
+    interrupt(path, "UPDATE:1-2")
+    # The gateway has the new value, so the update went through
+    api.answers["TRANSACTIONQUERY"] = {"errorcode": "0", "found": "1", "records": [
+        {"transactionreference": "1-1", "settlestatus": "2"}]}
+    jobs.run(["UPDATE:1-1"])
+    api.answers["TRANSACTIONQUERY"] = {"errorcode": "0", "found": "1", "records": [
+        {"transactionreference": "1-2", "settlestatus": "0"}]}
+    jobs.run(["UPDATE:1-2"])
+    assert states(jobs, keys) == {"UPDATE:1-1": DONE, "UPDATE:1-2": UNKNOWN}
+    assert all(r["requesttypedescriptions"] == ["TRANSACTIONQUERY"] for r in api.requests)
+
+
+def testInterruptedWithoutOrderreferenceIsUnknown(jobs, api, path):
+    keys = jobs.enqueue([("AUTH:1", {"requesttypedescriptions": ["AUTH"], "baseamount": "100"})])
+    interrupt(path, keys[0])
+    jobs.run(keys)
+    assert states(jobs, keys) == {"AUTH:1": UNKNOWN}
+    assert api.requests == []
+
+
+def testResumesAfterReopening(api, path):
+    jobs = JobQueue(api, path=path)
+    keys = jobs.enqueue([refund("1-1"), refund("1-2")])
+    jobs.close()
+    jobs = JobQueue(api, path=path)
+    assert jobs.unfinished() == 2
+    jobs.run()
+    assert states(jobs, keys) == {"REFUND:1-1": DONE, "REFUND:1-2": DONE}
+    jobs.close()
+
+
+def testUnknownJobsCanBeRetried(jobs, api, path):
+    keys = jobs.enqueue([refund("1-1"), refund("1-2")])
+    jobs.run(["REFUND:1-2"])
+    interrupt(path, keys[0])
+    api.answers["TRANSACTIONQUERY"] = {"errorcode": "0", "found": "0"}
+    jobs.run(keys)
+    # Enqueuing it again leaves it alone, it may have gone through
+    jobs.enqueue([refund("1-1")])
+    assert states(jobs, keys) == {"REFUND:1-1": UNKNOWN, "REFUND:1-2": DONE}
+    assert jobs.retry(keys) == ["REFUND:1-1"]
+    jobs.run(keys)
+    assert states(jobs, keys) == {"REFUND:1-1": DONE, "REFUND:1-2": DONE}
+    assert [r["requesttypedescriptions"][0] for r in api.requests] == ["REFUND", "TRANSACTIONQUERY", "REFUND"]
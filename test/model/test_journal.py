@@ -0,0 +1,114 @@
+import os
+from unittest.mock import patch
+from model.journal import Journal
+
+
+def query(ref):
+    return {"requesttypedescriptions": ["TRANSACTIONQUERY"], "filter": {"transactionreference": [{"value": ref}]}}
+
+
+def queryResponse(*refs):
+    return {"responses": [{"errorcode": "0", "records": [{"transactionreference": ref} for ref in refs]}]}
+
+
+def refund(ref):
+    return {"requesttypedescriptions": ["REFUND"], "parenttransactionreference": ref, "pan": "4111111111111111",
+            "securitycode": "123"}
+
+
+def segmentFiles(directory) -> list:
+    return sorted(name for name in os.listdir(directory) if name.startswith("journal-"))
+
+
+def testEntriesRotateIntoNewSegments(tmp_path):
+    journal = Journal(tmp_path, maxBytes=1000)
+    for i in range(20):
+        journal.append(query(f"1-{i}"), queryResponse(f"1-{i}"))
+    files = segmentFiles(tmp_path)
+    assert len(files) > 1
+    assert all(os.path.getsize(tmp_path / name) <= 1000 for name in files)
+    assert [e["request"]["filter"]["transactionreference"][0]["value"] for e in journal.entries()] == \
+        [f"1-{i}" for i in range(20)]
+    journal.close()
+
+
+def testLookupAndBetween(tmp_path):
+    journal = Journal(tmp_path, maxBytes=1000)
+    with patch("model.journal.time.time", side_effect=[100, 200, 300, 400]):
+        journal.append(query("1-1"), queryResponse("1-1"))
+        journal.append(query("1-2"), queryResponse("1-2"))
+        journal.append(refund("1-1"), {"responses": [{"errorcode": "0", "transactionreference": "1-3"}]})
+        journal.append(query("1-1"), queryResponse("1-1"))
+    assert [e["t"] for e in journal.lookup("1-1")] == [100, 300, 400]
+    assert [e["t"] for e in journal.lookup("1-3")] == [300]
+    assert journal.lookup("9-9") == []
+    assert [e["t"] for e in journal.between(200, 300)] == [200, 300]
+    assert journal.between(450, 500) == []
+    journal.close()
+
+
+def testIndexIsReloadedOnReopen(tmp_path):
+    journal = Journal(tmp_path, maxBytes=1000)
+    for i in range(20):
+        journal.append(query(f"1-{i}"), queryResponse(f"1-{i}"))
+    journal.close()
+    reopened = Journal(tmp_path, maxBytes=1000)
+    assert [e["request"]["filter"]["transactionreference"][0]["value"] for e in reopened.lookup("1-3")] == ["1-3"]
+    # Appends carry on in the last segment
+    reopened.append(query("1-3"), queryResponse("1-3"))
+    assert len(reopened.lookup("1-3")) == 2
+    assert len(list(reopened.entries())) == 21
+    reopened.close()
+
+
+def testTornIndexLineIsSkipped(tmp_path):
+    journal = Journal(tmp_path)
+    journal.append(query("1-1"), queryResponse("1-1"))
+    journal.close()
+    with open(tmp_path / "journal.idx", "a") as f:
+        f.write('{"s": 1, "o": ')
+    assert len(Journal(tmp_path).lookup("1-1")) == 1
+
+
+def testCardDetailsAreRedacted(tmp_path):
+    journal = Journal(tmp_path)
+    journal.append(refund("1-1"), {"responses": [{"errorcode": "0", "records": [{"expirydate": "12/30"}]}]})
+    entry = journal.lookup("1-1")[0]
+    assert entry["request"]["pan"] == "REDACTED"
+    assert entry["request"]["securitycode"] == "REDACTED"
+    assert entry["request"]["parenttransactionreference"] == "1-1"
+    assert entry["response"]["responses"][0]["records"][0]["expirydate"] == "REDACTED"
+    journal.close()
+    with open(tmp_path / segmentFiles(tmp_path)[0]) as f:
+        assert "4111111111111111" not in f.read()
+
+
+def testOnlyTheNewestSegmentsAreKept(tmp_path):
+    journal = Journal(tmp_path, maxBytes=1000, maxSegments=3)
+    for i in range(60):
+        journal.append(query(f"1-{i}"), queryResponse(f"1-{i}"))
+    files = segmentFiles(tmp_path)
+    assert len(files) == 3
+    assert files[-1] == f"journal-{journal._segment:06d}.jsonl"
+    kept = [e["request"]["filter"]["transactionreference"][0]["value"] for e in journal.entries()]
+    assert kept == [f"1-{i}" for i in range(60 - len(kept), 60)]
+    assert journal.lookup("1-0") == []
+    assert len(journal.lookup("1-59")) == 1
+    journal.close()
+    # The index only describes what's left
+    with open(tmp_path / "journal.idx") as f:
+        assert len(f.readlines()) == len(kept)
+    assert len(list(Journal(tmp_path, maxBytes=1000, maxSegments=3).entries())) == len(kept)
+
+
+def testLoweringTheCapDeletesSegmentsOnOpen(tmp_path):
+    journal = Journal(tmp_path, maxBytes=1000)
+    for i in range(60):
+        journal.append(query(f"1-{i}"), queryResponse(f"1-{i}"))
+    journal.close()
+    assert len(segmentFiles(tmp_path)) > 2
+    reopened = Journal(tmp_path, maxBytes=1000, maxSegments=2)
+    assert len(segmentFiles(tmp_path)) == 2
+    assert len(reopened.lookup("1-59")) == 1
+    assert reopened.lookup("1-0") == []
+    reopened.close()
@@ -0,0 +1,274 @@
+import threading
+import time
+from unittest.mock import patch
+import pytest
+from model.middleware import (AdaptiveConcurrencyMiddleware, CacheMiddleware, CircuitBreakerMiddleware, CircuitOpen,
+                              DeadlineExceeded, PayloadSizeMiddleware, RetryMiddleware, SingleFlightMiddleware)
+from model.fakegateway import FakeGateway
+from model.webservices import Webservices
+
+QUERY = {"requesttypedescriptions": ["TRANSACTIONQUERY"], "filter": {}}
+
+
+def queryResponse(*refs):
+    return {"responses": [{"errorcode": "0", "found": str(len(refs)),
+                           "records": [{"transactionreference": ref} for ref in refs]}]}
+
+
+class Gateway:
+    """callNext for a middleware, answering every call with response."""
+
+    def __init__(self, response, bytesSent=None, bytesReceived=None):
+        self.response = response
+        self.calls = 0
+        self.bytes = (bytesSent, bytesReceived)
+
+    def __call__(self, request, context):
+        self.calls += 1
+        if self.bytes[0] is not None:
+            context["bytesSent"], context["bytesReceived"] = self.bytes
+        else:
+            context["unmeasured"] = True
+        return self.response
+
+
+def testPayloadSizeComesFromTheTransport():
+    middleware = PayloadSizeMiddleware()
+    middleware.process(QUERY, {}, Gateway(queryResponse("1-1"), 120, 4000))
+    middleware.process(QUERY, {}, Gateway(queryResponse("1-1")))
+    middleware.process(QUERY, {}, lambda request, context: queryResponse())  # Answered without the transport
+    assert middleware.stats["TRANSACTIONQUERY"] == {"count": 1, "unmeasured": 1, "sent": 120, "received": 4000}
+
+
+def testCacheHitReturnsTheCachedResponse():
+    middleware = CacheMiddleware()
+    gateway = Gateway(queryResponse("1-1"))
+    first = middleware.process(QUERY, {}, gateway)
+    second = middleware.process(QUERY, {}, gateway)
+    assert gateway.calls == 1
+    assert second is first
+
+
+def testOtherRequestsEmptyTheCache():
+    middleware = CacheMiddleware()
+    gateway = Gateway(queryResponse("1-1"))
+    middleware.process(QUERY, {}, gateway)
+    middleware.process({"requesttypedescriptions": ["REFUND"]}, {}, Gateway({"responses": [{"errorcode": "0"}]}))
+    middleware.process(QUERY, {}, gateway)
+    assert gateway.calls == 2
+
+
+def testConcurrencyBaselineIsPerRequestType():
+    middleware = AdaptiveConcurrencyMiddleware()
+    now = [0.0]
+
+    def gateway(latency):
+        def callNext(request, context):
+            now[0] += latency
+            return {"responses": [{"errorcode": "0"}]}
+        return callNext
+    with patch("model.middleware.time.monotonic", lambda: now[0]):
+        middleware.process(QUERY, {}, gateway(0.005))
+        for _ in range(40):
+            middleware.process({"requesttypedescriptions": ["REFUND"]}, {}, gateway(0.06))
+        limit = middleware.limit
+        assert limit > 4
+        # A REFUND slower than REFUNDs have been still backs off
+        middleware.process({"requesttypedescriptions": ["REFUND"]}, {}, gateway(0.2))
+    assert middleware.limit < limit
+
+
+def testCacheHitHandsRecordsToOnRecords():
+    middleware = CacheMiddleware()
+    gateway = Gateway(queryResponse("1-1", "1-2"))
+    for _ in range(2):
+        streamed = []
+        middleware.process(QUERY, {"onRecords": streamed.extend}, lambda request, context: (
+            context["onRecords"](gateway.response["responses"][0]["records"]), gateway(request, context))[1])
+        assert [r["transactionreference"] for r in streamed] == ["1-1", "1-2"]
+
+
+def sdkError(request, context):
+    """What the securetrading SDK answers with when it can't connect."""
+    return {"responses": [{"errorcode": "7", "requesttypedescription": "ERROR"}]}
+
+
+def testSdkConnectionErrorsOpenTheCircuit():
+    middleware = CircuitBreakerMiddleware(failureThreshold=3, openSeconds=5)
+    states = []
+    middleware.listeners.append(states.append)
+    now = [0.0]
+    with patch("model.middleware.time.monotonic", lambda: now[0]):
+        for _ in range(3):
+            middleware.process(QUERY, {}, sdkError)
+        assert middleware.state == CircuitBreakerMiddleware.OPEN
+        gateway = Gateway(queryResponse())
+        with pytest.raises(CircuitOpen):
+            middleware.process(QUERY, {}, gateway)
+        assert gateway.calls == 0
+        # A failed trial opens it again for twice as long
+        now[0] += 5
+        middleware.process(QUERY, {}, sdkError)
+        now[0] += 9
+        with pytest.raises(CircuitOpen):
+            middleware.process(QUERY, {}, gateway)
+        now[0] += 1
+        middleware.process(QUERY, {}, gateway)
+    assert gateway.calls == 1
+    assert middleware.state == CircuitBreakerMiddleware.CLOSED
+    assert states == ["open", "half-open", "open", "half-open", "closed"]
+
+
+def testCircuitCountsConsecutiveFailures():
+    middleware = CircuitBreakerMiddleware(failureThreshold=3)
+
+    def unreachable(request, context):
+        raise ConnectionError("Refused")
+    for callNext in [unreachable, sdkError, Gateway(queryResponse()), unreachable, sdkError]:
+        try:
+            middleware.process(QUERY, {}, callNext)
+        except ConnectionError:
+            pass
+    assert middleware.state == CircuitBreakerMiddleware.CLOSED
+    with pytest.raises(ConnectionError):
+        middleware.process(QUERY, {}, unreachable)
+    assert middleware.state == CircuitBreakerMiddleware.OPEN
+
+
+def testOnlyOneTrialWhileHalfOpen():
+    middleware = CircuitBreakerMiddleware(failureThreshold=1, openSeconds=5)
+    now = [0.0]
+    with patch("model.middleware.time.monotonic", lambda: now[0]):
+        middleware.process(QUERY, {}, sdkError)
+        now[0] += 5
+
+        def trial(request, context):
+            # Everyone else still fails fast while the trial is out
+            with pytest.raises(CircuitOpen):
+                middleware.process(QUERY, {}, Gateway(queryResponse()))
+            return queryResponse()
+        middleware.process(QUERY, {}, trial)
+    assert middleware.state == CircuitBreakerMiddleware.CLOSED
+
+
+def testSdkConnectionErrorsBackOffTheConcurrencyLimit():
+    middleware = AdaptiveConcurrencyMiddleware(initialLimit=8)
+    for _ in range(3):
+        middleware.process(QUERY, {}, sdkError)
+    assert middleware.limit < 4
+
+
+def testSdkConnectionErrorsAreRetried():
+    middleware = RetryMiddleware()
+    answers = [sdkError(None, None), sdkError(None, None), queryResponse("1-1")]
+    calls = []
+
+    def gateway(request, context):
+        calls.append(request)
+        return answers[len(calls) - 1]
+    with patch("model.middleware.time.sleep"):
+        assert middleware.process(QUERY, {}, gateway) is answers[2]
+        # Not a REFUND, it may have gone through
+        calls.clear()
+        answers[0] = sdkError(None, None)
+        refund = middleware.process({"requesttypedescriptions": ["REFUND"]}, {}, gateway)
+    assert refund["responses"][0]["errorcode"] == "7"
+    assert len(calls) == 1
+
+
+def testUnreachableGatewayThroughTheDefaultPipeline():
+    gateway = FakeGateway()
+    api = Webservices(gateway=gateway)
+    api.login("user", "pass")
+    gateway.outage(60)
+    calls = gateway.calls
+    with patch("model.middleware.time.sleep"):
+        response = api.makeRequest(QUERY)
+        assert response["responses"][0]["errorcode"] == "7"
+        assert gateway.calls - calls == 3
+        # The fifth failure in a row opens the circuit part way through the next request's retries
+        for value in ["1", "2"]:
+            with pytest.raises(CircuitOpen):
+                api.makeRequest({**QUERY, "filter": {"orderreference": [{"value": value}]}})
+    assert gateway.calls - calls == 5
+
+
+def concurrently(count, func) -> list:
+    """Run func on count threads at once, returning what each returned or raised."""
+    results = [None] * count
+    start = threading.Barrier(count)
+
+    def run(i):
+        start.wait()
+        try:
+            results[i] = func()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def testSingleFlightMergesIdenticalQueries():
+    gateway = FakeGateway(latency=0.2)
+    gateway.record(QUERY, queryResponse("1-1"))
+    api = Webservices(middlewares=[SingleFlightMiddleware()], gateway=gateway)
+    api.login("user", "pass")
+    calls = gateway.calls
+    responses = concurrently(8, lambda: api.makeRequest(QUERY))
+    assert gateway.calls - calls == 1
+    assert all(r is responses[0] for r in responses)
+    middleware = api.findMiddleware(SingleFlightMiddleware)
+    assert middleware.saved == 7
+    # Once it's back the next one goes to the gateway again
+    api.makeRequest(QUERY)
+    assert gateway.calls - calls == 2
+
+
+def testSingleFlightNeverMergesOtherRequests():
+    gateway = FakeGateway(latency=0.1)
+    api = Webservices(middlewares=[SingleFlightMiddleware()], gateway=gateway)
+    api.login("user", "pass")
+    calls = gateway.calls
+    refund = {"requesttypedescriptions": ["REFUND"], "parenttransactionreference": "1-1"}
+    concurrently(4, lambda: api.makeRequest(refund))
+    # Nor streamed queries that don't keep their records
+    concurrently(4, lambda: api.makeRequest(QUERY, onRecords=lambda records: None, keepRecords=False))
+    assert gateway.calls - calls == 8
+
+
+def testSingleFlightSharesTheException():
+    middleware = SingleFlightMiddleware()
+    calls = []
+
+    def unreachable(request, context):
+        calls.append(request)
+        time.sleep(0.2)
+        raise ConnectionError("Refused")
+    results = concurrently(4, lambda: middleware.process(QUERY, {}, unreachable))
+    assert len(calls) == 1
+    assert all(isinstance(r, ConnectionError) for r in results)
+    assert len({id(r) for r in results}) == 1
+
+
+def testSingleFlightFollowerGivesUpAtItsDeadline():
+    middleware = SingleFlightMiddleware()
+    released = threading.Event()
+
+    def slow(request, context):
+        released.wait(5)
+        return queryResponse("1-1")
+    leader = threading.Thread(target=lambda: middleware.process(QUERY, {}, slow))
+    leader.start()
+    while not middleware._flights:
+        time.sleep(0.001)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        middleware.process(QUERY, {"deadline": time.monotonic() + 0.1}, slow)
+    assert time.monotonic() - started < 1
+    released.set()
+    leader.join()
+    assert middleware.calls == 1 and middleware.saved == 1
@@ -0,0 +1,85 @@
+import datetime
+import pytest
+from model.reconciliation import Reconciler
+from model.transactionstore import TransactionStore
+
+
+def record(ref, day, settlestatus="100", settlebaseamount="1000"):
+    return {"transactionreference": ref, "requesttypedescription": "AUTH", "sitereference": "test_site12345",
+            "settlestatus": settlestatus, "settlebaseamount": settlebaseamount,
+            "transactionstartedtimestamp": f"{day} 10:00:00"}
+
+
+class Api:
+    """Answers each day's TRANSACTIONQUERY from records, a list of gateway records."""
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    def makeRequest(self, request):
+        day = request["filter"]["starttimestamp"][0]["value"][:10]
+        self.queries.append(day)
+        records = [dict(r) for r in self.records if r["transactionstartedtimestamp"].startswith(day)]
+        return {"responses": [{"errorcode": "0", "found": str(len(records)), "records": records}]}
+
+
+DAYS = [datetime.date(2021, 12, 1) + datetime.timedelta(days=i) for i in range(3)]
+RECORDS = [record(f"1-{d.day}-{i}", d) for d in DAYS for i in range(50)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = TransactionStore(budget=1, spillDirectory=str(tmp_path))  # Every raw record spilled
+    store.add([dict(r) for r in RECORDS])
+    return store
+
+
+@pytest.fixture(autouse=True)
+def state(tmp_path, monkeypatch):
+    monkeypatch.setenv("WS_RECONCILE_STATE", str(tmp_path / "reconciled.json"))
+
+
+def testMatchingDaysDontReadSpilledRecords(store):
+    api = Api(RECORDS)
+    reloads = store.reloads
+    report = Reconciler(api, store).reconcile(DAYS[0], DAYS[-1])
+    assert set(report["days"].values()) == {"verified"}
+    assert store.reloads == reloads
+    # Verified and long closed, so not queried again
+    report = Reconciler(api, store).reconcile(DAYS[0], DAYS[-1])
+    assert set(report["days"].values()) == {"skipped"}
+    assert store.reloads == reloads
+
+
+def testOnlyChangedRecordsAreReadBack(store):
+    gateway = [dict(r) for r in RECORDS]
+    gateway[0]["settlestatus"] = "3"
+    gateway.append(record("1-1-new", DAYS[0]))
+    reloads = store.reloads
+    report = Reconciler(Api(gateway), store).reconcile(DAYS[0], DAYS[-1], apply=True)
+    assert report["days"][str(DAYS[0])] == "differs"
+    assert report["changed"] == [("1-1-0", "settlestatus", "100", "3")]
+    assert report["missing"] == ["1-1-new"]
+    assert store.reloads - reloads == 1
+    assert store.get("1-1-0")["settlestatus"] == "3"
+    assert "1-1-new" in store
+
+
+def testFilterMatchesParsedFields(store):
+    store.add([{**record("2-1-0", DAYS[0]), "sitereference": "other_site"}])
+    api = Api(RECORDS)
+    reloads = store.reloads
+    report = Reconciler(api, store).reconcile(DAYS[0], DAYS[0], {"sitereference": [{"value": "test_site12345"}]})
+    assert report["days"][str(DAYS[0])] == "verified"
+    assert store.reloads == reloads
+
+
+def testRecordWithBothFieldsChangedIsReportedOnce(store):
+    gateway = [dict(r) for r in RECORDS]
+    gateway[0].update(settlestatus="3", settlebaseamount="0")
+    report = Reconciler(Api(gateway), store).reconcile(DAYS[0], DAYS[0])
+    assert len(report["changed"]) == 2
+    assert [r["transactionreference"] for r in report["records"]] == ["1-1-0"]
+    # Not applied without apply
+    assert store.get("1-1-0")["settlestatus"] == "100"
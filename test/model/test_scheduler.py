@@ -0,0 +1,78 @@
+import datetime
+import pytest
+from model.jobqueue import DONE, FAILED, JobQueue
+from model.scheduler import Scheduler, advance
+
+
+class Api:
+    """Answers AUTHs with a new transaction, or with failing's errorcode for the dues listed in it."""
+
+    def __init__(self):
+        self.requests = []
+        self.failing = set()
+
+    def makeRequest(self, request):
+        self.requests.append(request)
+        if request["orderreference"] in self.failing:
+            return {"responses": [{"errorcode": "70000", "errormessage": "Decline"}]}
+        return {"responses": [{"errorcode": "0", "transactionreference": f"2-{len(self.requests)}"}]}
+
+
+@pytest.fixture
+def api():
+    return Api()
+
+
+@pytest.fixture
+def scheduler(api, tmp_path):
+    jobs = JobQueue(api, path=str(tmp_path / "jobs.sqlite3"), workers=2)
+    scheduler = Scheduler(jobs, path=str(tmp_path / "schedule.sqlite3"))
+    yield scheduler
+    scheduler.close()
+    jobs.close()
+
+
+def dues(scheduler):
+    return sorted(run["due"] for run in scheduler.history() if run["state"] == DONE)
+
+
+def testAdvanceClampsMonthEnds():
+    assert advance(datetime.date(2021, 1, 31), "MONTH", 1) == datetime.date(2021, 2, 28)
+    assert advance(datetime.date(2021, 11, 30), "MONTH", 3) == datetime.date(2022, 2, 28)
+    assert advance(datetime.date(2021, 3, 31), "MONTH", -1) == datetime.date(2021, 2, 28)
+    assert advance(datetime.date(2021, 1, 31), "DAY", 7) == datetime.date(2021, 2, 7)
+
+
+def testMonthEndSubscriptionsDontDrift(scheduler):
+    scheduler.add("1-1", "site", "500", "GBP", "MONTH", 1, datetime.date(2021, 7, 31))
+    scheduler.run(today=datetime.date(2021, 12, 31))
+    assert dues(scheduler) == ["2021-07-31", "2021-08-31", "2021-09-30", "2021-10-31", "2021-11-30", "2021-12-31"]
+    assert scheduler.subscriptions()[0]["nextdue"] == "2022-01-31"
+
+
+def testRunningTwiceChargesOnce(scheduler, api):
+    scheduler.add("1-1", "site", "500", "GBP", "DAY", 7, datetime.date(2021, 7, 1))
+    scheduler.run(today=datetime.date(2021, 7, 10))
+    scheduler.run(today=datetime.date(2021, 7, 10))
+    assert len(api.requests) == 2
+    assert [r["subscriptionnumber"] for r in api.requests] == ["2", "3"]
+    assert all(r["credentialsonfile"] == "2" and r["parenttransactionreference"] == "1-1" for r in api.requests)
+
+
+def testFailedChargeStaysDue(scheduler, api):
+    id = scheduler.add("1-1", "site", "500", "GBP", "MONTH", 1, datetime.date(2021, 7, 31))
+    api.failing.add(f"RECUR-{id}-2021-08-31")
+    scheduler.run(today=datetime.date(2021, 9, 1))
+    assert dues(scheduler) == ["2021-07-31"]
+    assert [run["state"] for run in scheduler.history() if run["due"] == "2021-08-31"] == [FAILED]
+    api.failing.clear()
+    scheduler.run(today=datetime.date(2021, 9, 30))
+    assert dues(scheduler) == ["2021-07-31", "2021-08-31", "2021-09-30"]
+
+
+def testCancelledSubscriptionsArentCharged(scheduler, api):
+    id = scheduler.add("1-1", "site", "500", "GBP", "MONTH", 1, datetime.date(2021, 7, 31))
+    scheduler.cancel(id)
+    scheduler.run(today=datetime.date(2021, 9, 1))
+    assert api.requests == []
+    assert scheduler.subscriptions() == []
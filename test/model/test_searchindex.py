@@ -0,0 +1,68 @@
+from concurrent.futures import Future
+import numpy as np
+from model.searchindex import SearchIndex
+from model.transaction import Transaction
+
+
+def transaction(ref, name):
+    return Transaction({"transactionreference": ref, "billingfirstname": name})
+
+
+def testReplacedRecordsGetNewIds():
+    index = SearchIndex()
+    index.added([transaction("1-1", "alice"), transaction("1-2", "bob")])
+    ids, generation = index.idsOf(["1-1", "1-2"]), index.generation
+    assert index.search("alice")[ids].tolist() == [True, False]
+    # Another tab loading a newer version of 1-1
+    index.added([transaction("1-1", "alice")])
+    assert index.generation != generation
+    assert not index.search("alice")[ids].any()
+    assert index.search("alice")[index.idsOf(["1-1", "1-2"])].tolist() == [True, False]
+
+
+def testUnknownReferencesNeverMatch():
+    index = SearchIndex()
+    index.added([transaction("1-1", "alice")])
+    assert not np.any(index.search("alice")[index.idsOf(["9-9"])])
+
+
+class Ingestor:
+    """Tokenises chunks of two when told to, rather than in worker processes."""
+
+    def __init__(self):
+        self.work = []
+
+    def wants(self, size):
+        return True
+
+    def map(self, func, items):
+        chunks = []
+        for start in range(0, len(items), 2):
+            future = Future()
+            self.work.append((future, func, items[start:start + 2]))
+            chunks.append((start, future))
+        return chunks
+
+    def finish(self, count):
+        for future, func, items in self.work[:count]:
+            future.set_result(func(items))
+        self.work = self.work[count:]
+
+
+def testSearchDoesntWaitForWorkerSegments():
+    ingestor = Ingestor()
+    index = SearchIndex(ingestor)
+    arrived = []
+    index.listeners.append(lambda: arrived.append(True))
+    rows = [transaction(f"1-{i}", "alice") for i in range(5)]
+    index.added(rows)
+    assert index.pending == 5
+    assert not index.search("alice").any()
+    ingestor.finish(1)
+    assert arrived == [True]
+    assert index.pending == 3
+    ids = index.idsOf(t.transactionreference for t in rows)
+    assert index.search("alice")[ids].tolist() == [True, True, False, False, False]
+    ingestor.finish(2)
+    assert index.pending == 0
+    assert index.search("alice")[ids].all()
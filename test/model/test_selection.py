@@ -0,0 +1,45 @@
+import numpy as np
+from model.selection import Selection
+from model.transaction import Transaction
+
+
+def transaction(ref, refundable=True):
+    return Transaction({"transactionreference": ref, "requesttypedescription": "AUTH",
+                        "settlestatus": "100" if refundable else "0", "baseamount": "100"})
+
+
+def prefixOf(rows):
+    prefix = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([t.isRefundable for t in rows], out=prefix[1:])
+    return prefix
+
+
+def refs(transactions):
+    return [t.transactionreference for t in transactions]
+
+
+def testRangesAreMergedAndIndexed():
+    rows = [transaction(str(i)) for i in range(10)]
+    selection = Selection(rows, [(5, 6), (0, 1), (2, 3), (8, 8)])
+    assert selection.ranges == [(0, 3), (5, 6), (8, 8)]
+    assert len(selection) == 7
+    assert refs(selection) == ["0", "1", "2", "3", "5", "6", "8"]
+    assert selection[4].transactionreference == "5"
+    assert selection[-1].transactionreference == "8"
+
+
+def testRefundableInRanges():
+    rows = [transaction("a"), transaction("b", False), transaction("c"), transaction("d", False), transaction("e")]
+    selection = Selection(rows, [(0, 3)], prefixOf(rows))
+    assert selection.refundableCount() == 2
+    assert refs(selection.refundable()) == ["a", "c"]
+    assert refs(Selection(rows, [(1, 1), (3, 4)]).refundable()) == ["e"]
+
+
+def testRowsChangingAfterwardsDontChangeTheSelection():
+    rows = [transaction("a"), transaction("b", False), transaction("c"), transaction("d", False)]
+    selection = Selection(rows, [(0, 3)], prefixOf(rows))
+    # The table replaces its rows, e.g. a prefetched transaction is shown first
+    rows = [transaction("new", False)] + rows
+    assert refs(selection.refundable()) == ["a", "c"]
+    assert refs(selection) == ["a", "b", "c", "d"]
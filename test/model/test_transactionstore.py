@@ -0,0 +1,54 @@
+import pytest
+from model import spillfile
+from model.spillfile import SpillFile
+from model.transactionstore import TransactionStore
+
+
+def record(i, settlestatus="100"):
+    return {"transactionreference": f"1-{i}", "requesttypedescription": "AUTH", "settlestatus": settlestatus,
+            "baseamount": str(100 + i), "billingfirstname": "Jane", "transactionstartedtimestamp": "2021-12-01 10:00:00"}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = TransactionStore(budget=1, spillDirectory=str(tmp_path))  # Only the last record used stays in memory
+    store.add([record(i) for i in range(200)])
+    return store
+
+
+def testReadingSpilledRecordsDoesntGrowTheSpillFile(store):
+    sizes = []
+    for _ in range(5):
+        for i in range(200):
+            assert store.get(f"1-{i}")["baseamount"] == str(100 + i)
+        sizes.append(store.residency()["spillFileBytes"])
+    assert store.reloads >= 5 * 199
+    # Each record is written once, the last one added when it's first pushed out
+    assert sizes == [sizes[0]] * 5
+    assert store.residency()["spillLiveBytes"] == sizes[0]
+
+
+def testChangedRecordsAreSpilledAgain(store):
+    store.update({"1-0": {"settlestatus": "3"}})
+    store.add([record(1, settlestatus="0")])
+    store.get("1-2")  # Pushes the others out again
+    assert store.get("1-0")["settlestatus"] == "3"
+    assert store.get("1-1")["settlestatus"] == "0"
+
+
+def testSpillFileCompactsOnceMostlyGarbage(tmp_path, monkeypatch):
+    monkeypatch.setattr(spillfile, "COMPACT_MIN_BYTES", 0)
+    spill = SpillFile(str(tmp_path))
+    for i in range(10):
+        spill.write(f"1-{i}", record(i))
+    live = spill.size
+    for _ in range(5):
+        spill.write("1-0", record(0, settlestatus="3"))
+    assert spill.compactions == 0
+    for i in range(1, 10):
+        spill.write(f"1-{i}", record(i, settlestatus="3"))
+    assert spill.compactions == 1
+    assert spill.size < 2 * live
+    assert spill.liveBytes <= spill.size
+    assert [spill.read(f"1-{i}")["settlestatus"] for i in range(10)] == ["3"] * 10
+    assert spill.read("1-7")["baseamount"] == "107"
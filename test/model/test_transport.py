@@ -0,0 +1,47 @@
+import json
+import pytest
+from model.transport import RecordStreamParser
+
+RECORDS = [{"transactionreference": f"1-{i}", "billingfirstname": "Zoë \"Z\" [x]", "errordata": [], "n": {"a": i}}
+           for i in range(20)]
+DOCUMENT = {"requestreference": "W1", "version": "1.00", "response": [
+    {"errorcode": "0", "found": "20", "records": RECORDS, "requesttypedescription": "TRANSACTIONQUERY"},
+    {"errorcode": "0", "errordata": ["{records}"], "requesttypedescription": "AUTH"}]}
+
+
+def feed(parser, body: bytes, size: int) -> list:
+    records = []
+    for start in range(0, len(body), size):
+        records += parser.feed(body[start:start + size])
+    return records
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, 1 << 20])
+def testRecordsComeOutAsTheyArrive(size):
+    body = json.dumps(DOCUMENT, ensure_ascii=False).encode()
+    parser = RecordStreamParser()
+    assert feed(parser, body, size) == RECORDS
+    assert parser.finish() == DOCUMENT
+
+
+def testWithoutKeepingRecords():
+    parser = RecordStreamParser(keepRecords=False)
+    assert feed(parser, json.dumps(DOCUMENT, indent=2).encode(), 5) == RECORDS
+    document = parser.finish()
+    assert document["response"][0]["records"] == []
+    assert document["response"][1] == DOCUMENT["response"][1]
+
+
+def testOnlyGatewayRecordsArrays():
+    document = {"response": [{"errorcode": "0", "extra": {"records": [{"a": 1}]}}]}
+    parser = RecordStreamParser()
+    assert feed(parser, json.dumps(document).encode(), 3) == []
+    assert parser.finish() == document
+
+
+def testTruncatedBody():
+    body = json.dumps(DOCUMENT).encode()
+    parser = RecordStreamParser()
+    parser.feed(body[:len(body) // 2])
+    with pytest.raises(ValueError):
+        parser.finish()
@@ -0,0 +1,54 @@
+import os
+import pytest
+from PySide6.QtCore import QItemSelectionModel
+from PySide6.QtWidgets import QApplication
+from model.searchindex import SearchIndex
+from model.transaction import Transaction
+from view.transactiontable import TransactionTable
+
+
+@pytest.fixture
+def table():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")  # No display needed
+    app = QApplication.instance() or QApplication([])
+    table = TransactionTable()
+    yield table
+    table.deleteLater()
+
+
+def transactions(*numbers):
+    return [Transaction({"transactionreference": f"1-{i}", "billingfirstname": "odd" if i % 2 else "even",
+                         "transactionstartedtimestamp": f"2021-12-01 10:{i:02d}:00"}) for i in numbers]
+
+
+def selected(table) -> list:
+    return sorted(t.transactionreference for t in table.selection())
+
+
+def select(table, *rows):
+    for row in rows:
+        table.selectionModel().select(table.tableModel.index(row, 0),
+                                      QItemSelectionModel.Select | QItemSelectionModel.Rows)
+
+
+def testSelectionSurvivesMoreRowsArriving(table):
+    table.populate(transactions(1, 2, 3))
+    select(table, 0, 2)  # Newest first, 1-3 and 1-1
+    table.selectionModel().setCurrentIndex(table.tableModel.index(2, 0), QItemSelectionModel.NoUpdate)
+    table.populate(transactions(4, 5))
+    assert selected(table) == ["1-1", "1-3"]
+    assert table.transactionAt(table.currentIndex()).transactionreference == "1-1"
+    table.refresh()
+    assert selected(table) == ["1-1", "1-3"]
+
+
+def testFilterKeepsTheSelectedRowsStillShown(table):
+    rows = transactions(1, 2, 3, 4)
+    index = SearchIndex()
+    index.added(rows)
+    table.populate(rows)
+    select(table, 0, 1)  # 1-4 and 1-3
+    table.setFilter(index.search("odd"), index)
+    assert selected(table) == ["1-3"]
+    table.setFilter(None, index)
+    assert selected(table) == ["1-3"]
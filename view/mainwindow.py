@@ -1,8 +1,10 @@
 from lib.requesttype import RequestType
+from PySide6.QtCore import Signal
 from PySide6.QtWidgets import (
     QMainWindow, QLabel, QPushButton, QLineEdit, QHBoxLayout,
-    QVBoxLayout, QWidget)
+    QTabWidget, QVBoxLayout, QWidget)
 from lib.logger import createLogger
+from view.summarypanel import SummaryPanel
 from view.transactiontable import TransactionTable
 from dotenv import load_dotenv
 import os
@@ -15,14 +17,37 @@ class WSMain(QMainWindow):
     """
     Main application window.
     """
+    # Emitted with the gateway circuit breaker state, safe to emit from any thread
+    gatewayStateChanged = Signal(str)
+    # Emitted from the prefetch thread with (prefetcher, records) per chunk and (prefetcher, error) at the end
+    recordsPrefetched = Signal(object, list)
+    prefetchDone = Signal(object, object)
+    # Emitted from the transport's thread with each change pushed by the cache daemon
+    updatesPushed = Signal(dict)
+    # Emitted from the bulk update thread with (done, total, changes) per batch and (keys, error) at the end
+    updateProgress = Signal(int, int, dict)
+    updatesDone = Signal(list, object)
+    # Emitted from the billing run thread with (done, total) per batch and (keys, error) at the end
+    billingProgress = Signal(int, int)
+    billingDone = Signal(list, object)
+    # Emitted from the reconciliation thread with (report, error) at the end
+    reconcileDone = Signal(object, object)
+    # Emitted from the thread resuming unfinished jobs with (keys, error) at the end, updates go through updateProgress
+    resumeDone = Signal(list, object)
+    # Emitted from the ingestion workers' thread as each segment of a large batch becomes searchable
+    searchIndexed = Signal()
+    # Emitted with the TransactionTable of each new tab
+    tableAdded = Signal(object)
 
     def __init__(self):
         log.debug("calling __init__")
         super().__init__()
         self._configure()
+        self._addMenu()
         self._addLogin()
         self._addTable()
         self._addButtons()
+        self._addStatusBar()
         log.debug("calling show")
         self.show()
 
@@ -38,9 +63,33 @@ class WSMain(QMainWindow):
             for i in inputs:
                 i.setDisabled(False)
             button.setText("Login")
+            self.searchInput.clear()
+            while self.tabs.count() > 1:
+                self.closeTab(self.tabs.count() - 1)
+            self.tabs.setTabText(0, "Recent")
             self.table.clear()
         log.debug("toggleLogin returning")
 
+    @property
+    def table(self) -> TransactionTable:
+        """The table of the current tab."""
+        return self.tabs.currentWidget()
+
+    def tables(self) -> list:
+        return [self.tabs.widget(i) for i in range(self.tabs.count())]
+
+    def newTab(self, title) -> TransactionTable:
+        """Add a tab with an empty table, make it the current one and return its table."""
+        table = TransactionTable()
+        self.tabs.setCurrentIndex(self.tabs.addTab(table, title))
+        self.tableAdded.emit(table)
+        return table
+
+    def closeTab(self, index):
+        table = self.tabs.widget(index)
+        self.tabs.removeTab(index)
+        table.deleteLater()
+
     # PRIVATE METHODS-------------------------------------------------------------------------------------------------
     def _configure(self):
         """Configure the main window geometry, layout and title."""
@@ -54,6 +103,19 @@ class WSMain(QMainWindow):
         centralWidget.setLayout(self.layout)
         log.debug("_configure returning")
 
+    def _addMenu(self):
+        """Create the menu bar."""
+        log.debug("_addMenu called")
+        toolsMenu = self.menuBar().addMenu("Tools")
+        self.reconcileAction = toolsMenu.addAction("Reconcile...")
+        self.scheduleAction = toolsMenu.addAction("Recurring charges...")
+        debugMenu = self.menuBar().addMenu("Debug")
+        self.profileAction = debugMenu.addAction("Profile actions")
+        self.profileAction.setCheckable(True)
+        self.profileAction.setChecked(os.environ.get("WS_PROFILE", "0") == "1")
+        self.residencyAction = debugMenu.addAction("Store memory...")
+        log.debug("_addMenu returning")
+
     def _addLogin(self):
         """Create and add the login section to the main window."""
         log.debug("_addLogin called")
@@ -72,20 +134,42 @@ class WSMain(QMainWindow):
         log.debug("_addLogin returning")
 
     def _addTable(self):
-        """Create and add the transaction table to the main window."""
+        """Create and add the transaction tabs, one table of results each, to the main window."""
         log.debug("_addTable called")
+        self.searchInput = QLineEdit()
+        self.searchInput.setPlaceholderText("Search name, e-mail, postcode, order ref., card number or reference")
+        self.searchInput.setClearButtonEnabled(True)
+        self.layout.addWidget(self.searchInput)
         layout = QHBoxLayout()
-        table = TransactionTable()
-        layout.addWidget(table)
+        self.tabs = QTabWidget()
+        self.tabs.setTabsClosable(True)
+        self.tabs.setMovable(True)
+        self.tabs.addTab(TransactionTable(), "Recent")
+        layout.addWidget(self.tabs)
+        self.summary = SummaryPanel()
+        layout.addWidget(self.summary)
         self.layout.addLayout(layout)
-        self.table = table
         log.debug("_addTable returning")
 
+    def _addStatusBar(self):
+        """Create the status bar showing the gateway's health."""
+        log.debug("_addStatusBar called")
+        self.gatewayStatus = QLabel()
+        self.statusBar().addPermanentWidget(self.gatewayStatus)
+        self.gatewayStateChanged.connect(self._showGatewayState)
+        self._showGatewayState("closed")
+        log.debug("_addStatusBar returning")
+
+    def _showGatewayState(self, state):
+        text = {"closed": "Gateway OK", "open": "Gateway unavailable, failing fast", "half-open": "Gateway recovering..."}
+        self.gatewayStatus.setText(text.get(state, state))
+        self.gatewayStatus.setStyleSheet("" if state == "closed" else "color:red;")
+
     def _addButtons(self):
         """Create and add the button section to the main window."""
         log.debug("_addButtons called")
         layout = QHBoxLayout()
-        buttons = [rt.name for rt in RequestType if rt.name not in ["NONE", "TRANSACTIONUPDATE"]]
+        buttons = [rt.name for rt in RequestType if rt.name not in ["NONE"]]
         self.requestButtons = {}
         for b in buttons:
             btn = QPushButton(b)
@@ -0,0 +1,27 @@
+from PySide6.QtCore import Qt
+from PySide6.QtWidgets import QCalendarWidget, QCheckBox, QDialog, QHBoxLayout, QLabel, QPlainTextEdit, QPushButton, \
+    QVBoxLayout
+
+
+class ReconcileWindow(QDialog):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Reconcile with gateway")
+        self.layout = QVBoxLayout()
+        self.setLayout(self.layout)
+        self.layout.addWidget(QLabel("""Select the first and last day to compare the loaded transactions against the gateway.
+            Days already verified and fully settled are not queried again."""))
+        dates = QHBoxLayout()
+        self.startInput = QCalendarWidget()
+        self.endInput = QCalendarWidget()
+        dates.addWidget(self.startInput)
+        dates.addWidget(self.endInput)
+        self.layout.addLayout(dates)
+        self.applyInput = QCheckBox("Update local transactions from the gateway")
+        self.layout.addWidget(self.applyInput)
+        self.reconcileButton = QPushButton("Reconcile")
+        self.reconcileButton.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        self.layout.addWidget(self.reconcileButton)
+        self.reportOutput = QPlainTextEdit()
+        self.reportOutput.setReadOnly(True)
+        self.layout.addWidget(self.reportOutput)
@@ -1,9 +1,11 @@
 from PySide6.QtCore import Qt
 from PySide6.QtWidgets import QDialog, QVBoxLayout, QCalendarWidget, QHBoxLayout, QComboBox, QLineEdit, QPushButton, \
-    QLabel, QWidget, QTableWidget, QTableWidgetItem, QTableView
+    QLabel, QWidget, QTableWidget, QTableWidgetItem, QTableView, QFileDialog
 from lib.logger import createLogger
+from lib.profiling import profiled
 from lib.requesttype import RequestType
 from lib.config import Config
+from model.bulkupdate import UPDATABLE_FIELDS
 
 log = createLogger(__name__)
 
@@ -12,6 +14,7 @@ cfg = Config()
 
 # noinspection PyArgumentList
 class RequestWindow(QDialog):
+    @profiled
     def __init__(self, requestType: RequestType, transactions):
         super().__init__()
         log.debug(f"Creating a new {requestType.name} window")
@@ -30,6 +33,8 @@ class RequestWindow(QDialog):
             self._addDatePicker()
         elif requestType == RequestType.REFUND and len(self.transactions) > 0:
             self._addBatchRefundComponents()
+        elif requestType == RequestType.TRANSACTIONUPDATE:
+            self._addBulkUpdateComponents()
         elif requestType in [
             RequestType.AUTH,
             RequestType.REFUND,
@@ -40,7 +45,7 @@ class RequestWindow(QDialog):
         self.buttonRow = QHBoxLayout()
         self.layout.addLayout(self.buttonRow)
 
-        if (not (requestType == RequestType.REFUND and len(self.transactions))) and (not requestType == RequestType.ACCOUNTCHECK) > 0:
+        if (not (requestType == RequestType.REFUND and len(self.transactions))) and (not requestType in [RequestType.ACCOUNTCHECK, RequestType.TRANSACTIONUPDATE]) > 0:
             self._addNewFieldButton()
         self._addSubmitButton()
         if requestType == RequestType.CUSTOM:
@@ -79,17 +84,14 @@ class RequestWindow(QDialog):
                 self.layout.addLayout(row)
 
     def _addBatchRefundComponents(self):
-        transactions = [t for t in self.transactions if
-                        t["requesttypedescription"] == "AUTH" and t["settlestatus"] == "100"]
-        # Show a table with the remaining transactions, doubleclickable and selectable
+        # Show a table with the refundable transactions, doubleclickable and selectable
         self.resize(600, 400)
-        self.table = QTableWidget(0, 3)
+        self.table = QTableWidget(self.transactions.refundableCount(), 3)
         self.table.setSelectionBehavior(QTableView.SelectRows)
         self.table.setHorizontalHeaderLabels(["parenttransactionreference", "baseamount", "customername"])
-        for index, transaction in enumerate(transactions):
-            self.table.insertRow(index)
-            ref = QTableWidgetItem(transaction["transactionreference"])
-            amount = QTableWidgetItem(transaction["baseamount"])
+        for index, transaction in enumerate(self.transactions.refundable()):
+            ref = QTableWidgetItem(transaction.transactionreference)
+            amount = QTableWidgetItem(transaction.get("baseamount"))
             customerName = QTableWidgetItem(
                 f"{transaction.get('billingfirstname', '')} {transaction.get('billinglastname', '')}")
             for i, w in enumerate([ref, amount, customerName]):
@@ -98,6 +100,36 @@ class RequestWindow(QDialog):
         self.table.resizeColumnsToContents()
         self.layout.addWidget(self.table)
 
+    def _addBulkUpdateComponents(self):
+        # Without a selection a single transaction is given by reference, or a file of them is loaded
+        if len(self.transactions) > 0:
+            self.layout.addWidget(QLabel(f"Update the {len(self.transactions)} selected transactions"))
+        else:
+            self._addRequiredFields()
+        self.updateInputs = {}
+        for field in UPDATABLE_FIELDS:
+            row = QHBoxLayout()
+            fieldInput = QLineEdit()
+            fieldInput.setPlaceholderText("unchanged")
+            self.updateInputs[field] = fieldInput
+            row.addWidget(QLabel(field))
+            row.addWidget(fieldInput)
+            self.layout.addLayout(row)
+        self.updateFile = None
+        row = QHBoxLayout()
+        self.updateFileLabel = QLabel("or load transactionreference, sitereference and new values from a CSV file")
+        fileButton = QPushButton("Load file...", clicked=self._chooseUpdateFile)
+        fileButton.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        row.addWidget(self.updateFileLabel)
+        row.addWidget(fileButton)
+        self.layout.addLayout(row)
+
+    def _chooseUpdateFile(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Load updates", "", "CSV files (*.csv)")
+        if path:
+            self.updateFile = path
+            self.updateFileLabel.setText(f"Updates from {path}, the fields above are ignored")
+
     def _addDropdownRow(self, fields):
         rowCount = len(self.findChildren(QWidget, options=Qt.FindDirectChildrenOnly))
         row = QWidget(parent=self, objectName="requestRow")
@@ -0,0 +1,66 @@
+from PySide6.QtCore import Qt, QDate
+from PySide6.QtWidgets import QComboBox, QDateEdit, QDialog, QHBoxLayout, QHeaderView, QLabel, QLineEdit, \
+    QPlainTextEdit, QPushButton, QSpinBox, QTableWidget, QTableWidgetItem, QTableView, QVBoxLayout
+from model.scheduler import UNITS
+
+COLUMNS = ["id", "parenttransactionreference", "sitereference", "baseamount", "currencyiso3a", "nextdue", "payments"]
+
+
+class ScheduleWindow(QDialog):
+    def __init__(self, selected: int):
+        super().__init__()
+        self.setWindowTitle("Recurring charges")
+        self.resize(900, 700)
+        self.layout = QVBoxLayout()
+        self.setLayout(self.layout)
+        self.table = QTableWidget(0, len(COLUMNS) + 1)
+        self.table.setHorizontalHeaderLabels(COLUMNS + ["every"])
+        self.table.setSelectionBehavior(QTableView.SelectRows)
+        self.table.setEditTriggers(QTableView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.layout.addWidget(self.table)
+        self.cancelButton = QPushButton("Cancel selected subscriptions")
+        self.layout.addWidget(self.cancelButton)
+        # New subscriptions, on the stored credentials of the transactions selected in the main table
+        row = QHBoxLayout()
+        self.amountInput = QLineEdit()
+        self.amountInput.setPlaceholderText("baseamount")
+        self.currencyInput = QLineEdit()
+        self.currencyInput.setPlaceholderText("currencyiso3a")
+        self.countInput = QSpinBox()
+        self.countInput.setRange(1, 366)
+        self.unitInput = QComboBox()
+        self.unitInput.addItems(UNITS)
+        self.unitInput.setCurrentText("MONTH")
+        self.firstDueInput = QDateEdit(QDate.currentDate().addMonths(1))
+        self.firstDueInput.setCalendarPopup(True)
+        for w in [self.amountInput, self.currencyInput, QLabel("every"), self.countInput, self.unitInput,
+                  QLabel("from"), self.firstDueInput]:
+            row.addWidget(w)
+        self.layout.addLayout(row)
+        self.addButton = QPushButton(f"Add for the {selected} selected transactions")
+        self.addButton.setEnabled(selected > 0)
+        self.layout.addWidget(self.addButton)
+        self.runButton = QPushButton("Run due charges now")
+        self.layout.addWidget(self.runButton)
+        self.historyOutput = QPlainTextEdit()
+        self.historyOutput.setReadOnly(True)
+        self.layout.addWidget(self.historyOutput)
+        for button in [self.cancelButton, self.addButton, self.runButton]:
+            button.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+
+    def display(self, subscriptions: list, history: list):
+        self.table.setRowCount(len(subscriptions))
+        for index, subscription in enumerate(subscriptions):
+            values = [str(subscription[c]) for c in COLUMNS] + [f"{subscription['count']} {subscription['unit']}"]
+            for column, value in enumerate(values):
+                self.table.setItem(index, column, QTableWidgetItem(value))
+        self.historyOutput.setPlainText("\n".join(
+            f"{run['due']}  subscription {run['subscription']}  {run['state']}  "
+            f"{run['transactionreference'] or ''} {run['errorcode'] or ''} {run['errormessage'] or ''}"
+            for run in history))
+
+    def selectedIds(self) -> list:
+        rows = {index.row() for index in self.table.selectionModel().selectedRows()}
+        return [int(self.table.item(row, 0).text()) for row in sorted(rows)]
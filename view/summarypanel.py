@@ -0,0 +1,48 @@
+from PySide6.QtWidgets import QComboBox, QHBoxLayout, QHeaderView, QLabel, QTableWidget, QTableWidgetItem, \
+    QVBoxLayout, QWidget
+from lib.config import Config
+from model.aggregator import DIMENSIONS, BUCKETS
+
+cfg = Config()
+
+
+class SummaryPanel(QWidget):
+    """Totals of baseamount per currency, optionally split by another field and/or a time bucket."""
+
+    def __init__(self):
+        super().__init__()
+        self.setMaximumWidth(450)
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+        controls = QHBoxLayout()
+        self.groupInput = QComboBox()
+        self.groupInput.addItem("", None)
+        for dimension in DIMENSIONS[1:]:
+            self.groupInput.addItem(cfg.FIELDS[dimension]["humanString"], dimension)
+        self.bucketInput = QComboBox()
+        self.bucketInput.addItem("", None)
+        for bucket in BUCKETS:
+            self.bucketInput.addItem(bucket, bucket)
+        for w in [QLabel("Split by"), self.groupInput, QLabel("per"), self.bucketInput]:
+            controls.addWidget(w)
+        layout.addLayout(controls)
+        self.table = QTableWidget(0, 4)
+        self.table.setHorizontalHeaderLabels(["Group", "Count", "Total", "Average"])
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        layout.addWidget(self.table)
+
+    def grouping(self) -> tuple:
+        """The groupBy and bucket arguments for TransactionAggregator.summarise from the current selection."""
+        groupBy = ["currencyiso3a"]
+        if self.groupInput.currentData() is not None:
+            groupBy.append(self.groupInput.currentData())
+        return tuple(groupBy), self.bucketInput.currentData()
+
+    def display(self, summary: list):
+        self.table.setRowCount(len(summary))
+        for row, (key, count, total, average) in enumerate(summary):
+            cells = [" / ".join(v or "-" for v in key), str(count), f"{total / 100:.2f}", f"{average / 100:.2f}"]
+            for col, text in enumerate(cells):
+                self.table.setItem(row, col, QTableWidgetItem(text))
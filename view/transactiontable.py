@@ -1,56 +1,269 @@
-from PySide6.QtCore import Qt
-from PySide6.QtWidgets import QHeaderView, QTableWidget, QTableView
+from datetime import datetime
+import numpy as np
+from PySide6.QtCore import (Qt, QAbstractTableModel, QItemSelection, QItemSelectionModel, QModelIndex, QSettings,
+                            Signal)
+from PySide6.QtGui import QBrush
+from PySide6.QtWidgets import QHeaderView, QMenu, QTableView
 from lib.config import Config
 from lib.logger import createLogger
-from view.transactiontableitem import TransactionTableItem
+from lib.profiling import profiled
+from model.selection import Selection
+from model.transaction import SettleStatus, Transaction
 
 log = createLogger(__name__)
 cfg = Config()
 
+STATUS_CONVERSION = {
+    SettleStatus.PENDING: {"color": QBrush(Qt.cyan), "text": "Pending"},
+    SettleStatus.MANUAL: {"color": QBrush(Qt.gray), "text": "Manual"},
+    SettleStatus.SETTLING: {"color": QBrush(Qt.cyan), "text": "Settling"},
+    SettleStatus.SETTLED: {"color": QBrush(Qt.green), "text": "Settled"},
+    SettleStatus.SUSPENDED: {"color": QBrush(Qt.yellow), "text": "Suspended"},
+    SettleStatus.CANCELLED: {"color": QBrush(Qt.red), "text": "Cancelled"}
+}
+# Fields only ever sent in requests, never returned in a transaction record
+REQUEST_ONLY_FIELDS = ["pan", "securitycode", "requesttypedescriptions", "paymenttypedescriptions", "errorurlredirect",
+                       "successfulurlredirect"]
+SETTINGS_KEY = "transactionTable/columns"
+
+
+class TransactionTableModel(QAbstractTableModel):
+    """
+    Table model over the loaded transactions. Cells are formatted when Qt asks for them, so only the visible rows
+    cost anything, and filtering just swaps the list of rows.
+
+    The rows are the store's own Transactions, not copies, so several tables can show overlapping results of one
+    TransactionStore and a change to a transaction shows in all of them after a refresh.
+
+    There is a column for every field a record can have. Which of them are shown, and in what order, is up to the
+    table's header, so changing the columns never touches the rows.
+    """
 
-class TransactionTable(QTableWidget):
     def __init__(self):
-        super().__init__(0, 0)
-        self._setupTableHeaders()
-        self.setSelectionBehavior(QTableView.SelectRows)
-        self.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        super().__init__()
+        self.fields = [f for f in cfg.FIELDS if f not in REQUEST_ONLY_FIELDS]
+        self.headers = [cfg.FIELDS[f]["humanString"] for f in self.fields]
         self.transactions = []
+        self.rows = []
+        self._byRef = {}
+        self._mask = None
+        self._index = None
+        self._ids = None
+        self._idsGeneration = None
+        self._refundable = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.fields)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        transaction = self.rows[index.row()]
+        field = self.fields[index.column()]
+        if role == Qt.DisplayRole:
+            if field == "baseamount":
+                amount = transaction.baseamount
+                return "" if amount is None else f"{amount / 100:.2f} {transaction.currencyiso3a}"
+            if field == "settlestatus":
+                status = transaction.settlestatus
+                return STATUS_CONVERSION[status]["text"] if status is not None else transaction.get(field)
+            return transaction.get(field)
+        if role == Qt.BackgroundRole and field == "settlestatus" and transaction.settlestatus is not None:
+            return STATUS_CONVERSION[transaction.settlestatus]["color"]
+        return None
+
+    def add(self, transactions):
+        """Add (or replace, by transactionreference) transactions, newest first."""
+        self.beginResetModel()
+        for t in transactions:
+            self._byRef[t.transactionreference] = t
+        self.transactions = sorted(self._byRef.values(), reverse=True, key=lambda t: t.timestamp or datetime.min)
+        self._ids = None
+        self._applyFilter()
+        self.endResetModel()
+
+    def refresh(self):
+        """Re-sort and re-filter after transactions changed in place."""
+        self.add([])
+
+    def setFilter(self, mask, index):
+        """Only show the transactions matched by a SearchIndex mask, or everything if mask is None."""
+        self.beginResetModel()
+        self._mask = mask
+        if index is not self._index:
+            self._ids = None
+        self._index = index
+        self._applyFilter()
+        self.endResetModel()
+
+    def clear(self):
+        self.beginResetModel()
+        self.transactions = []
+        self.rows = []
+        self._byRef = {}
+        self._ids = None
+        self._refundable = None
+        self.endResetModel()
+
+    def refundablePrefix(self) -> np.ndarray:
+        """Running count of the refundable transactions in rows, with a leading 0. Worked out once per change of rows."""
+        if self._refundable is None:
+            flags = np.fromiter((t.isRefundable for t in self.rows), dtype=bool, count=len(self.rows))
+            self._refundable = np.zeros(len(flags) + 1, dtype=np.int64)
+            np.cumsum(flags, out=self._refundable[1:])
+        return self._refundable
+
+    def _applyFilter(self):
+        self._refundable = None
+        if self._mask is None:
+            self.rows = self.transactions
+            return
+        # Transactions added to the store since, in any tab, get new ids in the index
+        if self._ids is None or self._idsGeneration != self._index.generation:
+            self._ids = self._index.idsOf(t.transactionreference for t in self.transactions)
+            self._idsGeneration = self._index.generation
+        transactions = self.transactions
+        self.rows = [transactions[i] for i in np.flatnonzero(self._mask[self._ids]).tolist()]
+
+
+class TransactionTable(QTableView):
+    # Emitted with the fields shown whenever they change
+    columnsChanged = Signal(list)
 
-    def _setupTableHeaders(self):
-        headers = [(d["humanString"], d["position"]) for h, d in cfg.FIELDS.items() if d["activeInTransactionTableHeader"]]
-        # Sort the headers
-        headers = [header for header, position in sorted(headers, key=lambda h: h[1])]
-        # Apply the headers
-        self.setColumnCount(len(headers))
+    def __init__(self):
+        super().__init__()
+        self.tableModel = TransactionTableModel()
+        self.setModel(self.tableModel)
+        self.setSelectionBehavior(QTableView.SelectRows)
         self.verticalHeader().setVisible(False)
-        self.setHorizontalHeaderLabels(headers)
+        header = self.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        header.setSectionsMovable(True)
+        header.setContextMenuPolicy(Qt.CustomContextMenu)
+        header.customContextMenuRequested.connect(self._showColumnMenu)
+        self._settings = QSettings("WebservicesClient", "WebservicesClient")
+        columns = self._settings.value(SETTINGS_KEY) or cfg.defaultHeaders()
+        # QSettings gives back a one item list as a plain string
+        self.setColumns([columns] if isinstance(columns, str) else columns)
+        header.sectionMoved.connect(lambda *args: self._saveColumns())
+
+    @property
+    def transactions(self) -> list:
+        """The transactions in the order they're shown (after any filter)."""
+        return self.tableModel.rows
+
+    def transactionAt(self, index) -> Transaction:
+        return self.tableModel.rows[index.row()]
+
+    def selectedRanges(self) -> list:
+        """Selected rows as (top, bottom) pairs, inclusive."""
+        return [(r.top(), r.bottom()) for r in self.selectionModel().selection()]
 
+    def selection(self) -> Selection:
+        """The selected transactions, as they were shown when selected, however the rows change afterwards."""
+        # The prefix is taken now, with the rows it was worked out over
+        return Selection(self.tableModel.rows, self.selectedRanges(), self.tableModel.refundablePrefix())
+
+    @profiled
     def populate(self, transactions):
         """
         Fill the table with Transactions.
         """
         log.debug(f"populateTable called with {len(transactions)} transactions")
-        row = 0
-        for transaction in sorted(transactions, reverse=True, key=lambda x: x["transactionstartedtimestamp"]):
-            self.insertRow(row)
-            col = 0
-            # Build each row
-            for field, data in sorted(cfg.FIELDS.items(), key=lambda i: i[1]["position"]):
-                if data["activeInTransactionTableHeader"]:
-                    text = transaction.get(field, "")
-                    if field == "baseamount":
-                        text = f"{float(text)/100:.2f} {transaction.get('currencyiso3a', '')}"
-                    item = TransactionTableItem(text=text, ref=transaction["transactionreference"])
-                    if field == "settlestatus":
-                        item.applyStatusColor(text)
-                    item.setFlags(Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsEnabled)
-                    self.setItem(row, col, item)
-                    col += 1
-            row += 1
-            self.transactions.append(transaction)
+        self._keepingSelection(lambda: self.tableModel.add(transactions))
         log.debug("populateTable returning")
 
+    def refresh(self):
+        self._keepingSelection(self.tableModel.refresh)
+
+    def references(self) -> list:
+        """transactionreferences of every transaction in the table, filtered out or not."""
+        return [t.transactionreference for t in self.tableModel.transactions]
+
+    def setFilter(self, mask, index):
+        """Selected transactions that are still shown stay selected."""
+        self._keepingSelection(lambda: self.tableModel.setFilter(mask, index))
+
     def clear(self):
-        self.setRowCount(0)
-        self.transactions = []
+        self.tableModel.clear()
         log.debug("Table cleared!")
+
+    def columns(self) -> list:
+        """The fields shown, in the order they're shown."""
+        header = self.horizontalHeader()
+        fields = self.tableModel.fields
+        visual = [header.logicalIndex(i) for i in range(header.count())]
+        return [fields[i] for i in visual if not header.isSectionHidden(i)]
+
+    def setColumns(self, columns):
+        """Show only the given fields, in that order. Unknown fields are ignored."""
+        header = self.horizontalHeader()
+        fields = self.tableModel.fields
+        columns = [f for f in columns if f in fields]
+        # Shown columns first, in order, then the hidden ones in their model order
+        order = [fields.index(f) for f in columns] + [i for i, f in enumerate(fields) if f not in columns]
+        header.blockSignals(True)
+        for visual, logical in enumerate(order):
+            header.moveSection(header.visualIndex(logical), visual)
+            header.setSectionHidden(logical, fields[logical] not in columns)
+        header.blockSignals(False)
+        header.viewport().update()
+        self._saveColumns()
+
+    def toggleColumn(self, field):
+        """Show a hidden field at the end of the shown columns, or hide a shown one."""
+        columns = self.columns()
+        self.setColumns([f for f in columns if f != field] if field in columns else columns + [field])
+
+    # PRIVATE METHODS --------------------------------------------------------------------
+    def _keepingSelection(self, change):
+        """
+        Make a change that resets the model, e.g. a prefetch chunk arriving, and select the same transactions (and make
+        the same one current) again afterwards, so background loading doesn't take the user's selection away.
+        """
+        current = self.currentIndex()
+        currentRef = self.transactionAt(current).transactionreference if current.isValid() else None
+        selected = None
+        if self.selectionModel().hasSelection():
+            selected = {t.transactionreference for t in self.selection()}
+        change()
+        rows = self.tableModel.rows
+        if currentRef is not None:
+            row = next((i for i, t in enumerate(rows) if t.transactionreference == currentRef), None)
+            if row is not None:
+                self.selectionModel().setCurrentIndex(self.tableModel.index(row, current.column()),
+                                                      QItemSelectionModel.NoUpdate)
+        if not selected:
+            return
+        flags = np.fromiter((t.transactionreference in selected for t in rows), dtype=bool, count=len(rows))
+        # Runs of selected rows, each one range of the selection
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], flags, [False])).astype(np.int8)))
+        lastColumn = self.tableModel.columnCount() - 1
+        selection = QItemSelection()
+        for top, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+            selection.select(self.tableModel.index(top, 0), self.tableModel.index(end - 1, lastColumn))
+        self.selectionModel().select(selection, QItemSelectionModel.Select)
+
+    def _showColumnMenu(self, position):
+        menu = QMenu(self)
+        columns = self.columns()
+        for field in sorted(self.tableModel.fields, key=lambda f: cfg.FIELDS[f]["humanString"].lower()):
+            action = menu.addAction(cfg.FIELDS[field]["humanString"])
+            action.setCheckable(True)
+            action.setChecked(field in columns)
+            # Never hide the last column, the header would go with it
+            action.setEnabled(field not in columns or len(columns) > 1)
+            action.triggered.connect(lambda checked=False, field=field: self.toggleColumn(field))
+        menu.addSeparator()
+        menu.addAction("Reset columns", lambda: self.setColumns(cfg.defaultHeaders()))
+        menu.exec(self.horizontalHeader().mapToGlobal(position))
+
+    def _saveColumns(self):
+        self._settings.setValue(SETTINGS_KEY, self.columns())
+        self.columnsChanged.emit(self.columns())